@@ -0,0 +1,82 @@
+"""Import throughput: per-row inserts (before) vs. the batched, diff-based pipeline (after).
+
+Run from the repository root:
+    python benchmarks/bench_import.py [rows ...]
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_utils
+import import_proxies
+from db_utils import init_db, open_pools, close_pools, write_connection, UPSERT_PROXY_SQL
+from fetcher import STREAM_CHUNK_SIZE, iter_proxy_records
+from storage import proxy_row
+from generators import synthetic_proxies
+
+DEFAULT_SIZES = (10_000, 100_000)
+
+
+async def legacy_import(data):
+    """The original import loop: one awaited execute per proxy."""
+    imported_at = time.time()
+    async with write_connection('proxies') as db:
+        for proxy_data in data:
+            await db.execute(UPSERT_PROXY_SQL, proxy_row(proxy_data, imported_at))
+        await db.commit()
+
+
+async def timed(coro):
+    started = time.perf_counter()
+    await coro
+    return time.perf_counter() - started
+
+
+async def reimport_with_changes(data, fraction):
+    """Import once untimed, then time a re-import where ``fraction`` of proxies changed."""
+    await import_proxies.import_proxies(data)
+    changed = [dict(proxy, timeout=proxy['timeout'] + 1) if i % int(1 / fraction) == 0 else proxy
+               for i, proxy in enumerate(data)]
+    return await timed(import_proxies.import_proxies(changed))
+
+
+async def streamed(payload, chunk_size=STREAM_CHUNK_SIZE):
+    for i in range(0, len(payload), chunk_size):
+        yield payload[i:i + chunk_size]
+
+
+async def run(sizes):
+    for size in sizes:
+        data = synthetic_proxies(size)
+        payload = json.dumps({'proxies': data}).encode()
+        cases = (
+            ('before: per-row execute', lambda: timed(legacy_import(data))),
+            ('after: executemany batches', lambda: timed(import_proxies.import_proxies(data))),
+            ('after: streamed JSON + batches', lambda: timed(import_proxies.import_proxies(
+                iter_proxy_records(streamed(payload))))),
+            ('after: re-import, 10% changed', lambda: reimport_with_changes(data, 0.1)),
+        )
+        for name, case in cases:
+            with tempfile.TemporaryDirectory() as tmp:
+                async def get_db_path(db_name):
+                    return os.path.join(tmp, f'{db_name}.db')
+                db_utils.get_db_path = get_db_path
+                await open_pools(['proxies'])
+                try:
+                    await init_db()
+                    elapsed = await case()
+                finally:
+                    await close_pools()
+            print(f'{size:>8} rows  {name:<32} {elapsed:8.2f}s  {size / elapsed:>10,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    asyncio.run(run(sizes))
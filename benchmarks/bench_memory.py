@@ -0,0 +1,109 @@
+"""Memory held per alive proxy: dicts (before) vs. ProxyRecord objects vs. ProxyColumns (after).
+
+"before" is the previous layout of the alive index plus the cards built
+from it: a 10-key card dict, a filter-attributes dict and a quality entry
+per proxy. Strings are fresh copies per row, as a database driver returns
+them. Also measures a complete AliveIndex, which adds the weighted sets.
+
+Run from the repository root:
+    python benchmarks/bench_memory.py [proxies ...]
+"""
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_index import AliveIndex
+from records import ProxyColumns, ProxyRecord
+
+DEFAULT_SIZES = (100_000, 1_000_000)
+
+COUNTRIES = (('DE', 'Germany'), ('US', 'United States'), ('BR', 'Brazil'), ('ID', 'Indonesia'))
+
+
+def fresh(value):
+    """A new string object with the same text, like each row fetched from a database."""
+    return value.encode().decode()
+
+
+def rows(count, seed=0):
+    """Yield proxy_info rows: (proxy, protocol, ip, port, country_code, country, anonymity, ssl, latency, last_checked)."""
+    rng = random.Random(seed)
+    now = time.time()
+    for i in range(count):
+        ip = f'{10 + i // 16_777_216}.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+        port = rng.choice((80, 1080, 3128, 8080))
+        protocol = rng.choice(('http', 'socks4', 'socks5'))
+        country_code, country = rng.choice(COUNTRIES)
+        yield (f'{protocol}://{ip}:{port}', fresh(protocol), ip, port, fresh(country_code), fresh(country),
+               fresh(rng.choice(('transparent', 'anonymous', 'elite'))), rng.random() < 0.3,
+               rng.uniform(50, 5000), now - rng.uniform(0, 3600))
+
+
+def build_dicts(count):
+    cards, attributes, quality = {}, {}, {}
+    for proxy, protocol, ip, port, country_code, country, anonymity, ssl, latency, last_checked in rows(count):
+        cards[proxy] = {
+            'proxy': proxy, 'protocol': protocol, 'ip': ip, 'port': port, 'country_code': country_code,
+            'country': country, 'anonymity': anonymity, 'https': 'Yes' if ssl else 'No',
+            'latency': latency, 'last_checked': last_checked,
+        }
+        attributes[proxy] = {'protocol': protocol, 'country_code': country_code, 'anonymity': anonymity}
+        quality[proxy] = random.random()
+    return cards, attributes, quality
+
+
+def build_records(count):
+    records, quality = {}, {}
+    for row in rows(count):
+        records[row[0]] = ProxyRecord.from_row(row)
+        quality[row[0]] = random.random()
+    return records, quality
+
+
+def build_columns(count):
+    table = ProxyColumns()
+    for row in rows(count):
+        table.add(ProxyRecord.from_row(row), random.random())
+    return table
+
+
+def build_index(count):
+    index = AliveIndex()
+    index.replace((ProxyRecord.from_row(row), row[8], random.random()) for row in rows(count))
+    return index
+
+
+def measure(build, count):
+    """Bytes still allocated after ``build(count)``, and the seconds it took."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build(count)
+    elapsed = time.perf_counter() - started
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return held, elapsed
+
+
+def main(sizes):
+    cases = (
+        ('before: dicts per proxy', build_dicts),
+        ('after: ProxyRecord objects', build_records),
+        ('after: ProxyColumns', build_columns),
+        ('after: AliveIndex (columns + sets)', build_index),
+    )
+    for count in sizes:
+        for name, build in cases:
+            held, elapsed = measure(build, count)
+            print(f'{count:>9} proxies  {name:<36} {held / 2**20:9.1f} MiB  {held / count:7.0f} B/proxy  {elapsed:6.2f}s')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
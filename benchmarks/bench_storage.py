@@ -0,0 +1,93 @@
+"""The same workload against each storage backend.
+
+Imports a synthetic proxy list, re-imports it with 10% changed, then times
+the per-request queries: proxy lookups, assignments and assignment reads.
+PostgresStore is included when BENCH_POSTGRES_DSN points at a scratch
+database (its tables are dropped first).
+
+Run from the repository root:
+    python benchmarks/bench_storage.py [rows ...]
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_utils
+from db_utils import init_db, create_users_table, create_store, use_store
+from generators import synthetic_proxies
+
+DEFAULT_SIZES = (10_000, 100_000)
+USERS = 2_000
+
+
+async def timed_calls(calls):
+    """Run ``calls`` one after another; return the total seconds."""
+    started = time.perf_counter()
+    for call in calls:
+        await call()
+    return time.perf_counter() - started
+
+
+async def workload(store, data):
+    proxies = [proxy['proxy'] for proxy in data]
+    changed = [dict(proxy, timeout=proxy['timeout'] + 1) if i % 10 == 0 else proxy for i, proxy in enumerate(data)]
+    results = []
+
+    started = time.perf_counter()
+    await store.import_proxies(data)
+    results.append(('import', time.perf_counter() - started, len(data)))
+    started = time.perf_counter()
+    await store.import_proxies(changed)
+    results.append(('re-import, 10% changed', time.perf_counter() - started, len(data)))
+
+    users = range(USERS)
+    cases = (
+        ('get_proxy_info', [lambda i=i: db_utils.get_proxy_info(proxies[i * 7 % len(proxies)]) for i in users]),
+        ('assign_proxy', [lambda i=i: db_utils.assign_proxy(i, proxies[i * 13 % len(proxies)], 'en') for i in users]),
+        ('get_assigned_proxies', [lambda i=i: db_utils.get_assigned_proxies_and_language_code(i) for i in users]),
+    )
+    for name, calls in cases:
+        elapsed = await timed_calls(calls)
+        results.append((name, elapsed, len(calls)))
+    return results
+
+
+async def run_backend(backend, data):
+    with tempfile.TemporaryDirectory() as tmp:
+        async def get_db_path(db_name):
+            return os.path.join(tmp, f'{db_name}.db')
+        db_utils.get_db_path = get_db_path
+        store = create_store(backend, os.environ.get('BENCH_POSTGRES_DSN'))
+        previous = use_store(store)
+        await store.open()
+        try:
+            if backend == 'postgres':
+                await store._pool.execute('DROP TABLE IF EXISTS user_proxies, users, proxy_geo, proxies, leases, generations')
+            await init_db()
+            await create_users_table()
+            return await workload(store, data)
+        finally:
+            await store.close()
+            use_store(previous)
+
+
+async def run(sizes):
+    backends = ['sqlite', 'memory']
+    if os.environ.get('BENCH_POSTGRES_DSN'):
+        backends.append('postgres')
+    for size in sizes:
+        data = synthetic_proxies(size)
+        for backend in backends:
+            for name, elapsed, count in await run_backend(backend, data):
+                print(f'{size:>8} rows  {backend:<9} {name:<24} {elapsed:8.3f}s  {count / elapsed:>12,.0f} ops/sec')
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    asyncio.run(run(sizes))
@@ -0,0 +1,93 @@
+"""Webhook load test: POST synthetic updates and measure updates/sec and handler latency.
+
+The real handlers run against a temporary database; Telegram API calls are
+replaced by a stub that sleeps for --api-latency seconds.
+
+Run from the repository root:
+    python benchmarks/bench_webhook.py [--updates N] [--chats N] [--workers N]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import TestClient, TestServer
+from telebot.async_telebot import AsyncTeleBot
+
+import db_utils
+import webhook
+from generators import synthetic_proxies, synthetic_update
+from db_utils import init_db, create_users_table, rebuild_alive_index, open_pools, close_pools
+from handlers import register_handlers
+from import_proxies import import_proxies
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run(args):
+    rng = random.Random(0)
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp:
+        async def get_db_path(db_name):
+            return os.path.join(tmp, f'{db_name}.db')
+        db_utils.get_db_path = get_db_path
+        await open_pools()
+        try:
+            await init_db()
+            await create_users_table()
+            await import_proxies(synthetic_proxies(args.proxies))
+            await rebuild_alive_index()
+
+            bot = AsyncTeleBot('123456:BENCHMARK')
+
+            async def fake_send_message(*_, **__):
+                await asyncio.sleep(args.api_latency)
+            bot.send_message = fake_send_message
+            register_handlers(bot)
+
+            app = webhook.create_webhook_app(bot, max_workers=args.workers, on_processed=latencies.append)
+            updates = [synthetic_update(i, rng.randrange(args.chats), rng) for i in range(args.updates)]
+            async with TestClient(TestServer(app)) as client:
+                sem = asyncio.Semaphore(args.clients)
+
+                async def post(update):
+                    async with sem:
+                        response = await client.post(webhook.WEBHOOK_PATH, json=update)
+                        response.release()
+
+                started = time.perf_counter()
+                await asyncio.gather(*(post(update) for update in updates))
+                accepted = time.perf_counter() - started
+                await app[webhook.DISPATCHER_KEY].join()
+                elapsed = time.perf_counter() - started
+        finally:
+            await close_pools()
+
+    latencies.sort()
+    print(f'{args.updates} updates from {args.chats} chats, {args.workers} workers, '
+          f'{args.api_latency * 1000:.0f}ms stub API latency')
+    print(f'  accepted:  {args.updates / accepted:,.0f} updates/sec')
+    print(f'  processed: {args.updates / elapsed:,.0f} updates/sec')
+    print(f'  handler latency p50 {percentile(latencies, 0.5) * 1000:.1f}ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=webhook.WEBHOOK_WORKERS)
+    parser.add_argument('--clients', type=int, default=50, help='concurrent HTTP requests')
+    parser.add_argument('--proxies', type=int, default=10_000)
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(run(args))
@@ -0,0 +1,78 @@
+"""Synthetic inputs shared by the benchmarks: proxyscrape payloads and Telegram updates."""
+import json
+import random
+import time
+
+SIZES = (1_000, 10_000, 100_000)
+
+
+def synthetic_proxies(count, seed=0):
+    """Generate proxyscrape-shaped records."""
+    rng = random.Random(seed)
+    protocols = ('http', 'socks4', 'socks5')
+    countries = (('DE', 'Germany'), ('US', 'United States'), ('BR', 'Brazil'), ('ID', 'Indonesia'))
+    now = time.time()
+    proxies = []
+    for i in range(count):
+        ip = f'{10 + i // 16_777_216}.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}'
+        port = rng.choice((80, 1080, 3128, 8080))
+        protocol = rng.choice(protocols)
+        country_code, country = rng.choice(countries)
+        timeout = rng.uniform(50, 5000)
+        proxies.append({
+            'proxy': f'{protocol}://{ip}:{port}',
+            'alive': rng.random() < 0.9,
+            'alive_since': now - rng.uniform(0, 86400),
+            'anonymity': rng.choice(('transparent', 'anonymous', 'elite')),
+            'average_timeout': timeout,
+            'first_seen': now - rng.uniform(0, 864000),
+            'ip': ip,
+            'ip_data': {
+                'as': f'AS{rng.randint(1, 65000)}', 'asname': 'EXAMPLE-AS', 'city': 'City',
+                'continent': 'Europe', 'country': country, 'countryCode': country_code,
+                'isp': 'Example ISP', 'org': 'Example Org', 'regionName': 'Region',
+                'timezone': 'UTC', 'zip': '00000',
+            },
+            'last_seen': now,
+            'port': port,
+            'protocol': protocol,
+            'ssl': rng.random() < 0.3,
+            'timeout': timeout,
+            'times_alive': rng.randint(0, 500),
+            'times_dead': rng.randint(0, 500),
+            'uptime': rng.uniform(0, 100),
+        })
+    return proxies
+
+
+def synthetic_payload(count, seed=0):
+    """A proxyscrape API response body with ``count`` proxies, as bytes."""
+    return json.dumps({'proxies': synthetic_proxies(count, seed)}).encode()
+
+
+def synthetic_update(update_id, chat_id, rng):
+    """A Telegram update from ``chat_id``: /start, Main Menu, or a Get/Check Proxy button tap."""
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'language_code': 'en'}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': user,
+    }
+    kind = rng.random()
+    if kind < 0.1:
+        return {'update_id': update_id, 'message': dict(message, text='/start')}
+    if kind < 0.2:
+        return {'update_id': update_id, 'message': dict(message, text='📜 Main Menu')}
+    data = '/get_proxy' if kind < 0.6 else '/check_proxy'
+    return {
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': str(chat_id),
+                           'data': data, 'message': dict(message, text='Select an option')},
+    }
+
+
+def synthetic_updates(count, chats, seed=0):
+    """``count`` updates spread over ``chats`` chats."""
+    rng = random.Random(seed)
+    return [synthetic_update(i, rng.randrange(chats), rng) for i in range(count)]
@@ -0,0 +1,343 @@
+"""The benchmark suite: import throughput, query latency under concurrent users, handler throughput, warm start and handler latency during an import.
+
+Every case runs against a fresh temporary database at each of --sizes
+proxies. Results are written as JSON (--output, by default
+benchmarks/results/<timestamp>.json); --compare OLD.json prints the change
+of every number against an earlier run.
+
+Run from the repository root:
+    python benchmarks/run_suite.py [--sizes 1000 10000 100000] [--compare benchmarks/results/OLD.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+
+import config
+import db_utils
+import import_proxies
+import offload
+from db_utils import (SQLiteStore, init_db, create_users_table, open_store, close_store, rebuild_alive_index,
+                      save_alive_snapshot, warm_start_alive_index, use_store)
+from fetcher import Fetcher, ProxyscrapeSource, RecordDecoder, RowDecoder
+from generators import SIZES, synthetic_proxies, synthetic_updates
+from handlers import register_handlers
+from proxy_index import AliveIndex
+from render import card_cache
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def latency_summary(latencies, elapsed):
+    """Throughput and latency percentiles (in ms) of timed calls."""
+    latencies = sorted(latencies)
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+async def concurrent_calls(call, users, calls_per_user):
+    """Run ``call(user)`` ``calls_per_user`` times for each of ``users`` concurrent users."""
+    latencies = []
+
+    async def user_loop(user):
+        for _ in range(calls_per_user):
+            started = time.perf_counter()
+            await call(user)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_loop(user) for user in range(users)))
+    return latency_summary(latencies, time.perf_counter() - started)
+
+
+@contextlib.asynccontextmanager
+async def fresh_database(data=None):
+    """A temporary proxies.db, optionally imported from ``data``, with empty in-memory caches."""
+    with tempfile.TemporaryDirectory() as tmp:
+        async def get_db_path(db_name):
+            return os.path.join(tmp, f'{db_name}.db')
+        db_utils.get_db_path = get_db_path
+        db_utils.alive_index = AliveIndex()
+        card_cache.clear()
+        previous = use_store(SQLiteStore())
+        await open_store()
+        try:
+            await init_db()
+            await create_users_table()
+            if data is not None:
+                await import_proxies.import_proxies(data)
+            yield
+        finally:
+            await close_store()
+            use_store(previous)
+
+
+async def bench_import(data, args):
+    size = len(data)
+    async with fresh_database():
+        started = time.perf_counter()
+        await import_proxies.import_proxies(data)
+        first = time.perf_counter() - started
+        changed = [dict(proxy, timeout=proxy['timeout'] + 1) if i % 10 == 0 else proxy for i, proxy in enumerate(data)]
+        started = time.perf_counter()
+        await import_proxies.import_proxies(changed)
+        again = time.perf_counter() - started
+    return {
+        'first_seconds': first,
+        'first_rows_per_sec': size / first,
+        'reimport_10pct_changed_seconds': again,
+        'reimport_10pct_changed_rows_per_sec': size / again,
+    }
+
+
+async def bench_replace_proxy(data, args):
+    proxies = [proxy['proxy'] for proxy in data]
+    rng = random.Random(0)
+
+    async def call(user):
+        await db_utils.replace_proxy(user, rng.sample(proxies, 2))
+
+    results = {}
+    async with fresh_database(data):
+        results['sql'] = await concurrent_calls(call, args.users, args.calls)
+        await rebuild_alive_index()
+        results['alive_index'] = await concurrent_calls(call, args.users, args.calls)
+    return results
+
+
+async def bench_get_assigned(data, args):
+    proxies = [proxy['proxy'] for proxy in data]
+    async with fresh_database(data):
+        for user in range(args.users):
+            for i in range(db_utils.MAX_ASSIGNED_PROXIES):
+                await db_utils.assign_proxy(user, proxies[(user * 3 + i) % len(proxies)], 'en')
+
+        async def call(user):
+            await db_utils.get_assigned_proxies_and_language_code(user)
+
+        return await concurrent_calls(call, args.users, args.calls)
+
+
+def stub_bot(args):
+    """A bot with the real handlers whose Telegram API calls just sleep for --api-latency."""
+    bot = AsyncTeleBot('123456:BENCHMARK')
+
+    async def fake_api_call(*_, **__):
+        await asyncio.sleep(args.api_latency)
+    bot.send_message = fake_api_call
+    bot.answer_callback_query = fake_api_call
+    register_handlers(bot)
+    return bot
+
+
+async def bench_handlers(data, args):
+    """Updates through the real handlers, with a stub in place of the Telegram API."""
+    updates = [Update.de_json(update) for update in synthetic_updates(args.updates, args.chats)]
+    async with fresh_database(data):
+        await rebuild_alive_index()
+        bot = stub_bot(args)
+
+        queue = iter(updates)
+        latencies = []
+
+        async def client():
+            for update in queue:
+                started = time.perf_counter()
+                await bot.process_new_updates([update])
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.users)))
+        return latency_summary(latencies, time.perf_counter() - started)
+
+
+async def bench_warm_start(data, args):
+    """Time to the first assignment after a restart, rebuilding the alive index or loading its snapshot."""
+    proxies = [proxy['proxy'] for proxy in data[:2]]
+
+    async def first_assignment(start):
+        db_utils.alive_index = AliveIndex()
+        started = time.perf_counter()
+        await start()
+        await db_utils.replace_proxy(0, proxies)
+        return (time.perf_counter() - started) * 1000
+
+    async with fresh_database(data):
+        cold_ms = await first_assignment(rebuild_alive_index)
+        started = time.perf_counter()
+        snapshot_bytes = await save_alive_snapshot()
+        write_ms = (time.perf_counter() - started) * 1000
+        warm_ms = await first_assignment(warm_start_alive_index)
+    return {
+        'rebuild_first_assignment_ms': cold_ms,
+        'snapshot_first_assignment_ms': warm_ms,
+        'snapshot_write_ms': write_ms,
+        'snapshot_bytes': snapshot_bytes,
+    }
+
+
+async def bench_import_cycle(data, args):
+    """Handler latency while the leader fetches, imports, rebuilds and snapshots a list with 10% changes.
+
+    Runs with the cycle's CPU-bound steps on the event loop and with them in
+    the offload pool (see offload.py). The list is served from a local
+    server; the pool is started before timing, as it is after the first cycle.
+    """
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    changed = [dict(proxy, timeout=proxy['timeout'] + 1) if i % 10 == 0 else proxy for i, proxy in enumerate(data)]
+    body = json.dumps({'proxies': changed}).encode()
+    updates = [Update.de_json(update) for update in synthetic_updates(args.updates, args.chats)]
+
+    async def proxy_list(request):
+        return web.Response(body=body, content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/proxies', proxy_list)
+    results = {}
+    configured = getattr(config, 'OFFLOAD_PROCESSES', offload.OFFLOAD_PROCESSES)
+    async with TestServer(app) as server:
+        for mode, processes in (('event_loop', 0), ('offload', max(1, configured))):
+            config.OFFLOAD_PROCESSES = processes
+            async with fresh_database(data):
+                await rebuild_alive_index()
+                if offload.enabled():
+                    await offload.run(len, b'')
+                bot = stub_bot(args)
+                fetcher = Fetcher([ProxyscrapeSource(str(server.make_url('/proxies')))],
+                                  decoder=RowDecoder() if offload.enabled() else RecordDecoder())
+                latencies = []
+                done = asyncio.Event()
+
+                async def client(offset):
+                    i = offset
+                    while not done.is_set():
+                        started = time.perf_counter()
+                        await bot.process_new_updates([updates[i % len(updates)]])
+                        latencies.append(time.perf_counter() - started)
+                        i += args.users
+
+                clients = [asyncio.create_task(client(offset)) for offset in range(args.users)]
+                started = time.perf_counter()
+                try:
+                    await import_proxies.import_proxies(await fetcher.fetch())
+                    await rebuild_alive_index(snapshot=True)
+                finally:
+                    cycle = time.perf_counter() - started
+                    done.set()
+                    await asyncio.gather(*clients)
+                    await fetcher.close()
+            results[mode] = dict(latency_summary(latencies, cycle), cycle_seconds=cycle)
+    config.OFFLOAD_PROCESSES = configured
+    offload.shutdown()
+    return results
+
+
+CASES = {
+    'import_proxies': bench_import,
+    'replace_proxy': bench_replace_proxy,
+    'get_assigned_proxies_and_language_code': bench_get_assigned,
+    'handlers': bench_handlers,
+    'warm_start': bench_warm_start,
+    'import_cycle': bench_import_cycle,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    results = []
+    for size in args.sizes:
+        data = synthetic_proxies(size)
+        for name in args.cases:
+            metrics = await CASES[name](data, args)
+            results.append({'case': name, 'size': size, 'metrics': metrics})
+            print(f'{size:>8} proxies  {name}: ' + ', '.join(f'{metric} {value:,.2f}' for metric, value in flatten(metrics)))
+    return {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+
+
+def flatten(metrics, prefix=''):
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        else:
+            yield f'{prefix}{key}', value
+
+
+def compare(old, new):
+    """Print every metric of ``new`` next to the same metric in ``old``."""
+    previous = {(result['case'], result['size']): dict(flatten(result['metrics'])) for result in old['results']}
+    print(f"\nChange since {old.get('commit') or old['started_at']}:")
+    for result in new['results']:
+        before = previous.get((result['case'], result['size']), {})
+        for metric, value in flatten(result['metrics']):
+            if before.get(metric):
+                change = (value - before[metric]) / before[metric] * 100
+                name = f"{result['case']}.{metric}"
+                print(f"{result['size']:>8} proxies  {name:<56} {before[metric]:>12.2f} -> {value:>12.2f}  {change:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--users', type=int, default=100, help='concurrent users issuing queries or updates')
+    parser.add_argument('--calls', type=int, default=20, help='queries per user')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--api-latency', type=float, default=0.02, help='seconds each stubbed Telegram call takes')
+    parser.add_argument('--output', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier JSON results to compare with')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    report = asyncio.run(run(args))
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['started_at'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
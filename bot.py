@@ -1,26 +1,237 @@
+import argparse
 import asyncio
 import logging
-from telebot.async_telebot import AsyncTeleBot
+import multiprocessing
+import sys
+import config
 from config import TOKEN
-from handlers import register_handlers
-from import_proxies import periodic_update
+import metrics
+import offload
+from events import bus
+from cluster import Cluster
+from render import card_cache
+from startup import StartupPhases, configure_logging, import_report, lazy
 from db_utils import (
     init_db,
-    create_users_table
+    create_users_table,
+    warm_start_alive_index,
+    open_store,
+    close_store,
+    create_store,
+    use_store,
+    STORAGE_BACKENDS
 )
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Only the leader runs these, so they are imported when it takes the lease.
+LEADER_TASKS = (
+    lazy('import_proxies', 'periodic_update'),
+    lazy('health_check', 'periodic_health_check'),
+    lazy('maintenance', 'periodic_maintenance'),
+)
+
+async def main(mode='polling', webhook_url=None, webhook_host='0.0.0.0', webhook_port=8443,
+               webhook_secret=None, webhook_workers=None, metrics_port=metrics.METRICS_PORT,
+               reuse_port=False, store=None, profile=False, register_webhook=True):
+    """Main function to initialize the bot and serve updates by polling or webhook.
+
+    Metrics are served on 127.0.0.1:``metrics_port``; pass None to switch them off.
+    Imports, health checks, maintenance and dead proxy notices only run while
+    this process holds the leader lease (see cluster.Cluster), so several
+    workers can share proxies.db. The alive index starts from the snapshot written after the
+    last import, so assignments are served before the database is re-read.
+    ``store`` replaces the default SQLite storage (see db_utils.create_store).
+    ``webhook_workers`` defaults to webhook.WEBHOOK_WORKERS; workers started by
+    launch_workers pass ``register_webhook=False`` and leave the webhook to
+    the launcher. With ``profile``
+    the startup phases are returned once the bot is ready, before any update
+    is served (see --profile-startup).
+    """
+    phases = StartupPhases()
+    if store is not None:
+        use_store(store)
+    metrics.configure(metrics_port is not None)
+    metrics_runner = None
+    sender = None
+    # The notifier starts after the sender below, once the cluster runs.
+    notify_dead_proxies = lazy('notifier', 'notify_dead_proxies')
+    cluster = Cluster(leader_tasks=LEADER_TASKS + (lambda: notify_dead_proxies(sender),))
+    cluster_task = None
+    warm_start_task = None
+    with phases('open storage'):
+        await open_store()
+    try:
+        if metrics_port is not None:
+            with phases('start metrics server'):
+                metrics_runner = await metrics.start_metrics_server(port=metrics_port)
+        with phases('migrate databases'):
+            await init_db()
+            await create_users_table()
+        with phases('load alive index'):
+            warm_start_task = await warm_start_alive_index()
+
+        # telebot (and requests under it) is most of the import time; the
+        # parent of --workers and argument errors never need it.
+        with phases('import telebot, handlers and sender'):
+            from telebot.async_telebot import AsyncTeleBot
+            from handlers import register_handlers
+            from sender import MessageSender
+        with phases('set up bot and handlers'):
+            bot = AsyncTeleBot(TOKEN)
+            if metrics_port is not None:
+                metrics.instrument_bot(bot)
+            sender = MessageSender(bot)
+            sender.start()
+            register_handlers(bot, sender)
+        if mode == 'webhook':
+            with phases('import webhook server'):
+                from webhook import run_webhook, WEBHOOK_WORKERS
+        logging.info(f"Started in {phases.total * 1000:.0f}ms: {phases.summary()}.")
+        if profile:
+            if warm_start_task is not None:
+                with phases('rebuild stale alive index', background=True):
+                    await warm_start_task
+            return phases
+
+        cluster_task = asyncio.create_task(cluster.run())
+        if mode == 'webhook':
+            await run_webhook(bot, webhook_url, webhook_host, webhook_port, secret_token=webhook_secret,
+                              max_workers=webhook_workers or WEBHOOK_WORKERS, reuse_port=reuse_port,
+                              register=register_webhook)
+        else:
+            await bot.polling(non_stop=True)
+    finally:
+        if cluster_task is not None:
+            cluster_task.cancel()
+        if warm_start_task is not None:
+            warm_start_task.cancel()
+        await cluster.stop()
+        if sender is not None:
+            await sender.close()
+        # The importer, and with it the fetcher's HTTP session, only exists on the leader.
+        importer = sys.modules.get('import_proxies')
+        if importer is not None:
+            await importer.close_fetcher()
+        offload.shutdown()
+        await bus.close()
+        await close_store()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
-async def main():
-    """Main function to initialize the bot and start polling."""
-    await init_db()
-    await create_users_table()
+def parse_args(argv=None):
+    """Startup options; webhook defaults come from optional WEBHOOK_* settings in config.py."""
+    parser = argparse.ArgumentParser(description='Proxy Bot')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=getattr(config, 'MODE', 'polling'))
+    parser.add_argument('--webhook-url', default=getattr(config, 'WEBHOOK_URL', None),
+                        help='public base URL Telegram should call, e.g. https://bot.example.com')
+    parser.add_argument('--webhook-host', default=getattr(config, 'WEBHOOK_HOST', '0.0.0.0'))
+    parser.add_argument('--webhook-port', type=int, default=getattr(config, 'WEBHOOK_PORT', 8443))
+    parser.add_argument('--webhook-secret', default=getattr(config, 'WEBHOOK_SECRET', None))
+    parser.add_argument('--webhook-workers', type=int, default=getattr(config, 'WEBHOOK_WORKERS', None),
+                        help='maximum number of updates handled at the same time (default 64)')
+    parser.add_argument('--metrics-port', type=int, default=getattr(config, 'METRICS_PORT', metrics.METRICS_PORT),
+                        help='serve Prometheus metrics on 127.0.0.1:PORT/metrics')
+    parser.add_argument('--no-metrics', dest='metrics_port', action='store_const', const=None,
+                        help='do not collect or serve metrics')
+    parser.add_argument('--workers', type=int, default=getattr(config, 'WORKERS', 1),
+                        help='bot processes to run; they share the webhook port and elect one importer')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default=getattr(config, 'STORAGE', 'sqlite'),
+                        help='where proxies and users are kept')
+    parser.add_argument('--postgres-dsn', default=getattr(config, 'POSTGRES_DSN', None),
+                        help='connection string for --storage postgres')
+    parser.add_argument('--memory-snapshot', default=getattr(config, 'MEMORY_SNAPSHOT_PATH', None),
+                        help='file the memory storage is saved to and restored from')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report import and startup phase times, then exit without serving updates')
+    args = parser.parse_args(argv)
+    if args.mode == 'webhook' and not args.webhook_url:
+        parser.error('--webhook-url (or WEBHOOK_URL in config.py) is required in webhook mode')
+    if args.workers > 1 and args.mode != 'webhook':
+        parser.error('--workers needs --mode webhook: Telegram allows only one getUpdates poller per token')
+    if args.workers > 1 and args.storage == 'memory':
+        parser.error('--storage memory keeps data inside one process and cannot be shared by --workers')
+    if args.storage == 'postgres' and not args.postgres_dsn:
+        parser.error('--postgres-dsn (or POSTGRES_DSN in config.py) is required with --storage postgres')
+    return args
 
+def store_from_args(args):
+    return create_store(args.storage, args.postgres_dsn, args.memory_snapshot)
+
+async def prepare_database(store=None):
+    """Create and migrate the databases once, before any worker starts."""
+    if store is not None:
+        use_store(store)
+    await open_store()
+    try:
+        await init_db()
+        await create_users_table()
+    finally:
+        await close_store()
+
+def run_worker(args, index):
+    """Entry point of one worker process started by launch_workers."""
+    # A card cached here would miss proxies assigned to the same user by
+    # another worker, so workers always read assignments from the database.
+    card_cache.max_size = 0
+    configure_logging()
+    metrics_port = args.metrics_port + index if args.metrics_port is not None else None
+    asyncio.run(main(args.mode, args.webhook_url, args.webhook_host, args.webhook_port,
+                     args.webhook_secret, args.webhook_workers, metrics_port, reuse_port=True,
+                     store=store_from_args(args), register_webhook=False))
+
+async def set_shared_webhook(args, remove=False):
+    """Register the webhook the workers serve, or remove it once they are gone."""
+    from telebot.async_telebot import AsyncTeleBot
+    from webhook import register_webhook
     bot = AsyncTeleBot(TOKEN)
-    register_handlers(bot)
+    try:
+        if remove:
+            await bot.remove_webhook()
+        else:
+            await register_webhook(bot, args.webhook_url, secret_token=args.webhook_secret)
+    finally:
+        await bot.close_session()
+
+def launch_workers(args):
+    """Run ``args.workers`` bot processes and wait for them to exit.
+
+    The webhook is registered here, once, rather than by each worker: a
+    worker that exits or restarts must not unregister it for the others.
+    """
+    asyncio.run(prepare_database(store_from_args(args)))
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(args, index), name=f'bot-worker-{index}')
+                 for index in range(args.workers)]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {len(processes)} workers.")
+    try:
+        asyncio.run(set_shared_webhook(args))
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # The workers got the same SIGINT and shut down on their own.
+            for process in processes:
+                process.join()
+    finally:
+        asyncio.run(set_shared_webhook(args, remove=True))
 
-    asyncio.create_task(periodic_update())
-    await bot.polling(non_stop=True)
+def profile_startup(args):
+    """Print where cold start time goes: imports in a fresh interpreter, then each phase of main."""
+    print(import_report(['bot', 'webhook'] if args.mode == 'webhook' else ['bot']))
+    phases = asyncio.run(main(args.mode, args.webhook_url, args.webhook_host, args.webhook_port,
+                              args.webhook_secret, args.webhook_workers, args.metrics_port,
+                              store=store_from_args(args), profile=True))
+    print(phases.report())
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    configure_logging()
+    args = parse_args()
+    if args.profile_startup:
+        profile_startup(args)
+    elif args.workers > 1:
+        launch_workers(args)
+    else:
+        asyncio.run(main(args.mode, args.webhook_url, args.webhook_host, args.webhook_port,
+                         args.webhook_secret, args.webhook_workers, args.metrics_port,
+                         store=store_from_args(args)))
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+from db_utils import (
+    acquire_lease,
+    release_lease,
+    get_generation,
+    rebuild_alive_index,
+    forget_import_snapshot,
+    PROXIES_GENERATION
+)
+from metrics import Gauge
+from render import card_cache
+
+LEADER_LEASE = 'leader'
+LEASE_TTL = 30.0  # seconds a leader keeps the lease without renewing it
+LEASE_RENEW_INTERVAL = 10.0  # seconds between renewals, and between follower syncs
+
+IS_LEADER = Gauge('cluster_is_leader', '1 if this worker holds the leader lease.')
+
+
+def worker_id():
+    """A name for this process that is unique across hosts and restarts."""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class Cluster:
+    """Leader election for bot workers sharing one proxies.db.
+
+    Every worker calls run(). The one holding the LEADER_LEASE row runs
+    ``leader_tasks`` (the importer and the health checker); a leader that
+    stops renewing loses the lease LEASE_TTL seconds later and another
+    worker takes over. Followers poll the proxies generation, which the
+    leader bumps with every write, and rebuild their alive index and drop
+    their card cache when it changes.
+    """
+
+    def __init__(self, leader_tasks=(), holder=None, ttl=LEASE_TTL, interval=LEASE_RENEW_INTERVAL):
+        self.leader_tasks = leader_tasks
+        self.holder = holder or worker_id()
+        self.ttl = ttl
+        self.interval = interval
+        self.is_leader = False
+        self.generation = None
+        self.reloads = 0
+        self._tasks = []
+
+    async def _become_leader(self):
+        logging.info(f"Worker {self.holder} is now the leader.")
+        self.is_leader = True
+        IS_LEADER.set(1)
+        self._tasks = [asyncio.create_task(task()) for task in self.leader_tasks]
+
+    async def _step_down(self):
+        self.is_leader = False
+        IS_LEADER.set(0)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # The next leader imports, so what this worker remembers of its own imports goes stale.
+        await forget_import_snapshot()
+
+    async def sync(self):
+        """Reload the in-memory caches if the proxy data changed since the last sync."""
+        generation = await get_generation(PROXIES_GENERATION)
+        if generation != self.generation:
+            if self.generation is not None:
+                count = await rebuild_alive_index()
+                card_cache.clear()
+                self.reloads += 1
+                logging.info(f"Proxy data generation {generation}: alive index reloaded with {count} proxies.")
+            self.generation = generation
+
+    async def step(self):
+        """One election round: take or renew the lease, or sync as a follower."""
+        try:
+            leader = await acquire_lease(LEADER_LEASE, self.holder, self.ttl)
+        except Exception:
+            logging.exception("Leader lease renewal failed.")
+            leader = False
+        if leader and not self.is_leader:
+            await self._become_leader()
+        elif not leader and self.is_leader:
+            logging.warning(f"Worker {self.holder} lost the leader lease.")
+            await self._step_down()
+        if self.is_leader:
+            # The leader's own writes keep its caches current.
+            self.generation = await get_generation(PROXIES_GENERATION)
+        else:
+            await self.sync()
+
+    async def run(self):
+        while True:
+            try:
+                await self.step()
+            except Exception:
+                logging.exception("Cluster step failed.")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        """Stop the leader tasks and hand the lease over right away."""
+        if self.is_leader:
+            await self._step_down()
+            await release_lease(LEADER_LEASE, self.holder)
+            logging.info(f"Worker {self.holder} released the leader lease.")
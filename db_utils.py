@@ -1,161 +1,1124 @@
 import os
+import time
+import asyncio
+import logging
+import sqlite3
 import aiosqlite
+import config
+import offload
+from events import bus, ProxyAdded, ProxyUpdated, ProxyDied, LatencyChanged, IndexRefreshed, UserAssigned, UserReleased
+from contextlib import asynccontextmanager
+from proxy_index import FILTER_ATTRIBUTES, AliveIndex, alive_index, normalize_filters, proxy_quality
+from render import card_cache
+from metrics import DB_QUERY_SECONDS, Gauge, timed
+from storage import (
+    ProxyStore, UserStore, MemoryStore, PostgresStore, MAX_ASSIGNED_PROXIES, ASSIGNMENT_TTL, BROWSE_ORDERS, BROWSE_PAGE_SIZE,
+    aiter_rows, volatile_values, fingerprint, proxy_info, import_result, browse_query, browse_row
+)
 
-async def get_db_path(db_name):
-    """Get the path to the specified database file."""
-    return os.path.join(os.path.dirname(__file__), f'{db_name}.db')
+DB_NAMES = ('proxies',)
+ALIVE_SNAPSHOT_FILE = 'alive_index.snapshot'
+READER_CONNECTIONS = 4
+IMPORT_BATCH_SIZE = 1000
+STORAGE_BACKENDS = ('sqlite', 'memory', 'postgres')
 
-async def init_db():
-    """Initialize the database and create the 'proxies' table if it doesn't exist."""
-    db_path = await get_db_path('proxies')
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-        CREATE TABLE IF NOT EXISTS proxies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            proxy TEXT NOT NULL,
-            status TEXT NOT NULL,
-            alive BOOLEAN NOT NULL,
-            alive_since REAL,
-            anonymity TEXT,
-            average_timeout REAL,
-            first_seen REAL,
-            ip TEXT,
+# Applied to every pooled connection. WAL lets the readers run alongside the
+# single writer, and NORMAL sync is durable enough for data we re-fetch anyway.
+CONNECTION_PRAGMAS = (
+    # Only takes effect on a new, empty database; see SQLiteStore.vacuum.
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+)
+
+# Recounted whenever liveness changes; the GROUP BY only reads one of the browse indexes.
+REFRESH_FACETS_SQL = (
+    'DELETE FROM proxy_facets',
+    '''
+    INSERT INTO proxy_facets (protocol, country_code, anonymity, proxies)
+    SELECT protocol, country_code, anonymity, COUNT(*) FROM proxies
+    WHERE alive = 1 AND protocol IS NOT NULL AND country_code IS NOT NULL AND anonymity IS NOT NULL
+    GROUP BY protocol, country_code, anonymity
+    ''',
+)
+
+# Schema changes applied on top of the original tables, in order. The number
+# of migrations already applied is kept in PRAGMA user_version.
+PROXIES_MIGRATIONS = (
+    # 1: one row per proxy, stamped with the import cycle that last saw it
+    (
+        'DELETE FROM proxies WHERE id NOT IN (SELECT MAX(id) FROM proxies GROUP BY proxy)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_proxies_proxy ON proxies (proxy)',
+        'ALTER TABLE proxies ADD COLUMN imported_at REAL',
+    ),
+    # 2: time of our own health check, preferred over older upstream liveness
+    (
+        'ALTER TABLE proxies ADD COLUMN checked_at REAL',
+    ),
+    # 3: geo/ASN details move to a rarely written side table
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS proxy_geo (
+            proxy_id INTEGER PRIMARY KEY REFERENCES proxies (id),
             as_value TEXT,
             asname TEXT,
             city TEXT,
             continent TEXT,
-            country TEXT,
-            country_code TEXT,
             isp TEXT,
             org TEXT,
             region_name TEXT,
-            last_seen REAL,
-            port INTEGER,
-            protocol TEXT,
-            ssl BOOLEAN,
-            timeout REAL,
-            times_alive INTEGER,
-            times_dead INTEGER,
-            uptime REAL,
             timezone TEXT,
             zip_code TEXT
         )
-        ''')
+        ''',
+        '''
+        INSERT INTO proxy_geo (proxy_id, as_value, asname, city, continent, isp, org, region_name, timezone, zip_code)
+        SELECT id, as_value, asname, city, continent, isp, org, region_name, timezone, zip_code FROM proxies
+        ''',
+    ) + tuple(
+        f'ALTER TABLE proxies DROP COLUMN {column}'
+        for column in ('as_value', 'asname', 'city', 'continent', 'isp', 'org', 'region_name', 'timezone', 'zip_code')
+    ),
+    # 4: leases for leader election and generation counters, shared by all workers.
+    (
+        'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    ),
+    # 5: covering indexes for browsing alive proxies by facet, one per
+    # storage.BROWSE_ORDERS entry, and alive proxy counts per facet combination.
+    # alive is repeated as a column so SQLite never has to visit the table.
+    tuple(
+        f'CREATE INDEX IF NOT EXISTS idx_proxies_browse_{order[0]} ON proxies ({", ".join(order)}, id, proxy, timeout, alive) WHERE alive = 1'
+        for order in BROWSE_ORDERS
+    ) + (
+        '''
+        CREATE TABLE IF NOT EXISTS proxy_facets (
+            protocol TEXT NOT NULL,
+            country_code TEXT NOT NULL,
+            anonymity TEXT NOT NULL,
+            proxies INTEGER NOT NULL,
+            PRIMARY KEY (protocol, country_code, anonymity)
+        ) WITHOUT ROWID
+        ''',
+    ) + REFRESH_FACETS_SQL,
+    # 6: lets maintenance find unlisted proxies without scanning the table
+    (
+        "CREATE INDEX IF NOT EXISTS idx_proxies_dead ON proxies (id) WHERE status = 'dead'",
+    ),
+)
+
+# Generation of the proxy data the in-memory caches are built from. Bumped
+# in the same transaction as the writes it announces.
+PROXIES_GENERATION = 'proxies'
+BUMP_GENERATION_SQL = '''
+INSERT INTO generations (name, value) VALUES (?, 1)
+ON CONFLICT (name) DO UPDATE SET value = value + 1
+'''
+GENERATION_SQL = 'SELECT value FROM generations WHERE name = ?'
+
+# Liveness and latency from our own health check (checked_at) are kept when
+# they are newer than what upstream reports.
+UPSERT_PROXY_SQL = '''
+INSERT INTO proxies (proxy, status, alive, alive_since, anonymity, average_timeout, first_seen, ip, country, country_code, last_seen, port, protocol, ssl, timeout, times_alive, times_dead, uptime, imported_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (proxy) DO UPDATE SET
+    status = excluded.status,
+    alive = CASE WHEN proxies.checked_at > excluded.last_seen THEN proxies.alive ELSE excluded.alive END,
+    alive_since = excluded.alive_since,
+    anonymity = excluded.anonymity,
+    average_timeout = excluded.average_timeout,
+    country = excluded.country,
+    country_code = excluded.country_code,
+    last_seen = excluded.last_seen,
+    ssl = excluded.ssl,
+    timeout = CASE WHEN proxies.checked_at > excluded.last_seen THEN proxies.timeout ELSE excluded.timeout END,
+    times_alive = excluded.times_alive,
+    times_dead = excluded.times_dead,
+    uptime = excluded.uptime,
+    imported_at = excluded.imported_at
+'''
+
+# Geo/ASN details rarely change, so they are only written for new proxies.
+UPSERT_PROXY_GEO_SQL = '''
+INSERT INTO proxy_geo (proxy_id, as_value, asname, city, continent, isp, org, region_name, timezone, zip_code)
+SELECT id, ?, ?, ?, ?, ?, ?, ?, ?, ? FROM proxies WHERE proxy = ?
+ON CONFLICT (proxy_id) DO UPDATE SET
+    as_value = excluded.as_value,
+    asname = excluded.asname,
+    city = excluded.city,
+    continent = excluded.continent,
+    isp = excluded.isp,
+    org = excluded.org,
+    region_name = excluded.region_name,
+    timezone = excluded.timezone,
+    zip_code = excluded.zip_code
+'''
+
+UPDATE_VOLATILE_SQL = '''
+UPDATE proxies SET
+    status = 'active',
+    alive = CASE WHEN checked_at > ?3 THEN alive ELSE ?1 END,
+    alive_since = ?2,
+    last_seen = ?3,
+    anonymity = ?4,
+    average_timeout = ?5,
+    ssl = ?6,
+    timeout = CASE WHEN checked_at > ?3 THEN timeout ELSE ?7 END,
+    times_alive = ?8,
+    times_dead = ?9,
+    uptime = ?10,
+    imported_at = ?11
+WHERE proxy = ?12
+'''
+
+# Proxies the latest fetch did not return are no longer served upstream.
+MARK_DEAD_SQL = "UPDATE proxies SET status = 'dead', alive = 0 WHERE proxy = ?"
+
+SNAPSHOT_SQL = '''
+SELECT proxy, alive, alive_since, last_seen, anonymity, average_timeout, ssl, timeout, times_alive, times_dead, uptime
+FROM proxies WHERE status != 'dead'
+'''
+
+# Unlisted proxies with no sign of life (upstream, our checks or an import)
+# since the cutoff, that no user holds.
+PRUNABLE_PROXIES_SQL = '''
+SELECT id FROM proxies p
+WHERE status = 'dead' AND alive = 0
+    AND MAX(COALESCE(last_seen, 0), COALESCE(checked_at, 0), COALESCE(imported_at, 0)) < ?
+    AND NOT EXISTS (SELECT 1 FROM user_proxies up WHERE up.proxy_id = p.id)
+LIMIT ?
+'''
+
+# Run before UPDATE_CHECKED_PROXY_SQL; its row count is how many proxies went alive or dead.
+FLIP_CHECKED_PROXY_SQL = 'UPDATE proxies SET alive = ? WHERE proxy = ? AND alive IS NOT ?'
+UPDATE_CHECKED_PROXY_SQL = '''
+UPDATE proxies SET alive = ?, timeout = COALESCE(?, timeout), checked_at = ?
+WHERE proxy = ?
+'''
+
+_pools = {}
+
+ALIVE_PROXIES = Gauge('alive_proxies', 'Proxies in the in-memory alive index.', callback=lambda: len(alive_index))
+CARD_CACHE_ENTRIES = Gauge('card_cache_entries', 'Rendered replies in the card cache.', callback=lambda: len(card_cache))
+CARD_CACHE_HIT_RATIO = Gauge('card_cache_hit_ratio', 'Card cache hits / lookups.',
+                             callback=lambda: card_cache.stats()['hit_ratio'])
+
+async def get_db_path(db_name):
+    """Get the path to the specified database file."""
+    return os.path.join(os.path.dirname(__file__), f'{db_name}.db')
+
+
+class ConnectionPool:
+    """Long-lived connections to one database: a single writer and a few readers."""
+
+    def __init__(self, db_path, readers=READER_CONNECTIONS):
+        self.db_path = db_path
+        self.size = readers
+        self.writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._connections = []
+
+    async def _connect(self, query_only=False):
+        db = await aiosqlite.connect(self.db_path)
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        if query_only:
+            await db.execute('PRAGMA query_only = ON')
+        self._connections.append(db)
+        return db
+
+    async def open(self):
+        """Open the writer and reader connections."""
+        self.writer = await self._connect()
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect(query_only=True))
+
+    async def close(self):
+        """Close every connection owned by the pool."""
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+        self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer_connection(self):
+        async with self._write_lock:
+            try:
+                yield self.writer
+            except BaseException:
+                if self.writer.in_transaction:
+                    await self.writer.rollback()
+                raise
+
+
+async def open_pools(db_names=DB_NAMES, readers=READER_CONNECTIONS):
+    """Open a connection pool for each database. Called once on startup."""
+    for db_name in db_names:
+        if db_name not in _pools:
+            pool = ConnectionPool(await get_db_path(db_name), readers)
+            await pool.open()
+            _pools[db_name] = pool
+
+async def close_pools():
+    """Close all connection pools. Called on shutdown."""
+    while _pools:
+        _, pool = _pools.popitem()
+        await pool.close()
+
+@asynccontextmanager
+async def read_connection(db_name):
+    """Borrow a reader connection, or open a one-off one if no pool is running."""
+    pool = _pools.get(db_name)
+    if pool is None:
+        async with aiosqlite.connect(await get_db_path(db_name)) as db:
+            yield db
+        return
+    async with pool.reader() as db:
+        yield db
+
+@asynccontextmanager
+async def write_connection(db_name):
+    """Borrow the writer connection, or open a one-off one if no pool is running."""
+    pool = _pools.get(db_name)
+    if pool is None:
+        async with aiosqlite.connect(await get_db_path(db_name)) as db:
+            yield db
+        return
+    async with pool.writer_connection() as db:
+        yield db
+
+async def apply_migrations(db, migrations):
+    """Apply the migrations the database has not seen yet."""
+    async with db.execute('PRAGMA user_version') as cursor:
+        version = (await cursor.fetchone())[0]
+    for number, statements in enumerate(migrations[version:], start=version + 1):
+        for statement in statements:
+            await db.execute(statement)
+        await db.execute(f'PRAGMA user_version = {number}')
+
+async def refresh_facets(db):
+    """Recount proxy_facets, inside the caller's transaction."""
+    for statement in REFRESH_FACETS_SQL:
+        await db.execute(statement)
+
+async def migrate_legacy_users():
+    """Copy users from the old users.db into the proxies database.
+
+    The old file is renamed to users.db.migrated afterwards so this runs once.
+    """
+    legacy_path = await get_db_path('users')
+    if not os.path.exists(legacy_path):
+        return 0
+    async with aiosqlite.connect(legacy_path) as legacy_db:
+        async with legacy_db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'") as cursor:
+            has_users = await cursor.fetchone()
+        rows = []
+        if has_users:
+            # Keep the latest row for users that were inserted more than once.
+            async with legacy_db.execute('''
+            SELECT user_id, assigned_proxies, language_code FROM users
+            WHERE id IN (SELECT MAX(id) FROM users GROUP BY user_id)
+            ''') as cursor:
+                rows = await cursor.fetchall()
+
+    now = time.time()
+    users = []
+    assignments = []
+    for user_id, assigned_proxies_str, language_code in rows:
+        users.append((user_id, language_code))
+        proxies = assigned_proxies_str.split(',') if assigned_proxies_str else []
+        for position, proxy in enumerate(proxies):
+            # Oldest first, matching the order of the comma-separated list.
+            assignments.append((user_id, now - len(proxies) + position, now + ASSIGNMENT_TTL, proxy))
+
+    async with write_connection('proxies') as db:
+        await db.executemany('INSERT OR IGNORE INTO users (user_id, language_code) VALUES (?, ?)', users)
+        await db.executemany('''
+        INSERT OR IGNORE INTO user_proxies (user_id, proxy_id, assigned_at, expires_at)
+        SELECT ?, id, ?, ? FROM proxies WHERE proxy = ?
+        ''', assignments)
         await db.commit()
+    os.replace(legacy_path, legacy_path + '.migrated')
+    return len(users)
+
+PROXY_INFO_COLUMNS = 'p.proxy, p.protocol, p.ip, p.port, p.country_code, p.country, p.anonymity, p.ssl, p.timeout, p.last_seen'
+ALIVE_INDEX_ENTRIES_SQL = f'''
+SELECT {PROXY_INFO_COLUMNS}, p.average_timeout, p.uptime, p.times_alive, p.times_dead
+FROM proxies p WHERE p.alive = 1
+'''
+USER_PROXIES_EXISTS_SQL = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_proxies'"
+HOLDER_COUNTS_SQL = '''
+SELECT p.proxy, COUNT(*) FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id GROUP BY up.proxy_id
+'''
+
+def alive_index_entry(row):
+    """The (ProxyRecord, latency, quality) AliveIndex entry for a row of ALIVE_INDEX_ENTRIES_SQL."""
+    average_timeout, uptime, times_alive, times_dead = row[10:]
+    return proxy_info(row[:10]), row[8] or average_timeout, proxy_quality(uptime, times_alive, times_dead)
+
+def build_alive_snapshot(db_path):
+    """Build the alive index from the proxies.db at ``db_path``; return it as snapshot bytes.
+
+    Runs in the offload pool (see rebuild_alive_index) with a plain sqlite3
+    connection. Entries, holder counts and the generation are read in one
+    transaction, so the snapshot matches a single state of the database.
+    """
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        db.execute('BEGIN')
+        entries = list(map(alive_index_entry, db.execute(ALIVE_INDEX_ENTRIES_SQL)))
+        holders = dict(db.execute(HOLDER_COUNTS_SQL)) if db.execute(USER_PROXIES_EXISTS_SQL).fetchone() else {}
+        row = db.execute(GENERATION_SQL, (PROXIES_GENERATION,)).fetchone()
+        db.execute('COMMIT')
+    finally:
+        db.close()
+    index = AliveIndex()
+    index.replace(entries, holders)
+    return index.to_snapshot(row[0] if row else 0)
+
+
+class SQLiteStore(ProxyStore, UserStore):
+    """The default backend: the tables in proxies.db, through the connection pools."""
+
+    def __init__(self):
+        # Database path -> (proxies generation, {proxy: fingerprint of the volatile
+        # fields}) as of this process's last import.
+        self._snapshots = {}
+
+    async def open(self):
+        await open_pools()
+
+    async def close(self):
+        await close_pools()
+
+    async def init_proxies(self):
+        async with write_connection('proxies') as db:
+            # Serializes startup across worker processes sharing the file.
+            await db.execute('BEGIN IMMEDIATE')
+            await db.execute('''
+            CREATE TABLE IF NOT EXISTS proxies (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                proxy TEXT NOT NULL,
+                status TEXT NOT NULL,
+                alive BOOLEAN NOT NULL,
+                alive_since REAL,
+                anonymity TEXT,
+                average_timeout REAL,
+                first_seen REAL,
+                ip TEXT,
+                as_value TEXT,
+                asname TEXT,
+                city TEXT,
+                continent TEXT,
+                country TEXT,
+                country_code TEXT,
+                isp TEXT,
+                org TEXT,
+                region_name TEXT,
+                last_seen REAL,
+                port INTEGER,
+                protocol TEXT,
+                ssl BOOLEAN,
+                timeout REAL,
+                times_alive INTEGER,
+                times_dead INTEGER,
+                uptime REAL,
+                timezone TEXT,
+                zip_code TEXT
+            )
+            ''')
+            await apply_migrations(db, PROXIES_MIGRATIONS)
+            await db.commit()
+
+    async def init_users(self):
+        async with write_connection('proxies') as db:
+            await db.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                language_code TEXT
+            )
+            ''')
+            await db.execute('''
+            CREATE TABLE IF NOT EXISTS user_proxies (
+                user_id INTEGER NOT NULL REFERENCES users (user_id),
+                proxy_id INTEGER NOT NULL REFERENCES proxies (id),
+                assigned_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (user_id, proxy_id)
+            ) WITHOUT ROWID
+            ''')
+            async with db.execute('SELECT 1 FROM pragma_table_info(?) WHERE name = ?', ('user_proxies', 'expires_at')) as cursor:
+                has_leases = await cursor.fetchone()
+            if not has_leases:
+                # Tables from before leases: every existing assignment gets a full lease.
+                await db.execute('ALTER TABLE user_proxies ADD COLUMN expires_at REAL NOT NULL DEFAULT 0')
+                await db.execute('UPDATE user_proxies SET expires_at = ?', (time.time() + ASSIGNMENT_TTL,))
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_user_proxies_proxy ON user_proxies (proxy_id)')
+            await db.execute('CREATE INDEX IF NOT EXISTS idx_user_proxies_expires ON user_proxies (expires_at)')
+            await db.commit()
+        await migrate_legacy_users()
+
+    async def forget_import_snapshot(self):
+        self._snapshots.clear()
+
+    async def _generation(self, db):
+        async with db.execute(GENERATION_SQL, (PROXIES_GENERATION,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def _load_snapshot(self, db):
+        """Fingerprint the listed proxies as stored, for the first import after a restart."""
+        async with db.execute(SNAPSHOT_SQL) as cursor:
+            return {
+                proxy: fingerprint((bool(alive), alive_since, last_seen, anonymity, average_timeout, bool(ssl), timeout, times_alive, times_dead, uptime))
+                for proxy, alive, alive_since, last_seen, anonymity, average_timeout, ssl, timeout, times_alive, times_dead, uptime in await cursor.fetchall()
+            }
+
+    async def import_proxies(self, data):
+        """Write only what changed since the previous import.
+
+        Each record's volatile fields are fingerprinted and compared with the
+        previous import: new proxies are upserted together with their geo
+        details, changed ones get an UPDATE of the volatile columns, unchanged
+        ones are skipped and proxies missing from ``data`` are marked dead.
+        Writes go out with executemany in chunks of IMPORT_BATCH_SIZE inside a
+        single transaction.
+
+        The previous import's fingerprints are kept in memory, tagged with
+        the proxies generation they were written at. Once anything else has
+        bumped it (another worker's import, health checks) they are re-read
+        from the table instead.
+        """
+        imported_at = time.time()
+        db_path = await get_db_path('proxies')
+        imported = 0
+        inserted = []
+        updated = []
+        async with write_connection('proxies') as db:
+            try:
+                await db.execute('BEGIN IMMEDIATE')
+                generation = await self._generation(db)
+                snapshot_generation, previous = self._snapshots.get(db_path, (None, None))
+                if snapshot_generation != generation:
+                    previous = await self._load_snapshot(db)
+                current = {}
+                inserts, geo_inserts, updates = [], [], []
+
+                async def flush():
+                    if inserts:
+                        await db.executemany(UPSERT_PROXY_SQL, inserts)
+                        await db.executemany(UPSERT_PROXY_GEO_SQL, geo_inserts)
+                        inserted.extend(row[0] for row in inserts)
+                    if updates:
+                        await db.executemany(UPDATE_VOLATILE_SQL, updates)
+                        updated.extend(row[-1] for row in updates)
+                    inserts.clear()
+                    geo_inserts.clear()
+                    updates.clear()
+
+                async for row, geo in aiter_rows(data, imported_at):
+                    proxy = row[0]
+                    values = volatile_values(row)
+                    current[proxy] = fingerprint(values)
+                    imported += 1
+                    old = previous.get(proxy)
+                    if old is None:
+                        inserts.append(row)
+                        geo_inserts.append(geo)
+                    elif old != current[proxy]:
+                        updates.append(values + (imported_at, proxy))
+                    if len(inserts) + len(updates) >= IMPORT_BATCH_SIZE:
+                        await flush()
+                await flush()
+
+                # An empty or failed fetch must not take the whole pool down.
+                removed = [proxy for proxy in previous if proxy not in current] if imported else []
+                for i in range(0, len(removed), IMPORT_BATCH_SIZE):
+                    await db.executemany(MARK_DEAD_SQL, [(proxy,) for proxy in removed[i:i + IMPORT_BATCH_SIZE]])
+                if inserted or updated or removed:
+                    await refresh_facets(db)
+                    await db.execute(BUMP_GENERATION_SQL, (PROXIES_GENERATION,))
+                    generation += 1
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        if imported:
+            self._snapshots[db_path] = (generation, current)
+        return import_result(imported, inserted, updated, removed)
+
+    async def get_active_proxy(self):
+        async with read_connection('proxies') as db:
+            async with db.execute('SELECT proxy FROM proxies WHERE status = "active" LIMIT 1') as cursor:
+                result = await cursor.fetchone()
+                return result[0] if result else None
+
+    async def get_alive_proxies(self):
+        async with read_connection('proxies') as db:
+            async with db.execute('SELECT proxy FROM proxies WHERE alive = 1') as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def get_alive_index_entries(self):
+        async with read_connection('proxies') as db:
+            async with db.execute(ALIVE_INDEX_ENTRIES_SQL) as cursor:
+                rows = await cursor.fetchall()
+        return list(map(alive_index_entry, rows))
+
+    async def random_alive_proxy(self, exclude, filters):
+        filter_sql = ''.join(f' AND {attribute} = ?' for attribute in filters)
+        filter_values = tuple(filters.values())
+        async with read_connection('proxies') as db:
+            placeholder = ','.join('?' for _ in exclude)
+            async with db.execute(f'''
+            SELECT proxy
+            FROM proxies
+            WHERE alive = 1 AND proxy NOT IN ({placeholder}){filter_sql}
+            ORDER BY RANDOM()
+            LIMIT 1
+            ''', tuple(exclude) + filter_values) as cursor:
+                result = await cursor.fetchone()
+                if result:
+                    return result[0]
+                else:
+                    async with db.execute(f'SELECT proxy FROM proxies WHERE alive = 1{filter_sql} ORDER BY RANDOM() LIMIT 1', filter_values) as cursor:
+                        result = await cursor.fetchone()
+                        return result[0] if result else None
+
+    async def get_proxy_info(self, proxy):
+        async with read_connection('proxies') as proxies_db:
+            async with proxies_db.execute(f'SELECT {PROXY_INFO_COLUMNS} FROM proxies p WHERE p.proxy = ?', (proxy,)) as cursor:
+                row = await cursor.fetchone()
+                return proxy_info(row) if row else None
+
+    async def browse_proxies(self, filters, after=None, before=None, limit=BROWSE_PAGE_SIZE):
+        sql, params = browse_query(filters, after, before, limit)
+        async with read_connection('proxies') as db:
+            async with db.execute(sql, params) as cursor:
+                rows = [browse_row(row) for row in await cursor.fetchall()]
+        return rows[::-1] if before is not None else rows
+
+    async def get_facet_counts(self, facet, filters):
+        where = ' AND '.join(f'{name} = ?' for name in filters) or '1'
+        async with read_connection('proxies') as db:
+            async with db.execute(
+                f'SELECT {facet}, SUM(proxies) FROM proxy_facets WHERE {where} GROUP BY {facet} ORDER BY 2 DESC, 1',
+                tuple(filters.values())
+            ) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+
+    async def get_listed_proxies(self):
+        async with read_connection('proxies') as db:
+            async with db.execute("SELECT proxy FROM proxies WHERE status != 'dead'") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def record_checks(self, results):
+        async with write_connection('proxies') as db:
+            cursor = await db.executemany(FLIP_CHECKED_PROXY_SQL, [(int(alive), proxy, int(alive)) for alive, _, _, proxy in results])
+            changed = cursor.rowcount
+            await db.executemany(UPDATE_CHECKED_PROXY_SQL, results)
+            await db.commit()
+        return changed
+
+    async def finish_checks(self):
+        async with write_connection('proxies') as db:
+            await refresh_facets(db)
+            await db.execute(BUMP_GENERATION_SQL, (PROXIES_GENERATION,))
+            await db.commit()
 
+    async def prune_dead_proxies(self, cutoff, limit):
+        async with write_connection('proxies') as db:
+            async with db.execute(PRUNABLE_PROXIES_SQL, (cutoff, limit)) as cursor:
+                ids = [(row[0],) for row in await cursor.fetchall()]
+            await db.executemany('DELETE FROM proxy_geo WHERE proxy_id = ?', ids)
+            await db.executemany('DELETE FROM proxies WHERE id = ?', ids)
+            await db.commit()
+        return len(ids)
 
+    async def vacuum_step(self, pages):
+        async with write_connection('proxies') as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                if (await cursor.fetchone())[0] != 2:  # INCREMENTAL
+                    return None
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free = (await cursor.fetchone())[0]
+            if free:
+                # Each step of the pragma frees one page; executescript runs it to completion.
+                await db.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        return max(free - pages, 0)
+
+    async def optimize(self):
+        async with write_connection('proxies') as db:
+            # Bounded sampling keeps ANALYZE to milliseconds on large tables.
+            await db.execute('PRAGMA analysis_limit = 400')
+            await db.execute('ANALYZE')
+            await db.execute('PRAGMA optimize')
+            await db.commit()
+
+    async def vacuum(self):
+        """Rebuild the file and switch an older database to incremental auto_vacuum."""
+        async with write_connection('proxies') as db:
+            await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            await db.execute('VACUUM')
+
+    async def storage_stats(self):
+        path = await get_db_path('proxies')
+        async with read_connection('proxies') as db:
+            stats = {}
+            for name in ('page_size', 'page_count', 'freelist_count'):
+                async with db.execute(f'PRAGMA {name}') as cursor:
+                    stats[name] = (await cursor.fetchone())[0]
+        return {
+            'file_bytes': os.path.getsize(path),
+            'wal_bytes': os.path.getsize(f'{path}-wal') if os.path.exists(f'{path}-wal') else 0,
+            'page_size': stats['page_size'],
+            'pages': stats['page_count'],
+            'free_pages': stats['freelist_count'],
+        }
+
+    async def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        async with write_connection('proxies') as db:
+            await db.execute('''
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            ''', (name, holder, now + ttl, now))
+            async with db.execute('SELECT holder FROM leases WHERE name = ?', (name,)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+        return row is not None and row[0] == holder
+
+    async def release_lease(self, name, holder):
+        async with write_connection('proxies') as db:
+            await db.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+            await db.commit()
+
+    async def bump_generation(self, name):
+        async with write_connection('proxies') as db:
+            await db.execute(BUMP_GENERATION_SQL, (name,))
+            async with db.execute('SELECT value FROM generations WHERE name = ?', (name,)) as cursor:
+                value = (await cursor.fetchone())[0]
+            await db.commit()
+        return value
+
+    async def get_generation(self, name):
+        async with read_connection('proxies') as db:
+            async with db.execute('SELECT value FROM generations WHERE name = ?', (name,)) as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    async def get_assigned_proxies_and_language_code(self, user_id):
+        async with read_connection('proxies') as db:
+            async with db.execute(f'''
+            SELECT u.language_code, {PROXY_INFO_COLUMNS}
+            FROM users u
+            LEFT JOIN user_proxies up ON up.user_id = u.user_id AND up.expires_at > ?
+            LEFT JOIN proxies p ON p.id = up.proxy_id
+            WHERE u.user_id = ?
+            ORDER BY up.assigned_at
+            ''', (time.time(), user_id)) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return [], None
+        language_code = rows[0][0]
+        assigned_proxies = [proxy_info(row[1:]) for row in rows if row[1] is not None]
+        return assigned_proxies, language_code
+
+    async def assign_proxy(self, user_id, new_proxy, language_code, expires_at):
+        async with write_connection('proxies') as db:
+            await db.execute('''
+            INSERT INTO users (user_id, language_code) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET language_code = excluded.language_code
+            ''', (user_id, language_code))
+            acquired, released = False, []
+            if new_proxy:
+                cursor = await db.execute('''
+                INSERT OR IGNORE INTO user_proxies (user_id, proxy_id, assigned_at, expires_at)
+                SELECT ?, id, ?, ? FROM proxies WHERE proxy = ?
+                ''', (user_id, time.time(), expires_at, new_proxy))
+                acquired = cursor.rowcount == 1
+                if acquired:
+                    async with db.execute('''
+                    SELECT up.proxy_id, p.proxy FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id
+                    WHERE up.user_id = ? ORDER BY up.assigned_at DESC LIMIT -1 OFFSET ?
+                    ''', (user_id, MAX_ASSIGNED_PROXIES)) as cursor:
+                        dropped = await cursor.fetchall()
+                    await db.executemany('DELETE FROM user_proxies WHERE user_id = ? AND proxy_id = ?',
+                                         [(user_id, proxy_id) for proxy_id, _ in dropped])
+                    released = [proxy for _, proxy in dropped]
+                else:
+                    await db.execute('''
+                    UPDATE user_proxies SET expires_at = ?
+                    WHERE user_id = ? AND proxy_id = (SELECT id FROM proxies WHERE proxy = ?)
+                    ''', (expires_at, user_id, new_proxy))
+            await db.commit()
+        return acquired, released
+
+    async def expire_assignments(self, now, limit):
+        async with write_connection('proxies') as db:
+            async with db.execute('''
+            SELECT up.user_id, up.proxy_id, p.proxy FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id
+            WHERE up.expires_at <= ? ORDER BY up.expires_at LIMIT ?
+            ''', (now, limit)) as cursor:
+                expired = await cursor.fetchall()
+            await db.executemany('DELETE FROM user_proxies WHERE user_id = ? AND proxy_id = ?',
+                                 [(user_id, proxy_id) for user_id, proxy_id, _ in expired])
+            await db.commit()
+        return [(user_id, proxy) for user_id, _, proxy in expired]
+
+    async def get_holder_counts(self):
+        async with read_connection('proxies') as db:
+            # Before create_users_table has run nobody holds anything.
+            async with db.execute(USER_PROXIES_EXISTS_SQL) as cursor:
+                if not await cursor.fetchone():
+                    return {}
+            async with db.execute(HOLDER_COUNTS_SQL) as cursor:
+                return dict(await cursor.fetchall())
+
+    async def get_users_holding(self, proxies, now):
+        proxies = list(proxies)
+        # idx_proxies_proxy finds the proxies, idx_user_proxies_proxy their holders.
+        async with read_connection('proxies') as db:
+            async with db.execute(f'''
+            SELECT up.user_id, p.proxy FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id
+            WHERE up.expires_at > ? AND up.user_id IN (
+                SELECT h.user_id FROM proxies d JOIN user_proxies h ON h.proxy_id = d.id
+                WHERE d.proxy IN ({', '.join('?' * len(proxies))}) AND h.expires_at > ?
+            )
+            ORDER BY up.user_id, up.assigned_at
+            ''', (now, *proxies, now)) as cursor:
+                rows = await cursor.fetchall()
+        holders = {}
+        for user_id, proxy in rows:
+            holders.setdefault(user_id, []).append(proxy)
+        return holders
+
+
+# The backend the functions below talk to; see use_store().
+store = SQLiteStore()
+
+def create_store(backend='sqlite', postgres_dsn=None, snapshot_path=None):
+    """Build the store for one of STORAGE_BACKENDS."""
+    if backend == 'sqlite':
+        return SQLiteStore()
+    if backend == 'memory':
+        return MemoryStore(snapshot_path)
+    if backend == 'postgres':
+        if not postgres_dsn:
+            raise ValueError("The postgres backend needs a DSN (POSTGRES_DSN in config.py).")
+        return PostgresStore(postgres_dsn)
+    raise ValueError(f"Unknown storage backend {backend!r}; expected one of {', '.join(STORAGE_BACKENDS)}.")
+
+def use_store(new_store):
+    """Switch every query below to ``new_store`` (a storage.ProxyStore); returns the previous one."""
+    global store
+    previous, store = store, new_store
+    return previous
+
+async def open_store():
+    await store.open()
+
+async def close_store():
+    await store.close()
+
+async def init_db():
+    """Initialize the database and create the 'proxies' table if it doesn't exist."""
+    await store.init_proxies()
+
+async def create_users_table():
+    """Create the 'users' and 'user_proxies' tables in the proxies database.
+
+    Users from the legacy users.db (comma-separated assigned_proxies) are
+    copied over on first run.
+    """
+    await store.init_users()
+
+async def acquire_lease(name, holder, ttl):
+    """Take or renew the lease ``name`` for ``ttl`` seconds; return True if ``holder`` holds it."""
+    return await store.acquire_lease(name, holder, ttl)
+
+async def release_lease(name, holder):
+    """Give up the lease ``name`` if ``holder`` still holds it."""
+    await store.release_lease(name, holder)
+
+async def bump_generation(name):
+    """Announce that the data behind ``name`` changed; return the new generation."""
+    return await store.bump_generation(name)
+
+async def get_generation(name):
+    return await store.get_generation(name)
+
+async def forget_import_snapshot():
+    """Drop what this process remembers of its last import; the next one re-reads the table."""
+    await store.forget_import_snapshot()
+
+@timed(DB_QUERY_SECONDS, query='get_active_proxy')
 async def get_active_proxy():
     """Get an active proxy from the database."""
-    db_path = await get_db_path('proxies')
-    async with aiosqlite.connect(db_path) as db:
-        async with db.execute('SELECT proxy FROM proxies WHERE status = "active" LIMIT 1') as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else None
-
-async def replace_proxy(user_id, assigned_proxies):
-    """Replace a user's assigned proxy with a new one."""
-    db_path = await get_db_path('proxies')
-    async with aiosqlite.connect(db_path) as db:
-        placeholder = ','.join('?' for _ in assigned_proxies)
-        async with db.execute(f'''
-        SELECT proxy
-        FROM proxies
-        WHERE alive = 1 AND proxy NOT IN ({placeholder})
-        ORDER BY RANDOM()
-        LIMIT 1
-        ''', assigned_proxies) as cursor:
-            result = await cursor.fetchone()
-            if result:
-                return result[0]
-            else:
-                async with db.execute('SELECT proxy FROM proxies WHERE alive = 1 ORDER BY RANDOM() LIMIT 1') as cursor:
-                    result = await cursor.fetchone()
-                    return result[0] if result else None
+    return await store.get_active_proxy()
 
-async def create_users_table():
-    """Create the 'users' table if it doesn't exist."""
-    db_path = await get_db_path('users')
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            assigned_proxies TEXT,
-            language_code TEXT
-        )
-        ''')
-        await db.commit()
+@timed(DB_QUERY_SECONDS, query='get_alive_proxies')
+async def get_alive_proxies():
+    """Get every alive proxy from the database."""
+    return await store.get_alive_proxies()
 
-import os
-import aiosqlite
+@timed(DB_QUERY_SECONDS, query='get_alive_index_entries')
+async def get_alive_index_entries():
+    """Get (ProxyRecord, latency, quality) for every alive proxy."""
+    return await store.get_alive_index_entries()
 
-# ... (остальной код файла db_utils.py)
+@timed(DB_QUERY_SECONDS, query='get_holder_counts')
+async def get_holder_counts():
+    """Get how many users hold each proxy."""
+    return await store.get_holder_counts()
 
+@timed(DB_QUERY_SECONDS, query='get_users_holding')
+async def get_users_holding(proxies):
+    """Users with an unexpired lease on any of ``proxies``, each with every proxy they lease (oldest first)."""
+    return await store.get_users_holding(proxies, time.time())
+
+async def rebuild_alive_index(snapshot=False):
+    """Reload the in-memory alive proxy index, and how many users hold each proxy, from the database.
+
+    With SQLite storage and offloading on (see offload.py) the index is built
+    in a worker process and only its snapshot bytes are mapped here, which
+    keeps handlers responsive while 100k rows are scored. With ``snapshot``
+    the result is also saved as the warm-start snapshot. IndexRefreshed is
+    published once the new index is in place.
+    """
+    if not (offload.enabled() and isinstance(store, SQLiteStore)):
+        alive_index.replace(await get_alive_index_entries(), await get_holder_counts())
+        if snapshot:
+            await save_alive_snapshot()
+    else:
+        payload = await offload.run(build_alive_snapshot, await get_db_path('proxies'))
+        alive_index.load_snapshot_buffer(payload)
+        # Leases taken or dropped while the worker was busy.
+        alive_index.set_holders(await get_holder_counts())
+        if snapshot:
+            await asyncio.to_thread(_write_file, await get_alive_snapshot_path(), payload)
+    await bus.publish(IndexRefreshed())
+    return len(alive_index)
+
+async def get_alive_snapshot_path():
+    """The warm-start snapshot of the alive index lives next to proxies.db."""
+    return os.path.join(os.path.dirname(await get_db_path('proxies')), ALIVE_SNAPSHOT_FILE)
+
+def _write_file(path, payload):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(temp_path, path)
+
+async def save_alive_snapshot():
+    """Write the alive index to its warm-start snapshot, tagged with the current proxies generation.
+
+    The bytes are built on the event loop, so they match one state of the
+    index, and written in a thread, replacing the previous snapshot atomically.
+    """
+    payload = alive_index.to_snapshot(await get_generation(PROXIES_GENERATION))
+    await asyncio.to_thread(_write_file, await get_alive_snapshot_path(), payload)
+    return len(payload)
+
+async def warm_start_alive_index():
+    """Fill the alive index at startup, from the warm-start snapshot when there is a usable one.
+
+    Without one the index is rebuilt from the database before returning.
+    With a snapshot older than the data, assignments are served from it
+    right away and the returned task rebuilds the index in the background;
+    otherwise None is returned.
+    """
+    path = await get_alive_snapshot_path()
+    try:
+        generation = alive_index.load_snapshot(path)
+    except FileNotFoundError:
+        generation = None
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Ignoring alive index snapshot {path}: {e}")
+        generation = None
+    if generation is None:
+        await rebuild_alive_index()
+        return None
+    logging.info(f"Alive index loaded from snapshot with {len(alive_index)} proxies.")
+    # Leases change without bumping the generation, so holder counts are always re-read.
+    alive_index.set_holders(await get_holder_counts())
+    if generation == await get_generation(PROXIES_GENERATION):
+        return None
+    return asyncio.create_task(rebuild_alive_index())
+
+@timed(DB_QUERY_SECONDS, query='replace_proxy')
+async def replace_proxy(user_id, assigned_proxies, filters=None):
+    """Replace a user's assigned proxy with a new one.
+
+    Picks from the in-memory alive index, favouring fast and reliable
+    proxies; the database is only queried before the index has been loaded.
+    ``filters`` may restrict the pick by protocol, country_code or anonymity.
+    """
+    filters = normalize_filters(filters)
+    if alive_index.loaded:
+        return alive_index.sample(assigned_proxies, **filters)
+    return await store.random_alive_proxy(assigned_proxies, filters)
+
+async def pick_replacements(holdings):
+    """A proxy to offer each user in ``holdings`` (user_id -> proxies they lease), or None when there is none.
+
+    Picks are only offers: holder counts change once a user takes one.
+    """
+    if not alive_index.loaded:
+        return {user_id: await replace_proxy(user_id, held) for user_id, held in holdings.items()}
+    return {user_id: alive_index.sample(held) for user_id, held in holdings.items()}
+
+async def is_proxy_alive(proxy):
+    """Whether ``proxy`` is in the alive index; always true before the index has been loaded."""
+    return not alive_index.loaded or proxy in alive_index
+
+@timed(DB_QUERY_SECONDS, query='get_proxy_info')
 async def get_proxy_info(proxy):
-    async with aiosqlite.connect(await get_db_path('proxies')) as proxies_db:
-        async with proxies_db.execute('SELECT proxy, protocol, ip, port, country_code, country, anonymity, ssl, timeout, last_seen FROM proxies WHERE proxy = ?', (proxy,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                proxy, protocol, ip, port, country_code, country, anonymity, ssl, timeout, last_seen = row
-                return {
-                    'proxy': proxy,
-                    'protocol': protocol,
-                    'ip': ip,
-                    'port': port,
-                    'country_code': country_code,
-                    'country': country,
-                    'anonymity': anonymity,
-                    'https': 'Yes' if ssl else 'No',
-                    'latency': timeout,
-                    'last_checked': last_seen
-                }
-            else:
-                return None
+    """Get the ProxyRecord of a proxy, from the alive index when it is there."""
+    record = alive_index.record(proxy)
+    if record is not None:
+        return record
+    return await store.get_proxy_info(proxy)
+
+@timed(DB_QUERY_SECONDS, query='browse_proxies')
+async def browse_proxies(filters=None, after=None, before=None, limit=BROWSE_PAGE_SIZE):
+    """One page of alive proxies matching ``filters``, using keyset pagination.
+
+    ``after`` and ``before`` are the 'last' and 'first' keys of a previous
+    page. Returns a dict with the page's ProxyRecords under 'proxies', its
+    'first' and 'last' keys, and whether there are 'previous' and 'next'
+    pages. Each page is an index range scan, however deep it is.
+    """
+    filters = normalize_filters(filters)
+    rows = await store.browse_proxies(filters, after, before, limit + 1)
+    if before is not None:
+        has_previous, has_next = len(rows) > limit, True
+        rows = rows[-limit:]
+    else:
+        has_previous, has_next = after is not None, len(rows) > limit
+        rows = rows[:limit]
+    return {
+        'proxies': [record for _, record in rows],
+        'first': rows[0][0] if rows else None,
+        'last': rows[-1][0] if rows else None,
+        'previous': has_previous and bool(rows),
+        'next': has_next and bool(rows),
+    }
+
+@timed(DB_QUERY_SECONDS, query='get_facet_counts')
+async def get_facet_counts(facet, filters=None):
+    """(value, alive proxies) of ``facet`` among proxies matching ``filters``, most common first.
 
+    Read from the counts refreshed on every import and health check, so
+    building a menu never touches the proxies table.
+    """
+    if facet not in FILTER_ATTRIBUTES:
+        raise ValueError(f'Unknown proxy facet: {facet}')
+    return await store.get_facet_counts(facet, normalize_filters(filters))
+
+@timed(DB_QUERY_SECONDS, query='get_listed_proxies')
+async def get_listed_proxies():
+    """Get the proxies upstream still lists, i.e. the ones worth probing."""
+    return await store.get_listed_proxies()
+
+@timed(DB_QUERY_SECONDS, query='record_checks')
+async def record_checks(results):
+    """Store health check results: (alive, latency, checked_at, proxy) tuples.
+
+    Returns how many proxies went alive or dead; once a run is written,
+    finish_checks is due if any did.
+    """
+    return await store.record_checks(results)
+
+@timed(DB_QUERY_SECONDS, query='finish_checks')
+async def finish_checks():
+    """Recount the facets and bump the proxies generation, so other workers rebuild their alive index."""
+    await store.finish_checks()
+
+@timed(DB_QUERY_SECONDS, query='prune_dead_proxies')
+async def prune_dead_proxies(cutoff, limit):
+    """Delete up to ``limit`` unlisted proxies dead since before ``cutoff`` that no user holds."""
+    return await store.prune_dead_proxies(cutoff, limit)
+
+@timed(DB_QUERY_SECONDS, query='vacuum_step')
+async def vacuum_step(pages):
+    """Free up to ``pages`` unused pages; return how many are left, or None without incremental vacuum."""
+    return await store.vacuum_step(pages)
+
+async def optimize_database():
+    """Refresh the query planner's statistics."""
+    await store.optimize()
+
+async def vacuum_database():
+    """Compact the whole database at once; only while the bot is stopped."""
+    await store.vacuum()
+
+async def get_storage_stats():
+    return await store.storage_stats()
+
+@timed(DB_QUERY_SECONDS, query='get_assigned_proxies_and_language_code')
 async def get_assigned_proxies_and_language_code(user_id):
-    """Get a user's assigned proxies and language code from the database."""
-    db_path = await get_db_path('users')
-    async with aiosqlite.connect(db_path) as db:
-        async with db.execute('SELECT assigned_proxies, language_code FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-            if result:
-                assigned_proxies_str = result[0]
-                language_code = result[1]
-                
-                if assigned_proxies_str:
-                    async def get_assigned_proxies():
-                        proxy_strs = assigned_proxies_str.split(',')
-                        for proxy_str in proxy_strs:
-                            proxy_info = await get_proxy_info(proxy_str)
-                            if proxy_info:
-                                yield proxy_info
-                    
-                    assigned_proxies = [proxy_info async for proxy_info in get_assigned_proxies()]
-                else:
-                    assigned_proxies = []
-                
-                return assigned_proxies, language_code
-            else:
-                return [], None
+    """Get a user's assigned proxies (oldest first) and language code from the database."""
+    return await store.get_assigned_proxies_and_language_code(user_id)
 
+@timed(DB_QUERY_SECONDS, query='assign_proxy')
 async def assign_proxy(user_id, new_proxy, language_code):
-    """Assign a new proxy to a user."""
-    db_path = await get_db_path('users')
-    async with aiosqlite.connect(db_path) as db:
-        async with db.execute('SELECT assigned_proxies FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            result = await cursor.fetchone()
-
-        if result:
-            assigned_proxies = result[0].split(',') if result[0] else []
-            if new_proxy and new_proxy not in assigned_proxies:
-                if len(assigned_proxies) >= 3:
-                    assigned_proxies = assigned_proxies[1:] + [new_proxy]
-                else:
-                    assigned_proxies.append(new_proxy)
-            assigned_proxies_str = ','.join(assigned_proxies)
-            await db.execute('UPDATE users SET assigned_proxies = ?, language_code = ? WHERE user_id = ?', (assigned_proxies_str, language_code, user_id))
+    """Lease a new proxy to a user for ASSIGNMENT_TTL seconds, keeping only the MAX_ASSIGNED_PROXIES newest.
+
+    The alive index counts the new holder and drops the users of leases given
+    up to make room, so later picks favour less used proxies.
+    """
+    expires_at = time.time() + getattr(config, 'ASSIGNMENT_TTL', ASSIGNMENT_TTL)
+    acquired, released = await store.assign_proxy(user_id, new_proxy, language_code, expires_at)
+    # Holder counts and the user's own card change right here, not via the
+    # event bus: a rebuild reading counts from the store while an event is
+    # queued would count the lease twice, and the next reply must show it.
+    if acquired:
+        alive_index.acquire(new_proxy)
+    for proxy in released:
+        alive_index.release(proxy)
+    card_cache.invalidate_user(user_id)
+    if new_proxy is not None:
+        await bus.publish_many([UserAssigned(user_id, new_proxy)] + [UserReleased(user_id, proxy) for proxy in released])
+
+@timed(DB_QUERY_SECONDS, query='expire_assignments')
+async def expire_assignments(limit):
+    """Drop up to ``limit`` expired leases; return how many were dropped."""
+    expired = await store.expire_assignments(time.time(), limit)
+    for user_id, proxy in expired:
+        alive_index.release(proxy)
+        card_cache.invalidate_user(user_id)
+    await bus.publish_many([UserReleased(user_id, proxy) for user_id, proxy in expired])
+    return len(expired)
+
+async def apply_proxy_events(events):
+    """Drop dead proxies from the alive index and apply new latencies.
+
+    Proxies that are added or revived join the index on the next rebuild,
+    which reads their attributes and statistics.
+    """
+    for event in events:
+        if isinstance(event, LatencyChanged):
+            alive_index.update_latency(event.proxy, event.latency)
         else:
-            assigned_proxies_str = new_proxy if new_proxy else ''
-            await db.execute('INSERT INTO users (user_id, assigned_proxies, language_code) VALUES (?, ?, ?)', (user_id, assigned_proxies_str, language_code))
+            alive_index.discard(event.proxy)
+
+async def invalidate_proxy_cards(events):
+    """Drop cached replies showing a proxy that changed."""
+    card_cache.invalidate_proxies({event.proxy for event in events})
 
-        await db.commit()
\ No newline at end of file
+bus.subscribe(apply_proxy_events, ProxyDied, LatencyChanged, name='alive_index')
+bus.subscribe(invalidate_proxy_cards, ProxyAdded, ProxyUpdated, ProxyDied, LatencyChanged, name='card_cache')
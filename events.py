@@ -0,0 +1,255 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+SUBSCRIBER_QUEUE_SIZE = 10_000  # undelivered events a subscriber holds before publishers wait
+DELIVERY_BATCH_SIZE = 1000  # most events handed to a subscriber at once; publishers yield as often
+
+PUBLISHED_EVENTS = Counter('events_published_total', 'Events published on the in-process bus, by event.', ['event'])
+COALESCED_EVENTS = Counter('events_coalesced_total', 'Undelivered events replaced by a newer one, by subscriber.', ['subscriber'])
+EVENT_QUEUE_DEPTH = Gauge('event_queue_depth', 'Events waiting for a subscriber, by subscriber.', ['subscriber'])
+
+
+class Event:
+    """Something that changed, published on an EventBus.
+
+    While undelivered, an event is replaced by a newer one with the same
+    ``key``, so a subscriber only sees the latest state of each proxy.
+    Events whose key is None are all delivered.
+    """
+
+    __slots__ = ()
+    name = 'event'
+    fields = ()
+
+    @property
+    def key(self):
+        return None
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.fields)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(repr(getattr(self, field)) for field in self.fields)})"
+
+
+class ProxyEvent(Event):
+    """The listing or liveness of a proxy changed."""
+
+    __slots__ = ('proxy',)
+    fields = ('proxy',)
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    @property
+    def key(self):
+        return ('proxy', self.proxy)
+
+class ProxyAdded(ProxyEvent):
+    """A proxy was listed for the first time, or again after being unlisted."""
+    __slots__ = ()
+    name = 'proxy_added'
+
+class ProxyUpdated(ProxyEvent):
+    """An import changed a listed proxy's liveness, latency or statistics."""
+    __slots__ = ()
+    name = 'proxy_updated'
+
+class ProxyDied(ProxyEvent):
+    """A proxy was unlisted, or failed a health check while in the alive index."""
+    __slots__ = ()
+    name = 'proxy_died'
+
+class LatencyChanged(Event):
+    """A health check reached a proxy, in ``latency`` ms."""
+
+    __slots__ = ('proxy', 'latency')
+    name = 'latency_changed'
+    fields = ('proxy', 'latency')
+
+    def __init__(self, proxy, latency):
+        self.proxy = proxy
+        self.latency = latency
+
+    @property
+    def key(self):
+        return ('latency', self.proxy)
+
+class IndexRefreshed(Event):
+    """The alive index was rebuilt from the store."""
+
+    __slots__ = ()
+    name = 'index_refreshed'
+
+    @property
+    def key(self):
+        return ('index',)
+
+class UserAssigned(Event):
+    """A user was leased ``proxy``, or had the lease extended."""
+
+    __slots__ = ('user_id', 'proxy')
+    name = 'user_assigned'
+    fields = ('user_id', 'proxy')
+
+    def __init__(self, user_id, proxy):
+        self.user_id = user_id
+        self.proxy = proxy
+
+class UserReleased(UserAssigned):
+    """A user's lease of ``proxy`` ended: replaced by a newer one, or expired."""
+    __slots__ = ()
+    name = 'user_released'
+
+
+class Subscription:
+    """One subscriber's queue of undelivered events and the task delivering them.
+
+    The queue and task belong to the event loop that first published to
+    it; events left over from a loop that has since finished are dropped.
+    """
+
+    def __init__(self, handler, event_types, max_pending=SUBSCRIBER_QUEUE_SIZE, batch_size=DELIVERY_BATCH_SIZE, name=None):
+        self.handler = handler
+        self.event_types = event_types
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.name = name or handler.__name__
+        self._pending = OrderedDict()  # key (or a sequence number) -> event, oldest first
+        self._sequence = itertools.count()
+        self._loop = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._pending.clear()
+            self._ready = asyncio.Event()
+            self._space = asyncio.Event()
+            self._space.set()
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._task = loop.create_task(self._deliver())
+
+    def offer(self, event):
+        """Queue ``event`` unless that needs a free slot and there is none; return whether it was queued."""
+        self._bind()
+        pending = self._pending
+        key = event.key
+        if key is not None and key in pending:
+            del pending[key]  # the newer state goes to the back
+            COALESCED_EVENTS.inc(subscriber=self.name)
+        elif len(pending) >= self.max_pending:
+            self._space.clear()
+            return False
+        elif key is None:
+            key = next(self._sequence)
+        pending[key] = event
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    async def put(self, event):
+        """Queue ``event``, waiting while the queue is full."""
+        while not self.offer(event):
+            await self._space.wait()
+
+    async def _deliver(self):
+        pending = self._pending
+        while True:
+            await self._ready.wait()
+            batch = [pending.popitem(last=False)[1] for _ in range(min(self.batch_size, len(pending)))]
+            if not pending:
+                self._ready.clear()
+            self._space.set()
+            EVENT_QUEUE_DEPTH.set(len(pending), subscriber=self.name)
+            try:
+                await self.handler(batch)
+            except Exception:
+                logging.exception(f"Event subscriber {self.name} failed on {len(batch)} events.")
+            if not pending:
+                self._idle.set()
+
+    async def drain(self):
+        """Wait until every queued event has been handled."""
+        if self._loop is asyncio.get_running_loop():
+            await self._idle.wait()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            if self._loop is asyncio.get_running_loop():
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+        self._loop = self._task = None
+        self._pending.clear()
+
+
+class EventBus:
+    """In-process publish/subscribe of Events, with a bounded, coalescing queue per subscriber.
+
+    Publishers wait only when a subscriber they publish to has
+    ``max_pending`` events queued, and give subscribers a turn every
+    ``batch_size`` events, so a 100k-row import never builds an unbounded
+    backlog or holds the event loop while publishing.
+    """
+
+    def __init__(self, max_pending=SUBSCRIBER_QUEUE_SIZE, batch_size=DELIVERY_BATCH_SIZE):
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.subscriptions = []
+
+    def subscribe(self, handler, *event_types, max_pending=None, batch_size=None, name=None):
+        """Have ``await handler(events)`` called with lists of the ``event_types`` (every Event by default) published."""
+        subscription = Subscription(handler, event_types or (Event,), max_pending or self.max_pending,
+                                    batch_size or self.batch_size, name)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+        await subscription.close()
+
+    async def publish(self, event):
+        await self.publish_many((event,))
+
+    async def publish_many(self, events):
+        counts = {}
+        for i, event in enumerate(events, start=1):
+            counts[event.name] = counts.get(event.name, 0) + 1
+            for subscription in self.subscriptions:
+                if isinstance(event, subscription.event_types) and not subscription.offer(event):
+                    await subscription.put(event)
+            if i % self.batch_size == 0:
+                await asyncio.sleep(0)
+        for name, count in counts.items():
+            PUBLISHED_EVENTS.inc(count, event=name)
+
+    async def drain(self):
+        """Wait until every subscriber has handled what was published, including events its handlers published."""
+        while True:
+            for subscription in self.subscriptions:
+                await subscription.drain()
+            if not any(len(subscription) for subscription in self.subscriptions):
+                return
+
+    async def close(self):
+        """Stop delivering; undelivered events are dropped."""
+        for subscription in self.subscriptions:
+            await subscription.close()
+
+
+# The bus of this process; subscribers register when their module is imported.
+bus = EventBus()
@@ -0,0 +1,373 @@
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import random
+import aiohttp
+import offload
+from storage import merge_packed_rows, pack_rows
+
+API_URL = 'https://api.proxyscrape.com/v3/free-proxy-list/get?request=displayproxies&proxy_format=protocolipport&format=json'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+FETCH_TIMEOUT = 60  # seconds, per attempt
+FETCH_RETRIES = 3  # attempts after the first one
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 30.0  # seconds
+CONNECTION_LIMIT = 10
+RETRY_STATUSES = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+
+class FetchError(Exception):
+    """A source could not be fetched, even after retries."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ProxyStreamParser:
+    """Incrementally decode the records of the "proxies" array in an API response.
+
+    Feed it text chunks as they arrive; each call returns the records that are
+    complete so far, so the full payload is never held as one string.
+    """
+
+    def __init__(self, key='proxies'):
+        self._marker = f'"{key}"'
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._in_array = False
+        self.done = False
+
+    def _find_array_start(self):
+        marker = self._buffer.find(self._marker)
+        if marker == -1:
+            # Keep a tail in case the marker is split across chunks.
+            self._buffer = self._buffer[-len(self._marker):]
+            return False
+        bracket = self._buffer.find('[', marker)
+        if bracket == -1:
+            self._buffer = self._buffer[marker:]
+            return False
+        self._buffer = self._buffer[bracket + 1:]
+        self._in_array = True
+        return True
+
+    def feed(self, chunk):
+        """Add a chunk of text and return the records completed by it."""
+        if self.done:
+            return []
+        self._buffer += chunk
+        if not self._in_array and not self._find_array_start():
+            return []
+
+        records = []
+        buffer = self._buffer
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                self.done = True
+                break
+            try:
+                record, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # incomplete record, wait for more data
+            records.append(record)
+            pos = end
+        self._buffer = buffer[pos:]
+        return records
+
+    def close(self):
+        """Signal the end of input; raise if the array was never closed."""
+        if not self.done:
+            raise ValueError('Truncated proxy list in API response')
+
+async def iter_proxy_records(chunks, key='proxies'):
+    """Turn an async iterator of byte chunks into the records of the ``key`` array."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parser = ProxyStreamParser(key)
+    async for chunk in chunks:
+        for record in parser.feed(decoder.decode(chunk)):
+            yield record
+    for record in parser.feed(decoder.decode(b'', final=True)):
+        yield record
+    parser.close()
+
+
+class ProxySource:
+    """An upstream proxy list. Subclasses turn the response body into proxy records."""
+
+    def __init__(self, url, name=None):
+        self.url = url
+        self.name = name or url
+
+    def parse(self, chunks):
+        """Return an async iterator of proxyscrape-shaped records read from byte chunks."""
+        raise NotImplementedError
+
+
+class ProxyscrapeSource(ProxySource):
+    """The proxyscrape v3 JSON list, the bot's original and richest source."""
+
+    def __init__(self, url=API_URL, name='proxyscrape'):
+        super().__init__(url, name)
+
+    async def parse(self, chunks):
+        async for record in iter_proxy_records(chunks):
+            yield record
+
+
+class JSONListSource(ProxySource):
+    """A JSON document holding a list of objects with ip, port and protocol(s) fields.
+
+    ``items_key`` names the array inside the document (e.g. 'data'); objects
+    listing several protocols produce one record per protocol.
+    """
+
+    def __init__(self, url, name=None, items_key='data', protocol='http'):
+        super().__init__(url, name)
+        self.items_key = items_key
+        self.protocol = protocol
+
+    async def parse(self, chunks):
+        async for item in iter_proxy_records(chunks, self.items_key):
+            ip = item.get('ip')
+            port = item.get('port')
+            if not ip or not port:
+                continue
+            protocols = item.get('protocols') or [item.get('protocol') or self.protocol]
+            for protocol in protocols:
+                yield {
+                    'proxy': f'{protocol}://{ip}:{port}',
+                    'alive': True,
+                    'ip': ip,
+                    'port': int(port),
+                    'protocol': protocol,
+                    'anonymity': item.get('anonymity') or item.get('anonymityLevel'),
+                    'ip_data': {'countryCode': item.get('country_code') or item.get('country')},
+                }
+
+
+class PlainTextSource(ProxySource):
+    """A plain-text list with one 'ip:port' or 'protocol://ip:port' per line."""
+
+    def __init__(self, url, name=None, protocol='http'):
+        super().__init__(url, name)
+        self.protocol = protocol
+
+    def _record(self, line):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return None
+        protocol, _, address = line.rpartition('://')
+        protocol = protocol.lower() or self.protocol
+        ip, _, port = address.rpartition(':')
+        if not ip or not port.isdigit():
+            return None
+        return {'proxy': f'{protocol}://{ip}:{port}', 'alive': True, 'ip': ip, 'port': int(port), 'protocol': protocol}
+
+    async def parse(self, chunks):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        tail = ''
+        async for chunk in chunks:
+            lines = (tail + decoder.decode(chunk)).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                record = self._record(line)
+                if record:
+                    yield record
+        record = self._record(tail + decoder.decode(b'', final=True))
+        if record:
+            yield record
+
+
+DEFAULT_SOURCES = (ProxyscrapeSource(),)
+
+
+def pack_source_rows(source, body):
+    """Parse a whole response ``body`` with ``source`` into storage.PackedRows.
+
+    Runs in the offload pool, where no event loop is running yet.
+    """
+    async def chunks():
+        yield body
+
+    async def records():
+        return [record async for record in source.parse(chunks())]
+
+    return pack_rows(asyncio.run(records()))
+
+
+class RecordDecoder:
+    """Turns responses into lists of records on the event loop; what Fetcher uses by default."""
+
+    async def decode(self, source, chunks):
+        return [record async for record in source.parse(chunks)]
+
+    async def merge(self, results):
+        # Earlier sources win when the same proxy is listed more than once.
+        merged = {}
+        for records in results:
+            for record in records:
+                merged.setdefault(record.get('proxy'), record)
+        merged.pop(None, None)
+        return list(merged.values())
+
+
+class RowDecoder:
+    """Parses responses and maps them to storage rows in the offload pool (see offload.py).
+
+    The body is read in full, then decoded by a worker process that sends
+    back storage.PackedRows, so fetch() returns PackedRows instead of a
+    list and JSON decoding never holds the event loop.
+    """
+
+    async def decode(self, source, chunks):
+        body = b''.join([chunk async for chunk in chunks])
+        return await offload.run(pack_source_rows, source, body)
+
+    async def merge(self, results):
+        if len(results) == 1:
+            return results[0]
+        return await offload.run(merge_packed_rows, results)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Exponential backoff with jitter: a random delay in [d/2, d], d = base * 2**attempt."""
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class Fetcher:
+    """Fetches and merges proxy lists from several sources over one pooled session.
+
+    Each source is fetched concurrently with retries and backoff, and sends
+    If-None-Match / If-Modified-Since from its previous response. A 304 or a
+    body with the same hash as last time counts as unchanged, and is not
+    decoded. fetch() returns None when no source changed, so the caller can
+    skip the import. Responses only count as seen once the caller has
+    imported them and called commit(); until then the same content is
+    fetched and returned again.
+    ``decoder`` (RecordDecoder by default) turns bodies into what fetch()
+    returns.
+    """
+
+    def __init__(self, sources=DEFAULT_SOURCES, retries=FETCH_RETRIES, backoff_base=BACKOFF_BASE,
+                 timeout=FETCH_TIMEOUT, decoder=None):
+        self.sources = list(sources)
+        self.decoder = decoder or RecordDecoder()
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self._session = None
+        # Per source: validators of the last committed response, the (hash,
+        # ETag, Last-Modified) of one fetched but not committed yet, and the
+        # records of the last good response.
+        self._etags = {}
+        self._last_modified = {}
+        self._hashes = {}
+        self._pending = {}
+        self._records = {}
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _fetch_once(self, session, source):
+        """Return the source's records, or None if unchanged since the last commit()."""
+        headers = {}
+        # Uncommitted records stand in for the source until they are imported,
+        # so a 304 or a hash match against older validators would not do.
+        pending = source.name in self._pending
+        if source.name in self._etags and not pending:
+            headers['If-None-Match'] = self._etags[source.name]
+        if source.name in self._last_modified and not pending:
+            headers['If-Modified-Since'] = self._last_modified[source.name]
+        async with session.get(source.url, headers=headers) as response:
+            if response.status == 304:
+                return None
+            if response.status != 200:
+                raise FetchError(f'{source.name} returned HTTP {response.status}', response.status)
+            body = await response.read()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+        content_hash = hashlib.sha256(body).hexdigest()
+        if self._hashes.get(source.name) == content_hash and not pending:
+            return None
+
+        async def chunks():
+            for start in range(0, len(body), STREAM_CHUNK_SIZE):
+                yield body[start:start + STREAM_CHUNK_SIZE]
+
+        records = await self.decoder.decode(source, chunks())
+        self._pending[source.name] = (content_hash, etag, last_modified)
+        self._records[source.name] = records
+        return records
+
+    def commit(self):
+        """Mark the responses fetch() returned so far as imported.
+
+        From then on a 304, or a body with the same hash, counts as unchanged.
+        """
+        for name, (content_hash, etag, last_modified) in self._pending.items():
+            self._hashes[name] = content_hash
+            if etag:
+                self._etags[name] = etag
+            if last_modified:
+                self._last_modified[name] = last_modified
+        self._pending.clear()
+
+    async def _fetch_source(self, session, source):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._fetch_once(session, source)
+            except FetchError as e:
+                error = e
+                if e.status not in RETRY_STATUSES:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            if attempt < self.retries:
+                delay = backoff_delay(attempt, self.backoff_base)
+                logging.warning(f"Fetching {source.name} failed ({error!r}), retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+        raise FetchError(f'{source.name}: {error}')
+
+    async def fetch(self):
+        """Fetch every source; return the merged records, or None if nothing changed.
+
+        A source that fails keeps contributing the records of its last good
+        fetch, so its proxies are not retired because of a transient error.
+        When every source fails, None is returned as well.
+        """
+        session = await self._get_session()
+        results = await asyncio.gather(
+            *(self._fetch_source(session, source) for source in self.sources), return_exceptions=True
+        )
+        changed = False
+        for source, result in zip(self.sources, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to fetch proxies from {source.name}: {result}")
+            elif result is not None:
+                changed = True
+                logging.info(f"Fetched {len(result)} proxies from {source.name}.")
+        if not changed:
+            return None
+
+        return await self.decoder.merge([self._records[source.name] for source in self.sources
+                                         if source.name in self._records])
@@ -1,42 +1,125 @@
 import asyncio
-import aiosqlite
-import datetime
+from functools import partial
 from telebot.async_telebot import AsyncTeleBot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from db_utils import (
     get_assigned_proxies_and_language_code,
     assign_proxy,
     replace_proxy,
-    get_db_path,
-    get_proxy_info  
+    get_proxy_info,
+    browse_proxies,
+    get_facet_counts,
+    is_proxy_alive
 )
-from import_proxies import fetch_proxies, import_proxies
+from render import card_cache, format_check_proxy, format_proxy_card
+from metrics import HANDLER_SECONDS, timed
+from throttle import CallbackThrottle
+from proxy_index import FILTER_ATTRIBUTES
 
 
-def register_handlers(bot: AsyncTeleBot):
+PROTOCOLS = ('http', 'https', 'socks4', 'socks5')
+ANONYMITY_LEVELS = ('transparent', 'anonymous', 'elite')
+RATE_LIMITED_TEXT = '⏳ Too many requests, please wait a moment.'
+NO_PROXIES_TEXT = '😢 Unfortunately, there are no available proxies at the moment. Please try again later.'
+PROXY_GONE_TEXT = '⌛ That proxy is no longer available, so here is another one.'
+
+# Callback data of the browse flow (Telegram allows 64 bytes):
+#   browse|<protocol>|<country_code>|<anonymity>  a facet menu, or the first page once all three are chosen;
+#                                                 '' is not chosen yet, ANY matches everything
+#   page|<protocol>|<country_code>|<anonymity>|<'>' or '<'>|<browse key>  the page after or before a key
+#   take|<proxy>                                  assign a browsed proxy
+#   switch|<proxy>                                assign the replacement offered for a dead proxy (see notifier.py)
+BROWSE_PREFIX = 'browse|'
+PAGE_PREFIX = 'page|'
+TAKE_PREFIX = 'take|'
+SWITCH_PREFIX = 'switch|'
+ANY = '*'
+BROWSE_MENU_OPTIONS = 12  # most common values offered per facet
+FACET_LABELS = {'protocol': 'protocol', 'country_code': 'country', 'anonymity': 'anonymity level'}
+
+
+def parse_proxy_filters(args):
+    """Turn words like ['socks5', 'DE', 'elite'] into replace_proxy filters."""
+    filters = {}
+    for arg in args:
+        value = arg.lower()
+        if value in PROTOCOLS:
+            filters['protocol'] = value
+        elif value in ANONYMITY_LEVELS:
+            filters['anonymity'] = value
+        elif len(value) == 2 and value.isalpha():
+            filters['country_code'] = value.upper()
+        else:
+            raise ValueError(f'Unknown filter "{arg}". Use a protocol ({", ".join(PROTOCOLS)}), '
+                             f'a two-letter country code or an anonymity level ({", ".join(ANONYMITY_LEVELS)}).')
+    return filters
+
+
+def browse_callback(choices):
+    return BROWSE_PREFIX + '|'.join(choices)
+
+
+def page_callback(choices, direction, key):
+    return PAGE_PREFIX + '|'.join((*choices, direction, *key[:3], str(key[3])))
+
+
+def parse_browse_callback(data):
+    """The three facet choices in browse callback data."""
+    choices = data[len(BROWSE_PREFIX):].split('|')
+    if len(choices) != len(FILTER_ATTRIBUTES):
+        raise ValueError(f'Malformed browse callback: {data}')
+    return choices
+
+
+def parse_page_callback(data):
+    """(choices, direction, browse key) in page callback data."""
+    parts = data[len(PAGE_PREFIX):].split('|')
+    if len(parts) != 8 or parts[3] not in '<>':
+        raise ValueError(f'Malformed page callback: {data}')
+    return parts[:3], parts[3], (*parts[4:7], int(parts[7]))
+
+
+def choice_filters(choices):
+    """browse_proxies filters for the chosen facets."""
+    return {name: value for name, value in zip(FILTER_ATTRIBUTES, choices) if value and value != ANY}
+
+
+def register_handlers(bot: AsyncTeleBot, sender=None):
+    """Register the bot's handlers.
+
+    Replies go through ``sender`` (a sender.MessageSender) when given, so a
+    handler returns as soon as its messages are queued; otherwise they are
+    sent directly with ``bot.send_message``.
+    """
+    send_message = sender.send_message if sender is not None else bot.send_message
+
     # Create inline keyboard with buttons
     inline_keyboard = InlineKeyboardMarkup()
     inline_keyboard.row(InlineKeyboardButton('🔍 Check Proxy', callback_data='/check_proxy'),
                         InlineKeyboardButton('🆕 Get Proxy', callback_data='/get_proxy'))
-    inline_keyboard.row(InlineKeyboardButton('❓ Help', callback_data='/help'))
+    inline_keyboard.row(InlineKeyboardButton('🧭 Browse Proxies', callback_data=browse_callback(('', '', ''))),
+                        InlineKeyboardButton('❓ Help', callback_data='/help'))
 
     # Create keyboard with "Main Menu" button
     main_menu_keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
     main_menu_keyboard.add(KeyboardButton('📜 Main Menu'))
 
+    throttle = CallbackThrottle()
+
     @bot.message_handler(commands=['start'])
+    @timed(HANDLER_SECONDS, handler='start')
     async def handle_start(message):
         """Handle the /start command."""
         user_id = message.chat.id
         language_code = message.from_user.language_code
-        await bot.send_message(
+        await send_message(
             message.chat.id,
             'Welcome to Proxy Bot! 🌐\n'
             'I will help you obtain and manage your proxy servers.\n'
             'Use the buttons below to interact with me, or press "📜 Main Menu" if you need to call the menu again.',
             reply_markup=main_menu_keyboard
         )
-        await bot.send_message(
+        await send_message(
             message.chat.id,
             'Select an option from the menu below:',
             reply_markup=inline_keyboard
@@ -44,84 +127,173 @@ def register_handlers(bot: AsyncTeleBot):
         await assign_proxy(user_id, None, language_code)
 
     @bot.message_handler(func=lambda message: message.text == '📜 Main Menu')
+    @timed(HANDLER_SECONDS, handler='main_menu')
     async def handle_main_menu(message):
         """Handle the "Main Menu" button press."""
-        await bot.send_message(
+        await send_message(
             message.chat.id,
             'Select an option from the menu below:',
             reply_markup=inline_keyboard
         )
 
     @bot.callback_query_handler(func=lambda call: True)
+    @timed(HANDLER_SECONDS, handler='callback_query')
     async def callback_query(call):
-        """Handle callback queries from inline keyboard buttons."""
+        """Handle callback queries from inline keyboard buttons.
+
+        Taps go through ``throttle``: a repeat of a tap still being handled
+        shares its run, and a chat tapping faster than its token bucket
+        allows gets a short notice instead of a reply.
+        """
         if call.data == '/check_proxy':
-            await handle_check_proxy(call.message)
+            handler = handle_check_proxy
         elif call.data == '/get_proxy':
-            await handle_get_proxy(call.message)
+            handler = handle_get_proxy
         elif call.data == '/help':
-            await handle_help(call.message)
+            handler = handle_help
+        elif call.data.startswith(BROWSE_PREFIX):
+            handler = partial(handle_browse, callback_data=call.data)
+        elif call.data.startswith(PAGE_PREFIX):
+            handler = partial(handle_browse_page, callback_data=call.data)
+        elif call.data.startswith(TAKE_PREFIX):
+            handler = partial(handle_take_proxy, proxy=call.data[len(TAKE_PREFIX):])
+        elif call.data.startswith(SWITCH_PREFIX):
+            handler = partial(handle_switch_proxy, proxy=call.data[len(SWITCH_PREFIX):])
+        else:
+            return
+        if not await throttle.run(call.message.chat.id, call.data, lambda: handler(call.message)):
+            await bot.answer_callback_query(call.id, RATE_LIMITED_TEXT)
 
+    @timed(HANDLER_SECONDS, handler='check_proxy')
     async def handle_check_proxy(message):
         """Handle the "Check Proxy" button press."""
         user_id = message.chat.id
-        assigned_proxies, _ = await get_assigned_proxies_and_language_code(user_id)
-        if assigned_proxies:
-            current_proxy = assigned_proxies[-1]  # Use the last (newest) proxy as the active one
-            proxy_info = 'Protocol: {}\nIP Address: {}\nPort: {}\nCountry Code: {}\nCountry: {}\nAnonymity: {}\nHTTPS: {}\nLatency: {}ms\nLast Checked: {}'.format(
-                current_proxy['protocol'],
-                current_proxy['ip'],
-                current_proxy['port'],
-                current_proxy['country_code'],
-                current_proxy['country'],
-                current_proxy['anonymity'],
-                current_proxy['https'],
-                int(current_proxy['latency']),
-                datetime.datetime.fromtimestamp(current_proxy['last_checked']).strftime('%Y-%m-%d %H:%M:%S') if current_proxy['last_checked'] else 'N/A'
-            )
-            previously_used_proxies = assigned_proxies[:-1]  # Exclude the current proxy
-            previously_used_proxies_info = '\n'.join([f"{proxy['protocol']} {proxy['ip']}:{proxy['port']}" for proxy in previously_used_proxies])
-            
-            await bot.send_message(message.chat.id, f'✅ Your current active proxy:\n\n{proxy_info}\n\nPreviously used proxies:\n{previously_used_proxies_info}', reply_markup=main_menu_keyboard)
-        else:
-            await bot.send_message(message.chat.id, '❌ You do not have any assigned proxies. Use Get proxy to get one.', reply_markup=main_menu_keyboard)
+        text = card_cache.get(user_id)
+        if text is None:
+            generation = card_cache.generation
+            assigned_proxies, _ = await get_assigned_proxies_and_language_code(user_id)
+            text = format_check_proxy(assigned_proxies)
+            card_cache.put(user_id, text, [proxy.proxy for proxy in assigned_proxies], generation)
+        await send_message(message.chat.id, text, reply_markup=main_menu_keyboard)
 
-            
+    @bot.message_handler(commands=['get_proxy'])
+    @timed(HANDLER_SECONDS, handler='get_proxy_command')
+    async def handle_get_proxy_command(message):
+        """Handle /get_proxy [protocol] [country code] [anonymity], e.g. /get_proxy socks5 DE elite."""
+        try:
+            filters = parse_proxy_filters(message.text.split()[1:])
+        except ValueError as e:
+            await send_message(message.chat.id, f'❌ {e}', reply_markup=main_menu_keyboard)
+            return
+        await handle_get_proxy(message, filters)
 
-    async def handle_get_proxy(message):
-        """Handle the "Get Proxy" button press."""
+    @timed(HANDLER_SECONDS, handler='get_proxy')
+    async def handle_get_proxy(message, filters=None):
+        """Handle the "Get Proxy" button press, optionally restricted by ``filters``."""
         user_id = message.chat.id
         language_code = message.from_user.language_code
         assigned_proxies, _ = await get_assigned_proxies_and_language_code(user_id)
 
-        new_proxy = await replace_proxy(user_id, [proxy['proxy'] for proxy in assigned_proxies])
+        new_proxy = await replace_proxy(user_id, [proxy.proxy for proxy in assigned_proxies], filters)
         if new_proxy:
             new_proxy_info = await get_proxy_info(new_proxy)
             if new_proxy_info:
                 await assign_proxy(user_id, new_proxy, language_code)
-                proxy_info_str = 'Protocol: {}\nIP Address: {}\nPort: {}\nCountry Code: {}\nCountry: {}\nAnonymity: {}\nHTTPS: {}\nLatency: {}ms\nLast Checked: {}'.format(
-                    new_proxy_info['protocol'],
-                    new_proxy_info['ip'],
-                    new_proxy_info['port'],
-                    new_proxy_info['country_code'],
-                    new_proxy_info['country'],
-                    new_proxy_info['anonymity'],
-                    new_proxy_info['https'],
-                    int(new_proxy_info['latency']),
-                    datetime.datetime.fromtimestamp(new_proxy_info['last_checked']).strftime('%Y-%m-%d %H:%M:%S') if new_proxy_info['last_checked'] else 'N/A'
-                )
-                await bot.send_message(message.chat.id, f'🎉 You have been assigned a new proxy:\n\n{proxy_info_str}', reply_markup=main_menu_keyboard)
+                proxy_info_str = format_proxy_card(new_proxy_info)
+                await send_message(message.chat.id, f'🎉 You have been assigned a new proxy:\n\n{proxy_info_str}', reply_markup=main_menu_keyboard)
             else:
-                await bot.send_message(message.chat.id, '😢 Unfortunately, there are no available proxies at the moment. Please try again later.', reply_markup=main_menu_keyboard)
+                await send_message(message.chat.id, NO_PROXIES_TEXT, reply_markup=main_menu_keyboard)
         else:
-            await bot.send_message(message.chat.id, '😢 Unfortunately, there are no available proxies at the moment. Please try again later.', reply_markup=main_menu_keyboard)
+            await send_message(message.chat.id, NO_PROXIES_TEXT, reply_markup=main_menu_keyboard)
+
+    @bot.message_handler(commands=['browse'])
+    @timed(HANDLER_SECONDS, handler='browse')
+    async def handle_browse(message, callback_data=browse_callback(('', '', ''))):
+        """Offer the next facet to filter by, with alive proxy counts, or show the first page."""
+        try:
+            choices = parse_browse_callback(callback_data)
+        except ValueError:
+            return
+        if '' not in choices:
+            await show_browse_page(message, choices)
+            return
+        stage = choices.index('')
+        facet = FILTER_ATTRIBUTES[stage]
+        counts = await get_facet_counts(facet, choice_filters(choices))
+        if not counts:
+            await send_message(message.chat.id, NO_PROXIES_TEXT, reply_markup=main_menu_keyboard)
+            return
+
+        def choose(value):
+            return browse_callback(choices[:stage] + [value] + choices[stage + 1:])
+
+        keyboard = InlineKeyboardMarkup(row_width=3)
+        keyboard.add(*(InlineKeyboardButton(f'{value} ({count})', callback_data=choose(value))
+                       for value, count in counts[:BROWSE_MENU_OPTIONS]))
+        keyboard.row(InlineKeyboardButton(f'✳️ Any ({sum(count for _, count in counts)})', callback_data=choose(ANY)))
+        await send_message(message.chat.id, f'Choose a {FACET_LABELS[facet]}:', reply_markup=keyboard)
+
+    @timed(HANDLER_SECONDS, handler='browse_page')
+    async def handle_browse_page(message, callback_data):
+        """Show the page before or after the one a Prev / Next button was on."""
+        try:
+            choices, direction, key = parse_page_callback(callback_data)
+        except ValueError:
+            return
+        await show_browse_page(message, choices, **{'after' if direction == '>' else 'before': key})
+
+    async def show_browse_page(message, choices, after=None, before=None):
+        page = await browse_proxies(choice_filters(choices), after=after, before=before)
+        if not page['proxies']:
+            await send_message(message.chat.id, NO_PROXIES_TEXT, reply_markup=main_menu_keyboard)
+            return
+        lines = [
+            f"{i}. {record.proxy} · {record.country_code} · {record.anonymity} · "
+            f"{int(record.latency) if record.latency is not None else 'N/A'}ms"
+            for i, record in enumerate(page['proxies'], start=1)
+        ]
+        keyboard = InlineKeyboardMarkup(row_width=4)
+        keyboard.add(*(InlineKeyboardButton(f'🆕 {i}', callback_data=TAKE_PREFIX + record.proxy)
+                       for i, record in enumerate(page['proxies'], start=1)))
+        navigation = []
+        if page['previous']:
+            navigation.append(InlineKeyboardButton('◀️ Prev', callback_data=page_callback(choices, '<', page['first'])))
+        navigation.append(InlineKeyboardButton('🔄 Filters', callback_data=browse_callback(('', '', ''))))
+        if page['next']:
+            navigation.append(InlineKeyboardButton('Next ▶️', callback_data=page_callback(choices, '>', page['last'])))
+        keyboard.row(*navigation)
+        await send_message(message.chat.id, 'Tap a number to take that proxy:\n\n' + '\n'.join(lines), reply_markup=keyboard)
+
+    @timed(HANDLER_SECONDS, handler='take_proxy')
+    async def handle_take_proxy(message, proxy):
+        """Assign a proxy picked from a browse page, or a fresh pick if it died since the page was sent.
+
+        ``proxy`` comes from callback data, which may be stale or hand-made,
+        so only proxies in the alive index are assigned.
+        """
+        if not await is_proxy_alive(proxy):
+            await send_message(message.chat.id, PROXY_GONE_TEXT)
+            await handle_get_proxy(message)
+            return
+        proxy_info = await get_proxy_info(proxy)
+        if proxy_info is None:
+            await send_message(message.chat.id, NO_PROXIES_TEXT, reply_markup=main_menu_keyboard)
+            return
+        await assign_proxy(message.chat.id, proxy, message.from_user.language_code)
+        await send_message(message.chat.id, f'🎉 You have been assigned a new proxy:\n\n{format_proxy_card(proxy_info)}', reply_markup=main_menu_keyboard)
 
+    @timed(HANDLER_SECONDS, handler='switch_proxy')
+    async def handle_switch_proxy(message, proxy):
+        """Assign the replacement offered by a dead proxy notice (see notifier.py)."""
+        await handle_take_proxy(message, proxy)
 
+    @timed(HANDLER_SECONDS, handler='help')
     async def handle_help(message):
         """Handle the "Help" button press."""
-        await bot.send_message(message.chat.id, 
+        await send_message(message.chat.id, 
                                '📚 Here is a list of available commands:\n'
                                '🔍 Check Proxy - Check your current proxy.\n'
                                '🆕 Get Proxy - Get a new random proxy.\n'
+                               '🧭 Browse Proxies - Pick a proxy by protocol, country and anonymity.\n'
                                '❓ Help - Show this help message.',
                                reply_markup=main_menu_keyboard)
\ No newline at end of file
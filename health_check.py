@@ -0,0 +1,192 @@
+import asyncio
+import ipaddress
+import logging
+import struct
+import time
+import db_utils
+from db_utils import init_db, open_store, close_store, get_listed_proxies, record_checks, finish_checks
+from events import bus, LatencyChanged, ProxyDied
+from startup import configure_logging
+
+# Every proxy is asked to open a tunnel to this host.
+PROBE_TARGET = ('www.google.com', 80)
+PROBE_TIMEOUT = 5.0  # seconds
+CHECK_CONCURRENCY = 200
+CHECK_WRITE_BATCH = 500
+CHECK_INTERVAL = 600  # 10 minutes
+
+
+class ProbeError(Exception):
+    """The proxy answered, but refused or garbled the handshake."""
+
+
+async def _handshake_http(reader, writer, host, port):
+    writer.write(f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    parts = status_line.split()
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or parts[1] != b'200':
+        raise ProbeError(f'HTTP CONNECT failed: {status_line[:64]!r}')
+
+async def _handshake_socks4(reader, writer, host, port):
+    # SOCKS4a: an invalid 0.0.0.x address tells the proxy to resolve the host itself.
+    try:
+        address = ipaddress.IPv4Address(host).packed
+        hostname = b''
+    except ValueError:
+        address = b'\x00\x00\x00\x01'
+        hostname = host.encode() + b'\x00'
+    writer.write(struct.pack('>BBH', 4, 1, port) + address + b'\x00' + hostname)
+    await writer.drain()
+    reply = await reader.readexactly(8)
+    if reply[1] != 0x5A:
+        raise ProbeError(f'SOCKS4 request rejected: {reply[1]:#x}')
+
+async def _handshake_socks5(reader, writer, host, port):
+    writer.write(b'\x05\x01\x00')  # version 5, one method: no authentication
+    await writer.drain()
+    version, method = await reader.readexactly(2)
+    if version != 5 or method != 0:
+        raise ProbeError('SOCKS5 proxy requires authentication')
+    encoded_host = host.encode()
+    writer.write(b'\x05\x01\x00\x03' + bytes([len(encoded_host)]) + encoded_host + struct.pack('>H', port))
+    await writer.drain()
+    version, reply, _, address_type = await reader.readexactly(4)
+    if version != 5 or reply != 0:
+        raise ProbeError(f'SOCKS5 request rejected: {reply:#x}')
+    # Drain the bound address so the connection is left in a clean state.
+    if address_type == 1:
+        await reader.readexactly(4 + 2)
+    elif address_type == 4:
+        await reader.readexactly(16 + 2)
+    elif address_type == 3:
+        length = (await reader.readexactly(1))[0]
+        await reader.readexactly(length + 2)
+
+HANDSHAKES = {
+    'http': _handshake_http,
+    'https': _handshake_http,
+    'socks4': _handshake_socks4,
+    'socks5': _handshake_socks5,
+}
+
+def parse_proxy(proxy):
+    """Split 'protocol://ip:port' into its parts."""
+    protocol, _, address = proxy.partition('://')
+    host, _, port = address.rpartition(':')
+    return protocol.lower(), host.strip('[]'), int(port)
+
+async def _open_tunnel(host, port, handshake, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await handshake(reader, writer, *target)
+    finally:
+        writer.close()
+
+async def probe_proxy(proxy, target=PROBE_TARGET, timeout=PROBE_TIMEOUT):
+    """Connect through a proxy and return (alive, latency in ms)."""
+    try:
+        protocol, host, port = parse_proxy(proxy)
+        handshake = HANDSHAKES[protocol]
+    except (KeyError, ValueError):
+        logging.warning(f"Cannot probe proxy {proxy!r}: unsupported format.")
+        return False, None
+
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(_open_tunnel(host, port, handshake, target), timeout)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ProbeError):
+        return False, None
+    return True, (time.perf_counter() - started) * 1000
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def _write_results(results):
+    changed = await record_checks(results)
+    # A proxy only dies if it was alive; revived ones join the index on its next rebuild.
+    alive_index = db_utils.alive_index
+    await bus.publish_many([LatencyChanged(proxy, latency) if alive else ProxyDied(proxy)
+                            for alive, latency, _, proxy in results if alive or proxy in alive_index])
+    return changed
+
+async def check_proxies(proxies, concurrency=CHECK_CONCURRENCY, target=PROBE_TARGET,
+                        timeout=PROBE_TIMEOUT, batch_size=CHECK_WRITE_BATCH):
+    """Probe proxies concurrently and write the results back in batches.
+
+    At most ``concurrency`` probes are in flight; results are flushed to the
+    database every ``batch_size`` probes. Facets and the proxies generation
+    are refreshed once at the end, and only if a proxy went alive or dead.
+    Returns a summary with throughput and latency percentiles.
+    """
+    proxies = iter(proxies)
+    pending = []
+    latencies = []
+    probed = 0
+    changed = 0
+    started = time.perf_counter()
+
+    async def worker():
+        nonlocal pending, probed, changed
+        for proxy in proxies:
+            alive, latency = await probe_proxy(proxy, target, timeout)
+            probed += 1
+            pending.append((alive, latency, time.time(), proxy))
+            if latency is not None:
+                latencies.append(latency)
+            if len(pending) >= batch_size:
+                batch, pending = pending, []
+                flipped = await _write_results(batch)
+                changed += flipped  # after the await: other workers add to changed meanwhile
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if pending:
+        changed += await _write_results(pending)
+    if changed:
+        await finish_checks()
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'probed': probed,
+        'alive': len(latencies),
+        'elapsed': elapsed,
+        'probes_per_sec': probed / elapsed if elapsed else 0.0,
+        'p50_ms': _percentile(latencies, 0.50),
+        'p99_ms': _percentile(latencies, 0.99),
+        'changed': changed,
+    }
+
+async def run_health_check():
+    """Probe every listed proxy once and log the summary."""
+    report = await check_proxies(await get_listed_proxies())
+    p50, p99 = (f'{value:.0f}ms' if value is not None else 'n/a' for value in (report['p50_ms'], report['p99_ms']))
+    logging.info(
+        f"Health check: {report['alive']}/{report['probed']} alive, "
+        f"{report['probes_per_sec']:.1f} probes/sec, p50 {p50}, p99 {p99}."
+    )
+    return report
+
+async def periodic_health_check():
+    """Periodically re-check the liveness and latency of listed proxies."""
+    while True:
+        await asyncio.sleep(CHECK_INTERVAL)
+        try:
+            await run_health_check()
+        except Exception:
+            logging.exception("Health check cycle failed.")
+
+async def main():
+    """Run a single health check over the current proxy list."""
+    await open_store()
+    try:
+        await init_db()
+        await run_health_check()
+    finally:
+        await close_store()
+
+if __name__ == "__main__":
+    configure_logging()
+    asyncio.run(main())
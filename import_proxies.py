@@ -1,93 +1,115 @@
-import aiosqlite
-import aiohttp
 import asyncio
+import itertools
 import logging
-from db_utils import get_db_path, init_db
+import config
+import db_utils
+import offload
+from events import bus, ProxyAdded, ProxyUpdated, ProxyDied
+from db_utils import init_db, open_store, close_store, rebuild_alive_index
+from render import card_cache
+from metrics import FETCH_SECONDS, FETCHED_PROXIES, IMPORT_SECONDS, IMPORTED_PROXIES, timed
+from startup import configure_logging
+from fetcher import Fetcher, RecordDecoder, RowDecoder, DEFAULT_SOURCES
 
-API_URL = 'https://api.proxyscrape.com/v3/free-proxy-list/get?request=displayproxies&proxy_format=protocolipport&format=json'
 UPDATE_INTERVAL = 300  # 5 minutes
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+_fetcher = None
 
+@timed(IMPORT_SECONDS)
 async def import_proxies(data):
-    """Import proxies into the database."""
-    logging.debug(f"Importing proxies: {data}")
-    db_path = await get_db_path('proxies')
-    async with aiosqlite.connect(db_path) as db:
-        for proxy_data in data:
-            proxy = proxy_data['proxy']
-            status = 'active'
-            alive = proxy_data['alive']
-            alive_since = proxy_data.get('alive_since', None)
-            anonymity = proxy_data.get('anonymity', None)
-            average_timeout = proxy_data.get('average_timeout', None)
-            first_seen = proxy_data.get('first_seen', None)
-            ip = proxy_data.get('ip', None)
-            ip_data = proxy_data.get('ip_data', {})
-            as_value = ip_data.get('as', None)
-            asname = ip_data.get('asname', None)
-            city = ip_data.get('city', None)
-            continent = ip_data.get('continent', None)
-            country = ip_data.get('country', None)
-            country_code = ip_data.get('countryCode', None)
-            isp = ip_data.get('isp', None)
-            org = ip_data.get('org', None)
-            region_name = ip_data.get('regionName', None)
-            last_seen = proxy_data.get('last_seen', None)
-            port = proxy_data.get('port', None)
-            protocol = proxy_data.get('protocol', None)
-            ssl = proxy_data.get('ssl', False)
-            timeout = proxy_data.get('timeout', None)
-            times_alive = proxy_data.get('times_alive', 0)
-            times_dead = proxy_data.get('times_dead', 0)
-            uptime = proxy_data.get('uptime', None)
-            timezone = ip_data.get('timezone', None)
-            zip_code = ip_data.get('zip', None)
+    """Import proxies into the current store, writing only what changed.
 
-            try:
-                await db.execute('''
-                INSERT INTO proxies (proxy, status, alive, alive_since, anonymity, average_timeout, first_seen, ip, as_value, asname, city, continent, country, country_code, isp, org, region_name, last_seen, port, protocol, ssl, timeout, times_alive, times_dead, uptime, timezone, zip_code)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (proxy, status, alive, alive_since, anonymity, average_timeout, first_seen, ip, as_value, asname, city, continent, country, country_code, isp, org, region_name, last_seen, port, protocol, ssl, timeout, times_alive, times_dead, uptime, timezone, zip_code))
-                logging.debug(f"Inserted proxy: {proxy}")
-            except Exception as e:
-                logging.error(f"Error inserting proxy: {e}")
+    ``data`` may be a list of proxyscrape records or an async iterator of them
+    (see fetcher.iter_proxy_records); see SQLiteStore.import_proxies for how
+    unchanged records are skipped. What changed is published on the event
+    bus. Returns the number of records imported.
+    """
+    try:
+        result = await db_utils.store.import_proxies(data)
+    except Exception as e:
+        logging.error(f"Error importing proxies: {e}")
+        return 0
+    imported, inserted, updated, removed = (result[key] for key in ('imported', 'inserted', 'updated', 'removed'))
+    unchanged = imported - len(inserted) - len(updated)
+    logging.info(
+        f"Imported {imported} proxies: {len(inserted)} new, {len(updated)} updated, "
+        f"{len(removed)} removed, {unchanged} unchanged."
+    )
+    IMPORTED_PROXIES.inc(len(inserted), outcome='new')
+    IMPORTED_PROXIES.inc(len(updated), outcome='updated')
+    IMPORTED_PROXIES.inc(len(removed), outcome='removed')
+    IMPORTED_PROXIES.inc(unchanged, outcome='unchanged')
+    await bus.publish_many(itertools.chain(
+        map(ProxyAdded, inserted), map(ProxyUpdated, updated), map(ProxyDied, removed)))
+    return imported
 
-        try:
-            await db.commit()
-            logging.info("Proxies imported successfully.")
-        except Exception as e:
-            await db.rollback()
-            logging.error(f"Error committing changes: {e}")
+def get_fetcher():
+    """The shared Fetcher, created on first use so it binds to the running loop.
+
+    Sources come from PROXY_SOURCES in config.py when set (a list of
+    fetcher.ProxySource instances), otherwise fetcher.DEFAULT_SOURCES.
+    Responses are decoded in the offload pool unless it is switched off.
+    """
+    global _fetcher
+    if _fetcher is None:
+        decoder = RowDecoder() if offload.enabled() else RecordDecoder()
+        _fetcher = Fetcher(getattr(config, 'PROXY_SOURCES', DEFAULT_SOURCES), decoder=decoder)
+    return _fetcher
 
+async def close_fetcher():
+    global _fetcher
+    if _fetcher is not None:
+        await _fetcher.close()
+        _fetcher = None
+
+@timed(FETCH_SECONDS)
 async def fetch_proxies():
-    """Fetch proxies from the API."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(API_URL) as response:
-            if response.status == 200:
-                proxies_data = await response.json()
-                logging.info(f"Fetched {len(proxies_data['proxies'])} proxies.")
-                logging.debug(f"Proxies data: {proxies_data}")
-                return proxies_data['proxies']
-            else:
-                logging.error(f"Failed to fetch proxies: {response.status}")
-                return []
+    """Fetch proxies from the configured sources.
+
+    Returns None when no source has changed since the last commit_fetch()
+    (or all of them failed), so callers can skip the import.
+    """
+    proxies = await get_fetcher().fetch()
+    if proxies is None:
+        logging.info("Proxy lists unchanged or unavailable.")
+    else:
+        logging.info(f"Fetched {len(proxies)} proxies.")
+        FETCHED_PROXIES.set(len(proxies))
+    return proxies
+
+def commit_fetch():
+    """Count what fetch_proxies() returned as imported; call it once the import succeeded."""
+    get_fetcher().commit()
 
 async def periodic_update():
     """Periodically update proxies in the database."""
     while True:
-        proxies_data = await fetch_proxies()
-        await import_proxies(proxies_data)
+        try:
+            proxies_data = await fetch_proxies()
+            if proxies_data:
+                if await import_proxies(proxies_data):
+                    commit_fetch()
+                alive_count = await rebuild_alive_index(snapshot=True)
+                logging.info(f"Alive proxy index rebuilt with {alive_count} proxies.")
+                logging.info(f"Proxy card cache: {card_cache.stats()}")
+        except Exception:
+            logging.exception("Proxy update cycle failed.")
         await asyncio.sleep(UPDATE_INTERVAL)
 
 async def main():
     """Main function to initialize the database and start periodic updates."""
-    await init_db()
-    logging.info("Starting manual update.")
-    proxies_data = await fetch_proxies()
-    await import_proxies(proxies_data)
-    logging.info("Manual update completed.")
-    asyncio.create_task(periodic_update())
+    await open_store()
+    try:
+        await init_db()
+        logging.info("Starting manual update.")
+        proxies_data = await fetch_proxies()
+        if proxies_data and await import_proxies(proxies_data):
+            commit_fetch()
+        logging.info("Manual update completed.")
+    finally:
+        await close_fetcher()
+        await close_store()
 
 if __name__ == "__main__":
+    configure_logging()
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import logging
+import time
+import config
+from db_utils import (
+    init_db,
+    create_users_table,
+    open_store,
+    close_store,
+    expire_assignments,
+    prune_dead_proxies,
+    vacuum_step,
+    optimize_database,
+    vacuum_database,
+    get_storage_stats
+)
+from metrics import Counter, Gauge
+from startup import configure_logging
+
+MAINTENANCE_INTERVAL = 3600  # 1 hour
+DEAD_PROXY_RETENTION = 7 * 24 * 3600  # seconds an unlisted proxy is kept after its last sign of life
+PRUNE_BATCH_SIZE = 200
+EXPIRE_BATCH_SIZE = 500
+VACUUM_BATCH_PAGES = 128
+# Between batches the writer connection is free for handler writes.
+MAINTENANCE_PAUSE = 0.05  # seconds
+
+PRUNED_PROXIES = Counter('maintenance_pruned_proxies_total', 'Dead proxies deleted by maintenance.')
+EXPIRED_ASSIGNMENTS = Counter('maintenance_expired_assignments_total', 'Proxy leases dropped after they expired.')
+DATABASE_BYTES = Gauge('database_bytes', 'Size of the database, by file.', ['file'])
+DATABASE_PAGES = Gauge('database_pages', 'Pages in the database file, by state.', ['state'])
+
+
+async def _timed(call):
+    started = time.perf_counter()
+    result = await call
+    return result, time.perf_counter() - started
+
+async def run_maintenance(retention=None, batch_size=PRUNE_BATCH_SIZE, pages=VACUUM_BATCH_PAGES, pause=MAINTENANCE_PAUSE,
+                          expire_batch_size=EXPIRE_BATCH_SIZE):
+    """Drop expired leases, prune long-dead proxies, give free pages back, refresh planner statistics and report sizes.
+
+    Unlisted proxies with no sign of life for ``retention`` seconds
+    (DEAD_PROXY_RETENTION in config.py) are deleted unless a user holds one.
+    Deletes and vacuum steps run in small batches with a pause in between,
+    so the writer connection is never held for long; the longest batch is
+    part of the returned report.
+    """
+    if retention is None:
+        retention = getattr(config, 'DEAD_PROXY_RETENTION', DEAD_PROXY_RETENTION)
+    cutoff = time.time() - retention
+    longest = 0.0
+
+    # First, so proxies whose last lease just ended can be pruned below.
+    expired = 0
+    while True:
+        count, seconds = await _timed(expire_assignments(expire_batch_size))
+        expired += count
+        longest = max(longest, seconds)
+        if count < expire_batch_size:
+            break
+        await asyncio.sleep(pause)
+    EXPIRED_ASSIGNMENTS.inc(expired)
+
+    pruned = 0
+    while True:
+        count, seconds = await _timed(prune_dead_proxies(cutoff, batch_size))
+        pruned += count
+        longest = max(longest, seconds)
+        if count < batch_size:
+            break
+        await asyncio.sleep(pause)
+    PRUNED_PROXIES.inc(pruned)
+
+    while True:
+        free_pages, seconds = await _timed(vacuum_step(pages))
+        longest = max(longest, seconds)
+        if not free_pages:
+            break
+        await asyncio.sleep(pause)
+
+    _, optimize_seconds = await _timed(optimize_database())
+
+    stats = await get_storage_stats()
+    for name in ('file', 'wal'):
+        if f'{name}_bytes' in stats:
+            DATABASE_BYTES.set(stats[f'{name}_bytes'], file=name)
+    if 'pages' in stats:
+        DATABASE_PAGES.set(stats['pages'] - stats['free_pages'], state='used')
+        DATABASE_PAGES.set(stats['free_pages'], state='free')
+    return dict(
+        stats,
+        expired=expired,
+        pruned=pruned,
+        incremental_vacuum=free_pages is not None,
+        longest_batch_ms=longest * 1000,
+        optimize_ms=optimize_seconds * 1000,
+    )
+
+async def run_and_log_maintenance():
+    report = await run_maintenance()
+    sizes = ''
+    if 'pages' in report:
+        sizes = (f" {report['file_bytes'] / 2**20:.1f} MiB (+{report['wal_bytes'] / 2**20:.1f} MiB WAL), "
+                 f"{report['pages']} pages of {report['page_size']} bytes, {report['free_pages']} free.")
+    logging.info(
+        f"Maintenance: expired {report['expired']} leases, pruned {report['pruned']} dead proxies, longest batch {report['longest_batch_ms']:.1f}ms, "
+        f"optimize {report['optimize_ms']:.1f}ms.{sizes}"
+    )
+    if not report['incremental_vacuum'] and 'pages' in report:
+        logging.info("Incremental vacuum is off for this database; run `python maintenance.py --vacuum` "
+                     "once while the bot is stopped to switch it on.")
+    return report
+
+async def periodic_maintenance():
+    """Periodically prune dead proxies and compact the database."""
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await run_and_log_maintenance()
+        except Exception:
+            logging.exception("Maintenance cycle failed.")
+
+async def main(vacuum=False):
+    """Run maintenance once; with ``vacuum``, first rebuild the whole database file."""
+    await open_store()
+    try:
+        await init_db()
+        await create_users_table()
+        if vacuum:
+            await vacuum_database()
+        await run_and_log_maintenance()
+    finally:
+        await close_store()
+
+if __name__ == "__main__":
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Prune dead proxies and compact the database once.')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='rebuild the whole file first (blocks the database; stop the bot before)')
+    asyncio.run(main(parser.parse_args().vacuum))
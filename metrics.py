@@ -0,0 +1,221 @@
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+
+# Switched off at startup with configure(enabled=False); every recording
+# call checks it first, so disabled metrics cost one attribute lookup.
+enabled = True
+
+_registry = {}
+
+
+def configure(enabled_):
+    global enabled
+    enabled = enabled_
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if enabled:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        return self.header() + [
+            f'{self.name}{_format_labels(self.label_names, key)} {value}' for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, either set directly or read from a callback."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+        self.callback = callback
+
+    def set(self, value, **labels):
+        if enabled:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        if self.callback is not None:
+            return self.callback()
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        if self.callback is not None:
+            return self.header() + [f'{self.name} {self.callback()}']
+        return self.header() + [
+            f'{self.name}{_format_labels(self.label_names, key)} {value}' for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets, e.g. latencies in seconds."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count.
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, [le])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def timed(histogram, **labels):
+    """Decorator observing how long each call of an async function takes."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not enabled:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Time spent in each bot handler.', ['handler'])
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Time spent in each db_utils query.', ['query'])
+FETCH_SECONDS = Histogram('proxy_fetch_seconds', 'Duration of fetch_proxies.', buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120))
+IMPORT_SECONDS = Histogram('proxy_import_seconds', 'Duration of import_proxies.', buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+FETCHED_PROXIES = Gauge('proxy_fetched', 'Proxies returned by the last fetch that changed.')
+IMPORTED_PROXIES = Counter('proxy_import_rows_total', 'Proxies seen by import_proxies, by outcome.', ['outcome'])
+TELEGRAM_API_SECONDS = Histogram('telegram_api_seconds', 'Latency of Telegram Bot API calls.', ['method'])
+TELEGRAM_API_ERRORS = Counter('telegram_api_errors_total', 'Failed Telegram Bot API calls.', ['method'])
+
+
+def instrument_bot(bot, methods=('send_message',)):
+    """Time the given AsyncTeleBot API methods on this bot instance."""
+    for method in methods:
+        original = getattr(bot, method)
+
+        @functools.wraps(original)
+        async def wrapper(*args, _original=original, _method=method, **kwargs):
+            if not enabled:
+                return await _original(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await _original(*args, **kwargs)
+            except Exception:
+                TELEGRAM_API_ERRORS.inc(method=_method)
+                raise
+            finally:
+                TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=_method)
+
+        setattr(bot, method, wrapper)
+    return bot
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve GET /metrics on a local port. Returns the runner, for cleanup()."""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics.")
+    return runner
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import db_utils
+from db_utils import get_users_holding, pick_replacements
+from events import bus, ProxyDied, IndexRefreshed
+from handlers import SWITCH_PREFIX
+from metrics import Counter
+from render import format_dead_proxy_notice
+from sender import BULK
+
+LOOKUP_BATCH_SIZE = 500  # dead proxies whose holders are read in one query
+NOTIFY_BATCH_SIZE = 500  # users whose replacements are picked and notices queued in one go
+NOTIFY_PAUSE = 0.05  # seconds
+MAX_QUEUED_NOTICES = 1000  # bulk messages waiting in the sender before the notifier waits too
+
+DEAD_PROXY_NOTICES = Counter('dead_proxy_notices_total', 'Users told that a proxy they hold stopped working.')
+
+
+def switch_keyboard(replacement):
+    if replacement is None:
+        return None
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton('🔁 Switch', callback_data=SWITCH_PREFIX + replacement))
+    return keyboard
+
+class DeadProxyNotifier:
+    """Tells users when a proxy they lease stops working, offering a replacement.
+
+    A proxy is dead once it drops out of the alive index between two
+    refreshes, or a ProxyDied event names it while it was alive; either
+    way its holders hear about it once. Holders are read in batches through
+    the proxy -> users index of the store, replacements are picked for a
+    batch of users at a time, and notices go out at BULK priority with at
+    most ``max_queued`` waiting in the sender, so replies to users tapping
+    buttons are never stuck behind a fan-out of 10k notices.
+    """
+
+    def __init__(self, sender, lookup_batch_size=LOOKUP_BATCH_SIZE, batch_size=NOTIFY_BATCH_SIZE,
+                 pause=NOTIFY_PAUSE, max_queued=MAX_QUEUED_NOTICES):
+        self.sender = sender
+        self.lookup_batch_size = lookup_batch_size
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_queued = max_queued
+        self._alive = set(db_utils.alive_index)  # as of the last refresh, less the deaths reported since
+        self._dead = set()  # not reported yet
+        self._wakeup = asyncio.Event()
+
+    async def on_events(self, events):
+        for event in events:
+            if isinstance(event, IndexRefreshed):
+                alive = set(db_utils.alive_index)
+                self._dead |= self._alive - alive
+                self._alive = alive
+            elif event.proxy in self._alive:
+                self._alive.discard(event.proxy)
+                self._dead.add(event.proxy)
+        if self._dead:
+            self._wakeup.set()
+
+    async def run(self):
+        """Report dead proxies until cancelled; the fan-out runs here, outside the event bus."""
+        subscription = bus.subscribe(self.on_events, ProxyDied, IndexRefreshed, name='dead_proxy_notifier')
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                dead, self._dead = self._dead, set()
+                try:
+                    await self.notify(dead)
+                except Exception:
+                    logging.exception(f"Notifying the holders of {len(dead)} dead proxies failed.")
+        finally:
+            await bus.unsubscribe(subscription)
+
+    async def notify(self, dead):
+        """Queue a notice for every user holding one of ``dead``; return how many were queued."""
+        dead = sorted(dead)
+        holdings = {}
+        for i in range(0, len(dead), self.lookup_batch_size):
+            holdings.update(await get_users_holding(dead[i:i + self.lookup_batch_size]))
+        dead = set(dead)
+        users = list(holdings)
+        for i in range(0, len(users), self.batch_size):
+            batch = {user_id: holdings[user_id] for user_id in users[i:i + self.batch_size]}
+            replacements = await pick_replacements(batch)
+            for user_id, held in batch.items():
+                replacement = replacements[user_id]
+                await self.sender.send_message(user_id, format_dead_proxy_notice([proxy for proxy in held if proxy in dead], replacement),
+                                               reply_markup=switch_keyboard(replacement), priority=BULK)
+            DEAD_PROXY_NOTICES.inc(len(batch))
+            await asyncio.sleep(self.pause)
+            while self.sender.depth(BULK) > self.max_queued:
+                await asyncio.sleep(self.pause)
+        if users:
+            logging.info(f"Told {len(users)} users that {len(dead)} proxies they hold stopped working.")
+        return len(users)
+
+async def notify_dead_proxies(sender):
+    """Run a DeadProxyNotifier sending through ``sender``; a leader task (see bot.py)."""
+    await DeadProxyNotifier(sender).run()
@@ -0,0 +1,49 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
+import config
+
+OFFLOAD_PROCESSES = 1  # processes for CPU-bound batch work; 0 runs it on the event loop
+
+_pool = None
+
+
+def offload_processes():
+    return getattr(config, 'OFFLOAD_PROCESSES', OFFLOAD_PROCESSES)
+
+def enabled():
+    return offload_processes() > 0
+
+def get_pool():
+    """The shared process pool, started on first use.
+
+    Workers are spawned rather than forked: the bot process runs aiosqlite
+    threads, which a fork would copy mid-flight.
+    """
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(offload_processes(), mp_context=multiprocessing.get_context('spawn'))
+        # A --workers process joins its children on exit before the pool's
+        # own exit hook would stop them. Finalizers run first, and this one
+        # before those closing the pool's queues.
+        multiprocessing.util.Finalize(None, shutdown, exitpriority=100)
+    return _pool
+
+async def run(func, *args):
+    """Run ``func(*args)`` in the offload pool, or right here when offloading is off.
+
+    ``func`` must be a module-level function with picklable arguments. The
+    result is unpickled on the event loop, so it should be bytes or a few
+    large objects, never a long list of dicts.
+    """
+    if not enabled():
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), func, *args)
+
+def shutdown():
+    """Stop the pool, dropping queued work and waiting for the workers to exit."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,532 @@
+import itertools
+import json
+import mmap
+import random
+import struct
+import sys
+from array import array
+
+from records import ProxyColumns, ProxyRecord, intern
+
+# Rejection-sampling draws before excluded keys are weighed out of the tree.
+SAMPLE_ATTEMPTS = 8
+
+# Proxy attributes that can be used to filter a pick.
+FILTER_ATTRIBUTES = ('protocol', 'country_code', 'anonymity')
+
+DEFAULT_LATENCY = 5000.0  # ms, for proxies without a measurement
+MIN_SCORE = 0.01  # keeps every alive proxy reachable, just rarely
+# A proxy's weight is its score divided by (1 + holders) ** LOAD_EXPONENT,
+# so a proxy nobody holds is four times as likely as one held by one user.
+LOAD_EXPONENT = 2
+
+# Warm-start snapshot of an AliveIndex: a fixed header, a JSON table of
+# contents, then raw arrays at 8-byte aligned offsets, copied straight out of
+# an mmap on load. Bump SNAPSHOT_VERSION whenever the layout changes.
+SNAPSHOT_MAGIC = b'PXALIVE\0'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<8sII')  # magic, version, length of the table of contents
+NUMBER_COLUMNS = ('ips', 'ports', 'latency', 'quality', 'last_checked')
+STRING_COLUMNS = ('protocol', 'country_code', 'country', 'anonymity')
+
+
+def proxy_quality(uptime, times_alive, times_dead):
+    """Latency-independent part of a proxy's score, in (0, 1]."""
+    checks = (times_alive or 0) + (times_dead or 0)
+    reliability = ((times_alive or 0) + 1) / (checks + 2)
+    uptime = 50.0 if uptime is None else min(max(uptime, 1.0), 100.0)
+    return reliability * uptime / 100
+
+
+def proxy_score(latency, quality):
+    """Sampling weight of a proxy: reliable and fast proxies score higher."""
+    if not latency or latency < 0:
+        latency = DEFAULT_LATENCY
+    return max(quality * 1000 / (latency + 1000), MIN_SCORE)
+
+
+def load_factor(holders):
+    """What a proxy's score is divided by when ``holders`` users hold it."""
+    return (1 + holders) ** LOAD_EXPONENT
+
+
+def normalize_filters(filters):
+    """Drop empty filters and bring values to the case stored in the index."""
+    normalized = {}
+    for attribute, value in (filters or {}).items():
+        if attribute not in FILTER_ATTRIBUTES:
+            raise ValueError(f'Unknown proxy filter: {attribute}')
+        if value:
+            normalized[attribute] = value.upper() if attribute == 'country_code' else value.lower()
+    return normalized
+
+
+class FenwickTree:
+    """Prefix sums over float weights with O(log n) update and search."""
+
+    def __init__(self, weights=()):
+        self._tree = [0.0] + list(weights)
+        size = len(self._tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self._tree[parent] += self._tree[i]
+
+    @classmethod
+    def from_tree(cls, tree):
+        """A tree over the internal list of another one, e.g. read back from a snapshot."""
+        fenwick = cls()
+        fenwick._tree = tree
+        return fenwick
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def add(self, index, delta):
+        i = index + 1
+        size = len(self._tree)
+        while i < size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        i = len(self._tree) - 1
+        result = 0.0
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def find(self, value):
+        """Return the first index whose prefix sum exceeds ``value``."""
+        position = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(self._tree) and self._tree[nxt] <= value:
+                position = nxt
+                value -= self._tree[nxt]
+            step >>= 1
+        return position
+
+
+class WeightedSet:
+    """Keys with weights supporting O(log n) add, remove, reweight and weighted pick.
+
+    Keys are kept in a list with a key -> position dict, so removal swaps the
+    last key into the freed slot; the weights live in a Fenwick tree sized to
+    the list's capacity.
+    """
+
+    def __init__(self, items=()):
+        self._keys = []
+        self._weights = []
+        self._positions = {}
+        for key, weight in items:
+            if key not in self._positions:
+                self._positions[key] = len(self._keys)
+                self._keys.append(key)
+                self._weights.append(weight)
+        self._tree = FenwickTree(self._weights)
+
+    @classmethod
+    def restore(cls, keys, weights, tree):
+        """A set over the keys, weights and Fenwick tree list of another one, without rebuilding the tree."""
+        weighted = cls()
+        weighted._keys = keys
+        weighted._weights = weights
+        weighted._positions = dict(zip(keys, range(len(keys))))
+        weighted._tree = FenwickTree.from_tree(tree)
+        return weighted
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def add(self, key, weight):
+        if key in self._positions:
+            self.set_weight(key, weight)
+            return
+        position = len(self._keys)
+        self._positions[key] = position
+        self._keys.append(key)
+        self._weights.append(weight)
+        if position < len(self._tree):
+            self._tree.add(position, weight)
+        else:
+            # Out of capacity: rebuild with room to grow.
+            self._tree = FenwickTree(self._weights + [0.0] * len(self._weights))
+
+    def weight(self, key):
+        return self._weights[self._positions[key]]
+
+    def set_weight(self, key, weight):
+        position = self._positions[key]
+        self._tree.add(position, weight - self._weights[position])
+        self._weights[position] = weight
+
+    def discard(self, key):
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        last_position = len(self._keys) - 1
+        last_key = self._keys.pop()
+        last_weight = self._weights.pop()
+        self._tree.add(last_position, -last_weight)
+        if position < last_position:
+            self._tree.add(position, last_weight - self._weights[position])
+            self._keys[position] = last_key
+            self._weights[position] = last_weight
+            self._positions[last_key] = position
+
+    def pick(self):
+        """Pick a key with probability proportional to its weight."""
+        if not self._keys:
+            return None
+        total = self._tree.total()
+        if total <= 0:
+            return random.choice(self._keys)
+        position = self._tree.find(random.random() * total)
+        return self._keys[min(position, len(self._keys) - 1)]
+
+    def pick_excluding(self, exclude):
+        """Weighted pick among keys not in the set ``exclude``, or None if there are none.
+
+        A few plain picks usually land outside ``exclude``. If they do not,
+        the excluded keys weigh nothing for one pick, which costs
+        O(len(exclude) log n) rather than a pass over the keys.
+        """
+        for _ in range(SAMPLE_ATTEMPTS):
+            key = self.pick()
+            if key is None or key not in exclude:
+                return key
+        positions = {self._positions[key] for key in exclude if key in self._positions}
+        if len(positions) == len(self._keys):
+            return None
+        for position in positions:
+            self._tree.add(position, -self._weights[position])
+        try:
+            total = self._tree.total()
+            if total > 0:
+                position = min(self._tree.find(random.random() * total), len(self._keys) - 1)
+                if position not in positions:
+                    return self._keys[position]
+        finally:
+            for position in positions:
+                self._tree.add(position, self._weights[position])
+        # Every other key weighs 0, or rounding landed on an excluded one.
+        while True:
+            position = random.randrange(len(self._keys))
+            if position not in positions:
+                return self._keys[position]
+
+
+class AliveIndex:
+    """In-memory index of alive proxies for weighted random assignment.
+
+    Every proxy carries a score (see proxy_score) and its ProxyRecord, kept
+    in a ProxyColumns table. Besides the index over all alive proxies, one
+    WeightedSet per attribute value (e.g. protocol 'socks5') backs filtered
+    picks. A pick filtered on two or three attributes uses a WeightedSet of
+    exactly that combination, built from the smallest of its facets the
+    first time it is asked for and kept up to date from then on, so no pick
+    needs a pass over the proxies, however few match.
+
+    The index also counts the users holding each proxy, alive or not, and
+    weighs proxies down by load_factor(holders), so picks spread over lightly
+    held proxies. Taking or releasing a proxy re-weighs it in O(log n).
+    """
+
+    def __init__(self):
+        self._all = WeightedSet()
+        self._facets = {}
+        self._combinations = {}  # ((attribute, value), ...) in FILTER_ATTRIBUTES order -> WeightedSet, once used
+        self._table = ProxyColumns()
+        self._holders = {}  # proxy -> users holding it
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._all)
+
+    def __contains__(self, proxy):
+        return proxy in self._all
+
+    def __iter__(self):
+        return iter(self._all)
+
+    @staticmethod
+    def _entry(entry):
+        if isinstance(entry, str):
+            return ProxyRecord(entry), 1.0, 1.0, {}
+        record, latency, quality = entry
+        attributes = normalize_filters({name: getattr(record, name) for name in FILTER_ATTRIBUTES})
+        for name, value in attributes.items():
+            setattr(record, name, value)
+        return record, proxy_score(latency, quality), quality, attributes
+
+    def replace(self, entries, holders=None):
+        """Swap in a freshly built index.
+
+        ``entries`` are proxy strings (uniform weight) or
+        ``(ProxyRecord, latency, quality)`` tuples; ``holders`` maps proxies to
+        the number of users holding them and replaces the current counts.
+        """
+        holders = self._holders if holders is None else dict(holders)
+        scores = []
+        facet_items = {}
+        table = ProxyColumns()
+        for entry in entries:
+            record, score, quality, attributes = self._entry(entry)
+            score /= load_factor(holders.get(record.proxy, 0))
+            scores.append((record.proxy, score))
+            table.add(record, quality)
+            for facet in attributes.items():
+                facet_items.setdefault(facet, []).append((record.proxy, score))
+        new_all = WeightedSet(scores)
+        new_facets = {facet: WeightedSet(items) for facet, items in facet_items.items()}
+        self._all, self._facets, self._table, self._holders = new_all, new_facets, table, holders
+        self._combinations = {}
+        self.loaded = True
+
+    def add(self, record, latency=None, quality=1.0):
+        record, score, quality, attributes = self._entry((record, latency, quality))
+        score /= load_factor(self._holders.get(record.proxy, 0))
+        self.discard(record.proxy)
+        self._all.add(record.proxy, score)
+        self._table.add(record, quality)
+        for facet in attributes.items():
+            self._facets.setdefault(facet, WeightedSet()).add(record.proxy, score)
+        for combined in self._combined_sets(attributes):
+            combined.add(record.proxy, score)
+
+    def _attributes(self, row):
+        table = self._table
+        return {name: value for name, value in ((name, getattr(table, name)[row]) for name in FILTER_ATTRIBUTES) if value}
+
+    def _combined_sets(self, attributes):
+        """The combination sets built so far that a proxy with ``attributes`` belongs to."""
+        if not self._combinations:
+            return []
+        facets = [(name, attributes[name]) for name in FILTER_ATTRIBUTES if name in attributes]
+        combinations = itertools.chain.from_iterable(itertools.combinations(facets, size) for size in range(2, len(facets) + 1))
+        return [combined for combined in map(self._combinations.get, combinations) if combined is not None]
+
+    def _weighted_sets(self, row):
+        attributes = self._attributes(row)
+        return [self._all] + [self._facets[facet] for facet in attributes.items()] + self._combined_sets(attributes)
+
+    def discard(self, proxy):
+        self._all.discard(proxy)
+        row = self._table.row(proxy)
+        if row is None:
+            return
+        for weighted in self._weighted_sets(row):
+            weighted.discard(proxy)
+        self._table.discard(proxy)
+
+    def update_latency(self, proxy, latency):
+        """Re-score a proxy after a new latency measurement."""
+        row = self._table.row(proxy)
+        if row is None:
+            return
+        score = proxy_score(latency, self._table.quality[row]) / load_factor(self._holders.get(proxy, 0))
+        self._table.set_latency(proxy, latency)
+        for weighted in self._weighted_sets(row):
+            weighted.set_weight(proxy, score)
+
+    def record(self, proxy):
+        """The ProxyRecord of an alive proxy, or None."""
+        return self._table.get(proxy)
+
+    def holders(self, proxy):
+        return self._holders.get(proxy, 0)
+
+    def acquire(self, proxy):
+        """Count one more user holding ``proxy``."""
+        self._set_holders(proxy, self._holders.get(proxy, 0) + 1)
+
+    def release(self, proxy):
+        """Count one user less holding ``proxy``."""
+        self._set_holders(proxy, self._holders.get(proxy, 0) - 1)
+
+    def set_holders(self, holders):
+        """Replace all holder counts, re-weighing only the proxies whose count changed."""
+        for proxy in set(self._holders) | set(holders):
+            self._set_holders(proxy, holders.get(proxy, 0))
+
+    def _set_holders(self, proxy, count):
+        count = max(count, 0)
+        old = self._holders.get(proxy, 0)
+        if count == old:
+            return
+        if count:
+            self._holders[proxy] = count
+        else:
+            del self._holders[proxy]
+        row = self._table.row(proxy)
+        if row is None:
+            return
+        # Scale the current weight rather than recompute the score, which
+        # may have been built from a latency the table does not keep.
+        factor = load_factor(old) / load_factor(count)
+        for weighted in self._weighted_sets(row):
+            weighted.set_weight(proxy, weighted.weight(proxy) * factor)
+
+    def to_snapshot(self, generation=None):
+        """The index as snapshot bytes (see SNAPSHOT_MAGIC), tagged with the data ``generation``."""
+        table = self._table
+        sections = []
+
+        def add(name, data, typecode='B'):
+            sections.append((name, typecode, data))
+
+        add('proxies', '\n'.join(table.proxies).encode())
+        for name in NUMBER_COLUMNS:
+            column = getattr(table, name)
+            add(name, column.tobytes(), column.typecode)
+        add('ssl', bytes(table.ssl))
+        strings = {}
+        for name in STRING_COLUMNS:
+            codes = {}
+            add(name, array('H', [codes.setdefault(value, len(codes)) for value in getattr(table, name)]).tobytes(), 'H')
+            strings[name] = list(codes)
+        weighted_sets = [('all', None, self._all)]
+        weighted_sets += [(f'facet{i}', list(facet), weighted) for i, (facet, weighted) in enumerate(self._facets.items())]
+        for prefix, _, weighted in weighted_sets:
+            add(f'{prefix}.rows', array('I', map(table.row, weighted._keys)).tobytes(), 'I')
+            add(f'{prefix}.weights', array('d', weighted._weights).tobytes(), 'd')
+            add(f'{prefix}.tree', array('d', weighted._tree._tree).tobytes(), 'd')
+
+        offsets = {}
+        offset = 0
+        for name, typecode, data in sections:
+            offsets[name] = [offset, len(data), typecode]
+            offset += _aligned(len(data))
+        contents = json.dumps({
+            'count': len(table),
+            'generation': generation,
+            'byteorder': sys.byteorder,
+            'strings': strings,
+            'other_hosts': table.other_hosts,
+            'holders': self._holders,
+            'sets': [[prefix, facet] for prefix, facet, _ in weighted_sets],
+            'sections': offsets,
+        }).encode()
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(contents)), contents]
+        parts.append(bytes(_aligned(SNAPSHOT_HEADER.size + len(contents)) - SNAPSHOT_HEADER.size - len(contents)))
+        for _, _, data in sections:
+            parts += [data, bytes(_aligned(len(data)) - len(data))]
+        return b''.join(parts)
+
+    def load_snapshot(self, path):
+        """Swap in the index saved at ``path`` by to_snapshot; return the generation it was tagged with.
+
+        Raises ValueError for a file of another format, version or byte order.
+        """
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return self.load_snapshot_buffer(mapped, path)
+
+    def load_snapshot_buffer(self, buffer, name='snapshot'):
+        """load_snapshot for to_snapshot bytes already in memory; ``name`` is used in errors."""
+        magic, version, contents_length = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f'{name} is not a version {SNAPSHOT_VERSION} alive index snapshot')
+        contents = json.loads(buffer[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + contents_length])
+        if contents['byteorder'] != sys.byteorder:
+            raise ValueError(f'{name} was written on a {contents["byteorder"]}-endian machine')
+        start = _aligned(SNAPSHOT_HEADER.size + contents_length)
+
+        def section(name):
+            offset, length, typecode = contents['sections'][name]
+            data = buffer[start + offset:start + offset + length]
+            if typecode == 'B':
+                return data
+            values = array(typecode)
+            values.frombytes(data)
+            return values
+
+        proxies = section('proxies').decode().split('\n') if contents['count'] else []
+        numbers = [section(name) for name in NUMBER_COLUMNS]
+        strings = []
+        for name in STRING_COLUMNS:
+            values = [intern(value) for value in contents['strings'][name]]
+            strings.append(list(map(values.__getitem__, section(name))))
+        other_hosts = {int(row): host for row, host in contents['other_hosts'].items()}
+        table = ProxyColumns.from_columns(proxies, *numbers, bytearray(section('ssl')), *strings, other_hosts)
+        weighted_sets = {}
+        for prefix, facet in contents['sets']:
+            keys = list(map(proxies.__getitem__, section(f'{prefix}.rows')))
+            weighted = WeightedSet.restore(keys, section(f'{prefix}.weights').tolist(), section(f'{prefix}.tree').tolist())
+            weighted_sets[tuple(facet) if facet else None] = weighted
+        self._all = weighted_sets.pop(None)
+        self._facets = weighted_sets
+        self._combinations = {}
+        self._table = table
+        self._holders = contents['holders']
+        self.loaded = True
+        return contents['generation']
+
+    def count(self, **filters):
+        candidates = self._candidates(normalize_filters(filters))
+        return len(candidates) if candidates is not None else 0
+
+    def _candidates(self, filters):
+        """The WeightedSet of exactly the proxies matching normalized ``filters``, or None if a facet has none."""
+        if not filters:
+            return self._all
+        facets = tuple((name, filters[name]) for name in FILTER_ATTRIBUTES if name in filters)
+        if len(facets) == 1:
+            return self._facets.get(facets[0])
+        combined = self._combinations.get(facets)
+        if combined is None:
+            if self._smallest_facet(filters) is None:
+                return None
+            weight = self._all.weight
+            combined = self._combinations[facets] = WeightedSet((proxy, weight(proxy)) for proxy in self._matching(filters))
+        return combined
+
+    def _matching(self, filters):
+        smallest = self._smallest_facet(filters)
+        if smallest is None:
+            return
+        for proxy in smallest:
+            if self._matches(proxy, filters):
+                yield proxy
+
+    def _smallest_facet(self, filters):
+        facets = [self._facets.get(facet) for facet in filters.items()]
+        if any(facet is None for facet in facets):
+            return None
+        return min(facets, key=len)
+
+    def _matches(self, proxy, filters):
+        table = self._table
+        row = table.row(proxy)
+        return row is not None and all(getattr(table, name)[row] == value for name, value in filters.items())
+
+    def sample(self, exclude=(), **filters):
+        """Pick a proxy weighted by score, skipping those in ``exclude``.
+
+        Only proxies matching ``filters`` (protocol, country_code, anonymity)
+        are considered. When every matching proxy is excluded, any matching
+        proxy is returned, the same as the SQL fallback in replace_proxy.
+        """
+        candidates = self._candidates(normalize_filters(filters))
+        if not candidates:
+            return None
+        proxy = candidates.pick_excluding(set(exclude))
+        if proxy is None:
+            proxy = candidates.pick()
+        return proxy
+
+
+def _aligned(length):
+    return (length + 7) // 8 * 8
+
+
+alive_index = AliveIndex()
@@ -0,0 +1,180 @@
+import math
+import socket
+import sys
+from array import array
+
+# Attributes of a ProxyRecord, in the order of a proxy_info row.
+RECORD_FIELDS = ('proxy', 'protocol', 'ip', 'port', 'country_code', 'country', 'anonymity', 'ssl', 'latency', 'last_checked')
+
+
+def intern(value):
+    """Share one copy of repetitive strings such as protocols and country names."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProxyRecord:
+    """The details of one proxy shown to users and used to filter picks."""
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, proxy, protocol=None, ip=None, port=None, country_code=None, country=None,
+                 anonymity=None, ssl=False, latency=None, last_checked=None):
+        self.proxy = proxy
+        self.protocol = intern(protocol)
+        self.ip = ip
+        self.port = port
+        self.country_code = intern(country_code)
+        self.country = intern(country)
+        self.anonymity = intern(anonymity)
+        self.ssl = bool(ssl)
+        self.latency = latency
+        self.last_checked = last_checked
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from (proxy, protocol, ip, port, country_code, country, anonymity, ssl, timeout, last_seen)."""
+        return cls(*row)
+
+    @property
+    def https(self):
+        return 'Yes' if self.ssl else 'No'
+
+    def __eq__(self, other):
+        if not isinstance(other, ProxyRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in RECORD_FIELDS)
+
+    def __repr__(self):
+        return f'ProxyRecord({self.proxy!r}, protocol={self.protocol!r}, country_code={self.country_code!r})'
+
+
+def pack_ipv4(ip):
+    """An IPv4 address as an unsigned 32-bit int, or None for anything else."""
+    try:
+        return int.from_bytes(socket.inet_aton(ip), 'big') if ip and ip.count('.') == 3 else None
+    except OSError:
+        return None
+
+
+def unpack_ipv4(packed):
+    return socket.inet_ntoa(packed.to_bytes(4, 'big'))
+
+
+class ProxyColumns:
+    """Many ProxyRecords stored column by column.
+
+    Numbers live in typed arrays (float32 latency and quality, packed IPv4
+    addresses, 16-bit ports) and the few distinct protocols, countries and
+    anonymity levels are interned strings, so a proxy costs a few dozen bytes
+    instead of a dict or an object. Rows are addressed through the proxy
+    string; discard() moves the last row into the freed one.
+    """
+
+    def __init__(self):
+        self._rows = {}  # proxy -> row
+        self.proxies = []
+        self.ips = array('I')
+        self.ports = array('H')
+        self.latency = array('f')  # NaN when unknown
+        self.quality = array('f')
+        self.last_checked = array('d')  # NaN when unknown
+        self.ssl = bytearray()
+        self.protocol = []
+        self.country_code = []
+        self.country = []
+        self.anonymity = []
+        self._other_hosts = {}  # row -> host, for ips that are not IPv4
+        self._bind_columns()
+
+    def _bind_columns(self):
+        self._columns = (self.proxies, self.ips, self.ports, self.latency, self.quality, self.last_checked,
+                         self.ssl, self.protocol, self.country_code, self.country, self.anonymity)
+
+    @classmethod
+    def from_columns(cls, proxies, ips, ports, latency, quality, last_checked, ssl,
+                     protocol, country_code, country, anonymity, other_hosts=None):
+        """A table over ready-made columns, e.g. read back from a snapshot; the columns are used as is."""
+        table = cls()
+        table.proxies, table.ips, table.ports, table.latency = proxies, ips, ports, latency
+        table.quality, table.last_checked, table.ssl = quality, last_checked, ssl
+        table.protocol, table.country_code, table.country, table.anonymity = protocol, country_code, country, anonymity
+        table._other_hosts = dict(other_hosts or {})
+        table._rows = dict(zip(proxies, range(len(proxies))))
+        table._bind_columns()
+        return table
+
+    @property
+    def other_hosts(self):
+        """row -> host of the rows whose ip is not an IPv4 address."""
+        return self._other_hosts
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def __contains__(self, proxy):
+        return proxy in self._rows
+
+    def add(self, record, quality=1.0):
+        """Store ``record``, replacing the row of the same proxy if there is one."""
+        self.discard(record.proxy)
+        row = len(self.proxies)
+        self._rows[record.proxy] = row
+        packed = pack_ipv4(record.ip)
+        if packed is None:
+            packed = 0
+            if record.ip is not None:
+                self._other_hosts[row] = record.ip
+        self.proxies.append(record.proxy)
+        self.ips.append(packed)
+        self.ports.append(record.port or 0)
+        self.latency.append(math.nan if record.latency is None else record.latency)
+        self.quality.append(quality)
+        self.last_checked.append(math.nan if record.last_checked is None else record.last_checked)
+        self.ssl.append(record.ssl)
+        self.protocol.append(intern(record.protocol))
+        self.country_code.append(intern(record.country_code))
+        self.country.append(intern(record.country))
+        self.anonymity.append(intern(record.anonymity))
+
+    def discard(self, proxy):
+        row = self._rows.pop(proxy, None)
+        if row is None:
+            return
+        last = len(self.proxies) - 1
+        host = self._other_hosts.pop(row, None)
+        if row < last:
+            for column in self._columns:
+                column[row] = column[last]
+            self._rows[self.proxies[row]] = row
+            host = self._other_hosts.pop(last, None)
+            if host is not None:
+                self._other_hosts[row] = host
+        for column in self._columns:
+            column.pop()
+
+    def row(self, proxy):
+        return self._rows.get(proxy)
+
+    def ip(self, row):
+        host = self._other_hosts.get(row)
+        if host is not None:
+            return host
+        return unpack_ipv4(self.ips[row]) if self.ips[row] else None
+
+    def get(self, proxy):
+        """The stored ProxyRecord of ``proxy``, or None."""
+        row = self._rows.get(proxy)
+        if row is None:
+            return None
+        latency = self.latency[row]
+        last_checked = self.last_checked[row]
+        return ProxyRecord(
+            proxy, self.protocol[row], self.ip(row), self.ports[row] or None, self.country_code[row],
+            self.country[row], self.anonymity[row], self.ssl[row],
+            None if math.isnan(latency) else latency, None if math.isnan(last_checked) else last_checked,
+        )
+
+    def set_latency(self, proxy, latency):
+        row = self._rows.get(proxy)
+        if row is not None and latency is not None:
+            self.latency[row] = latency
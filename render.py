@@ -0,0 +1,138 @@
+import datetime
+import time
+from collections import OrderedDict
+
+CARD_CACHE_SIZE = 10000
+CARD_CACHE_TTL = 300  # seconds
+
+NO_PROXIES_TEXT = '❌ You do not have any assigned proxies. Use Get proxy to get one.'
+
+
+def format_proxy_card(record):
+    """Render the details of one proxy (a records.ProxyRecord) as shown to users."""
+    latency = record.latency
+    last_checked = record.last_checked
+    return 'Protocol: {}\nIP Address: {}\nPort: {}\nCountry Code: {}\nCountry: {}\nAnonymity: {}\nHTTPS: {}\nLatency: {}ms\nLast Checked: {}'.format(
+        record.protocol,
+        record.ip,
+        record.port,
+        record.country_code,
+        record.country,
+        record.anonymity,
+        record.https,
+        int(latency) if latency is not None else 'N/A',
+        datetime.datetime.fromtimestamp(last_checked).strftime('%Y-%m-%d %H:%M:%S') if last_checked else 'N/A'
+    )
+
+def format_check_proxy(assigned_proxies):
+    """Render the "Check Proxy" reply for a user's assigned proxies (oldest first)."""
+    if not assigned_proxies:
+        return NO_PROXIES_TEXT
+    current_proxy = assigned_proxies[-1]  # Use the last (newest) proxy as the active one
+    previously_used_proxies = assigned_proxies[:-1]  # Exclude the current proxy
+    previously_used_proxies_info = '\n'.join([f"{proxy.protocol} {proxy.ip}:{proxy.port}" for proxy in previously_used_proxies])
+    return f'✅ Your current active proxy:\n\n{format_proxy_card(current_proxy)}\n\nPreviously used proxies:\n{previously_used_proxies_info}'
+
+
+def format_dead_proxy_notice(dead_proxies, replacement=None):
+    """Render the notice that proxies a user holds stopped working, offering ``replacement``."""
+    noun = 'proxy' if len(dead_proxies) == 1 else 'proxies'
+    text = f"⚠️ Your {noun} {', '.join(dead_proxies)} stopped working."
+    if replacement is None:
+        return f'{text}\n\nThere is no other proxy available right now; try Get Proxy later.'
+    return f'{text}\n\nTap Switch to get {replacement} instead.'
+
+
+class ProxyCardCache:
+    """TTL + LRU cache of rendered "Check Proxy" replies, keyed by user_id.
+
+    Each entry remembers the proxies it shows, so a change to any of them
+    (a new assignment, an import, a health check) drops the entry.
+    """
+
+    def __init__(self, max_size=CARD_CACHE_SIZE, ttl=CARD_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._users_by_proxy = {}
+        # Bumped on every invalidation; a render that started before one is not stored.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_id, text, proxies, generation=None):
+        """Store a rendered reply, unless an invalidation happened since ``generation``."""
+        if generation is not None and generation != self.generation:
+            return
+        self._remove(user_id)
+        proxies = tuple(proxies)
+        self._entries[user_id] = (text, time.monotonic() + self.ttl, proxies)
+        for proxy in proxies:
+            self._users_by_proxy.setdefault(proxy, set()).add(user_id)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        for proxy in entry[2]:
+            users = self._users_by_proxy.get(proxy)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._users_by_proxy[proxy]
+        return True
+
+    def invalidate_user(self, user_id):
+        self.generation += 1
+        if self._remove(user_id):
+            self.invalidations += 1
+
+    def invalidate_proxies(self, proxies):
+        """Drop the entries of every user holding one of ``proxies``."""
+        self.generation += 1
+        if not isinstance(proxies, (set, frozenset, dict)):
+            proxies = set(proxies)
+        # Walk whichever side is smaller: the changed proxies or the cached ones.
+        if len(proxies) < len(self._users_by_proxy):
+            affected = [proxy for proxy in proxies if proxy in self._users_by_proxy]
+        else:
+            affected = [proxy for proxy in self._users_by_proxy if proxy in proxies]
+        for proxy in affected:
+            for user_id in list(self._users_by_proxy.get(proxy, ())):
+                if self._remove(user_id):
+                    self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._users_by_proxy.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+card_cache = ProxyCardCache()
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from metrics import Counter, Gauge
+from throttle import TokenBucketLimiter
+
+# Lower numbers go first.
+INTERACTIVE = 0  # replies to something the user just did
+BULK = 1  # notifications and other broadcast-type traffic
+
+SEND_WORKERS = 16
+GLOBAL_SEND_RATE = 30.0  # messages per second, Telegram's documented bot-wide limit
+CHAT_SEND_RATE = 1.0  # messages per second, per chat
+CHAT_SEND_BURST = 3
+MAX_SEND_RETRIES = 5  # 429 responses tolerated per message before giving up
+
+SEND_QUEUE_DEPTH = Gauge('send_queue_depth', 'Messages waiting in the outbound queue.', ['priority'])
+SENT_MESSAGES = Counter('send_queue_messages_total', 'Outbound messages handled, by outcome.', ['outcome'])
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+def retry_after(error):
+    """Seconds Telegram asked us to wait, if ``error`` is a 429 flood-control response."""
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        return (error.result_json.get('parameters') or {}).get('retry_after', 1)
+    return None
+
+
+class _Outgoing:
+    __slots__ = ('chat_id', 'args', 'kwargs', 'priority', 'future', 'retries')
+
+    def __init__(self, chat_id, args, kwargs, priority, future):
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.retries = 0
+
+
+def _consume_exception(future):
+    # Failures are logged by the worker; nobody has to await the future.
+    if not future.cancelled():
+        future.exception()
+
+
+class MessageSender:
+    """Outbound queue between the handlers and ``bot.send_message``.
+
+    send_message() only enqueues, so handlers return without waiting on the
+    Telegram API. Messages to one chat are delivered in order; chats take
+    turns by the priority of their oldest message, within a global rate and a
+    per-chat rate. A 429 response puts the message back at the head of its
+    chat's queue and, since Telegram's flood limit is per bot, pauses all
+    sending for the retry_after Telegram sent.
+    """
+
+    def __init__(self, bot, workers=SEND_WORKERS, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE,
+                 chat_burst=CHAT_SEND_BURST, max_retries=MAX_SEND_RETRIES):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global_limiter = TokenBucketLimiter(global_rate, max(1, int(global_rate)))
+        self._global_interval = 1 / global_rate
+        self._chat_limiter = TokenBucketLimiter(chat_rate, chat_burst)
+        self._chat_interval = 1 / chat_rate
+        self._resume_at = 0.0  # loop time before which a 429 holds every send back
+        self._pending = {}  # chat_id -> deque of _Outgoing; only chats with messages waiting
+        self._ready = asyncio.PriorityQueue()  # (priority, seq, chat_id), at most one entry per chat
+        self._seq = itertools.count()
+        self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def __len__(self):
+        return sum(self._depth.values())
+
+    def depth(self, priority):
+        """Messages of ``priority`` waiting to be sent."""
+        return self._depth[priority]
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self):
+        """Wait until every queued message has been sent or given up on."""
+        await self._idle.wait()
+
+    async def send_message(self, chat_id, *args, priority=INTERACTIVE, **kwargs):
+        """Queue a message; returns a future for the sent Message, which need not be awaited."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._schedule(chat_id, priority)
+        queue.append(_Outgoing(chat_id, args, kwargs, priority, future))
+        self._unfinished += 1
+        self._idle.clear()
+        self._track_depth(priority, 1)
+        return future
+
+    def _schedule(self, chat_id, priority, delay=0):
+        item = (priority, next(self._seq), chat_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, item)
+        else:
+            self._ready.put_nowait(item)
+
+    def _track_depth(self, priority, change):
+        self._depth[priority] += change
+        SEND_QUEUE_DEPTH.set(self._depth[priority], priority=PRIORITY_NAMES[priority])
+
+    def _finish(self, message):
+        self._track_depth(message.priority, -1)
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            item = await self._ready.get()
+            chat_id = item[2]
+            queue = self._pending[chat_id]
+            paused = self._resume_at - asyncio.get_running_loop().time()
+            if paused > 0:
+                self._ready.put_nowait(item)
+                await asyncio.sleep(paused)
+                continue
+            if not self._global_limiter.allow(None):
+                # Waiting with the chat in hand would let a backlog of bulk
+                # messages hold every worker while a reply queues behind them;
+                # put it back in its place, and take the most urgent chat next.
+                self._ready.put_nowait(item)
+                await asyncio.sleep(self._global_interval)
+                continue
+            if not self._chat_limiter.allow(chat_id):
+                self._global_limiter.refund(None)
+                self._schedule(chat_id, queue[0].priority, self._chat_interval)
+                continue
+
+            # The chat is out of the ready queue until this send is done, which
+            # keeps its messages in order.
+            message = queue.popleft()
+            try:
+                result = await self.bot.send_message(chat_id, *message.args, **message.kwargs)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is not None and message.retries < self.max_retries:
+                    message.retries += 1
+                    queue.appendleft(message)
+                    SENT_MESSAGES.inc(outcome='retried')
+                    logging.warning(f"Flood control for chat {chat_id}, pausing all sends for {delay}s.")
+                    loop = asyncio.get_running_loop()
+                    self._resume_at = max(self._resume_at, loop.time() + delay)
+                    self._schedule(chat_id, message.priority)
+                    continue
+                logging.error(f"Failed to send message to chat {chat_id}: {e}")
+                SENT_MESSAGES.inc(outcome='failed')
+                if not message.future.done():
+                    message.future.set_exception(e)
+            else:
+                SENT_MESSAGES.inc(outcome='sent')
+                if not message.future.done():
+                    message.future.set_result(result)
+            self._finish(message)
+            if queue:
+                self._schedule(chat_id, queue[0].priority)
+            else:
+                del self._pending[chat_id]
@@ -0,0 +1,92 @@
+import importlib
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def configure_logging(level=logging.INFO):
+    """Set up the root logger; only entry points call this, once per process."""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+def lazy(module, name):
+    """An async function that imports ``module`` on its first call and awaits ``module.name``.
+
+    Subsystems that only the leader worker runs (the importer, health
+    checks, maintenance) are passed to Cluster this way, so followers never
+    load them.
+    """
+    async def call(*args, **kwargs):
+        return await getattr(importlib.import_module(module), name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+class StartupPhases:
+    """Wall time of each named startup phase, in the order they finished.
+
+    Background phases run in tasks that startup does not wait for, so they
+    are listed but not counted in ``total``.
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def __call__(self, name, background=False):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started, background))
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds, background in self.phases if not background)
+
+    def summary(self):
+        return ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds, background in self.phases if not background)
+
+    def report(self):
+        lines = [f'Startup phases ({self.total * 1000:.1f}ms until ready):']
+        lines += [f"  {seconds * 1000:9.1f}ms  {name}{' (background)' if background else ''}"
+                  for name, seconds, background in self.phases]
+        return '\n'.join(lines)
+
+def import_times(modules):
+    """Import ``modules`` in a fresh interpreter under ``-X importtime``.
+
+    Returns (depth, module, self_us, cumulative_us) for every module that
+    was imported, in the order Python finished importing them.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', '; '.join(f'import {module}' for module in modules)],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            own, cumulative, indent, module = match.groups()
+            entries.append((len(indent) // 2, module, int(own), int(cumulative)))
+    return entries
+
+def import_report(modules, top=10):
+    """Cold import time of each of ``modules`` and of their ``top`` slowest direct imports."""
+    entries = import_times(modules)
+    lines = [f"Imports in a fresh interpreter ({sum(c for depth, _, _, c in entries if depth == 0) / 1000:.1f}ms):"]
+    for module in modules:
+        position = next(i for i, entry in enumerate(entries) if entry[0] == 0 and entry[1] == module)
+        # A module's imports are listed before it; they end at the previous top-level entry.
+        start = position
+        while start > 0 and entries[start - 1][0] > 0:
+            start -= 1
+        children = sorted((e for e in entries[start:position] if e[0] == 1), key=lambda e: -e[3])
+        lines.append(f'  {entries[position][3] / 1000:9.1f}ms  {module}')
+        lines += [f'  {cumulative / 1000:9.1f}ms    {name}' for _, name, _, cumulative in children[:top]]
+    return '\n'.join(lines)
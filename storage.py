@@ -0,0 +1,1055 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import pickle
+import random
+import time
+from abc import ABC, abstractmethod
+
+from proxy_index import FILTER_ATTRIBUTES, proxy_quality
+from records import ProxyRecord
+
+try:
+    import asyncpg
+except ImportError:  # only needed by PostgresStore
+    asyncpg = None
+
+MAX_ASSIGNED_PROXIES = 3
+ASSIGNMENT_TTL = 24 * 3600  # seconds a user holds an assigned proxy
+BROWSE_PAGE_SIZE = 8
+SNAPSHOT_INTERVAL = 60  # seconds between MemoryStore snapshots
+SNAPSHOT_VERSION = 1
+PACKED_BATCH_SIZE = 2000  # rows per pickled batch, and records between event loop turns on import
+
+# Order of the values in a proxy_row.
+PROXY_COLUMNS = (
+    'proxy', 'status', 'alive', 'alive_since', 'anonymity', 'average_timeout', 'first_seen', 'ip', 'country',
+    'country_code', 'last_seen', 'port', 'protocol', 'ssl', 'timeout', 'times_alive', 'times_dead', 'uptime',
+    'imported_at',
+)
+GEO_COLUMNS = ('as_value', 'asname', 'city', 'continent', 'isp', 'org', 'region_name', 'timezone', 'zip_code')
+
+
+def proxy_row(proxy_data, imported_at):
+    """Map a proxyscrape record to a tuple of PROXY_COLUMNS values."""
+    ip_data = proxy_data.get('ip_data') or {}
+    return (
+        proxy_data['proxy'],
+        'active',
+        proxy_data.get('alive', False),
+        proxy_data.get('alive_since'),
+        proxy_data.get('anonymity'),
+        proxy_data.get('average_timeout'),
+        proxy_data.get('first_seen'),
+        proxy_data.get('ip'),
+        ip_data.get('country'),
+        ip_data.get('countryCode'),
+        proxy_data.get('last_seen'),
+        proxy_data.get('port'),
+        proxy_data.get('protocol'),
+        proxy_data.get('ssl', False),
+        proxy_data.get('timeout'),
+        proxy_data.get('times_alive', 0),
+        proxy_data.get('times_dead', 0),
+        proxy_data.get('uptime'),
+        imported_at,
+    )
+
+def geo_row(proxy_data):
+    """Map a proxyscrape record to its GEO_COLUMNS values, followed by the proxy."""
+    ip_data = proxy_data.get('ip_data') or {}
+    return (
+        ip_data.get('as'),
+        ip_data.get('asname'),
+        ip_data.get('city'),
+        ip_data.get('continent'),
+        ip_data.get('isp'),
+        ip_data.get('org'),
+        ip_data.get('regionName'),
+        ip_data.get('timezone'),
+        ip_data.get('zip'),
+        proxy_data['proxy'],
+    )
+
+def volatile_values(row):
+    """The fields of a proxy_row that change between fetches."""
+    (proxy, _, alive, alive_since, anonymity, average_timeout, _, _, _, _,
+     last_seen, _, _, ssl, timeout, times_alive, times_dead, uptime, _) = row
+    return (bool(alive), alive_since, last_seen, anonymity, average_timeout, bool(ssl), timeout, times_alive, times_dead, uptime)
+
+def fingerprint(values):
+    """A digest of volatile_values that every process computes the same, unlike salted hash().
+
+    Numbers are digested as floats, so 120 in a fetched record matches the
+    120.0 read back from a REAL or DOUBLE PRECISION column.
+    """
+    canonical = tuple([float(value) if value.__class__ is int else value for value in values])
+    return int.from_bytes(hashlib.blake2b(repr(canonical).encode(), digest_size=8).digest(), 'little')
+
+def proxy_rows(data, imported_at):
+    """Yield (row, geo row) per valid record, skipping malformed ones."""
+    for proxy_data in data:
+        try:
+            yield proxy_row(proxy_data, imported_at), geo_row(proxy_data)
+        except (KeyError, TypeError, AttributeError) as e:
+            logging.error(f"Skipping malformed proxy record: {e!r}")
+
+def _packed(rows):
+    batches = [pickle.dumps(rows[i:i + PACKED_BATCH_SIZE], protocol=pickle.HIGHEST_PROTOCOL)
+               for i in range(0, len(rows), PACKED_BATCH_SIZE)]
+    return PackedRows(batches, len(rows))
+
+def pack_rows(records):
+    """proxy_rows of ``records`` as PackedRows, for handing rows out of the offload pool.
+
+    The first record of a proxy wins, as when Fetcher merges sources.
+    """
+    rows = {}
+    for row, geo in proxy_rows(records, None):
+        rows.setdefault(row[0], (row, geo))
+    return _packed(list(rows.values()))
+
+def merge_packed_rows(parts):
+    """One PackedRows from several; earlier parts win when a proxy is in more than one."""
+    rows = {}
+    for part in parts:
+        for batch in part.batches:
+            for row, geo in pickle.loads(batch):
+                rows.setdefault(row[0], (row, geo))
+    return _packed(list(rows.values()))
+
+
+class PackedRows:
+    """(row, geo row) pairs as pickled batches of PACKED_BATCH_SIZE, with no import time set.
+
+    Bytes pickle across processes in one copy, and each batch is unpickled
+    on its own while iterating, with an event loop turn in between.
+    """
+
+    def __init__(self, batches=(), count=0):
+        self.batches = list(batches)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    async def __aiter__(self):
+        for batch in self.batches:
+            for rows in pickle.loads(batch):
+                yield rows
+            await asyncio.sleep(0)
+
+
+async def aiter_rows(data, imported_at):
+    """proxy_rows for a list or an async iterator of records, or the rows of PackedRows."""
+    if isinstance(data, PackedRows):
+        async for row, geo in data:
+            yield row[:-1] + (imported_at,), geo
+    elif hasattr(data, '__aiter__'):
+        async for proxy_data in data:
+            for rows in proxy_rows((proxy_data,), imported_at):
+                yield rows
+    else:
+        for i, rows in enumerate(proxy_rows(data, imported_at), start=1):
+            yield rows
+            if i % PACKED_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+
+def proxy_info(row):
+    """The ProxyRecord for (proxy, protocol, ip, port, country_code, country, anonymity, ssl, timeout, last_seen)."""
+    return ProxyRecord.from_row(row)
+
+def import_result(imported=0, inserted=(), updated=(), removed=()):
+    """What ProxyStore.import_proxies reports: the record count and the proxies it changed."""
+    return {'imported': imported, 'inserted': list(inserted), 'updated': list(updated), 'removed': list(removed)}
+
+# Orders in which browse_proxies pages through alive proxies, each backed by
+# a covering index. Every combination of filters is the leading columns of
+# one of them, so the rest of that index is already in page order.
+BROWSE_ORDERS = (
+    ('protocol', 'country_code', 'anonymity'),
+    ('country_code', 'anonymity', 'protocol'),
+    ('anonymity', 'protocol', 'country_code'),
+)
+
+# Columns of a browse row; a page position (browse key) is its first four.
+BROWSE_COLUMNS = ('protocol', 'country_code', 'anonymity', 'id', 'proxy', 'timeout')
+
+def browse_order(filters):
+    """The columns after ``filters`` in the BROWSE_ORDERS entry they lead, followed by id."""
+    for order in BROWSE_ORDERS:
+        if set(order[:len(filters)]) == set(filters):
+            return order[len(filters):] + ('id',)
+    raise ValueError(f'Cannot browse by {", ".join(filters)}')
+
+def browse_position(key, columns):
+    """The values of ``columns`` in a browse key (protocol, country_code, anonymity, id)."""
+    return tuple(key[BROWSE_COLUMNS.index(column)] for column in columns)
+
+def browse_row(row):
+    """(browse key, ProxyRecord) for a row of BROWSE_COLUMNS."""
+    protocol, country_code, anonymity, id_, proxy, timeout = row
+    return (protocol, country_code, anonymity, id_), ProxyRecord(
+        proxy, protocol, country_code=country_code, anonymity=anonymity, latency=timeout)
+
+def browse_query(filters, after=None, before=None, limit=BROWSE_PAGE_SIZE, alive='alive = 1', param=lambda i: '?'):
+    """SQL and parameters for browse_proxies; ``param(i)`` renders the i-th placeholder."""
+    columns = browse_order(filters)
+    params = []
+
+    def placeholder(value):
+        params.append(value)
+        return param(len(params))
+
+    where = [alive] + [f'{name} IS NOT NULL' for name in FILTER_ATTRIBUTES]
+    where += [f'{name} = {placeholder(value)}' for name, value in filters.items()]
+    cursor = before if before is not None else after
+    if cursor is not None:
+        values = ', '.join(placeholder(value) for value in browse_position(cursor, columns))
+        where.append(f"({', '.join(columns)}) {'<' if before is not None else '>'} ({values})")
+    direction = ' DESC' if before is not None else ''
+    sql = (f"SELECT {', '.join(BROWSE_COLUMNS)} FROM proxies WHERE {' AND '.join(where)} "
+           f"ORDER BY {', '.join(column + direction for column in columns)} LIMIT {placeholder(limit)}")
+    return sql, params
+
+
+class ProxyStore(ABC):
+    """Where proxies, leases and generation counters are kept.
+
+    db_utils forwards its query functions to the store installed with
+    db_utils.use_store(); every implementation must pass the conformance
+    tests in test_all.py. ``results`` in record_checks are
+    (alive, latency, checked_at, proxy) tuples.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def init_proxies(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def import_proxies(self, data):
+        """Upsert proxyscrape records and mark proxies missing from them dead; return an import_result."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_proxy(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_alive_proxies(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_alive_index_entries(self):
+        """(ProxyRecord, latency, quality) for every alive proxy; see AliveIndex.replace."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def random_alive_proxy(self, exclude, filters):
+        """A random alive proxy not in ``exclude``, or any alive one if all are excluded."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_proxy_info(self, proxy):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def browse_proxies(self, filters, after=None, before=None, limit=BROWSE_PAGE_SIZE):
+        """Up to ``limit`` (browse key, ProxyRecord) of alive proxies matching ``filters``.
+
+        Rows come in browse_order, starting after the key ``after`` or, with
+        ``before``, ending just before that key. Proxies without a protocol,
+        country code or anonymity level are not browsable.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_facet_counts(self, facet, filters):
+        """(value, alive proxies) of ``facet`` among proxies matching ``filters``, most common first.
+
+        Served from counts refreshed whenever liveness changes, not from the proxies themselves.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_listed_proxies(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def record_checks(self, results):
+        """Store (alive, latency, checked_at, proxy) results; return how many proxies went alive or dead.
+
+        Facets and the proxies generation are left to finish_checks, so a
+        run written in many batches recounts them once.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def finish_checks(self):
+        """Recount the facets and bump the proxies generation after health checks changed liveness."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def prune_dead_proxies(self, cutoff, limit):
+        """Delete up to ``limit`` unlisted proxies no user holds and with no sign of life since ``cutoff``.
+
+        Returns how many were deleted; fewer than ``limit`` means none are left.
+        """
+        raise NotImplementedError
+
+    async def vacuum_step(self, pages):
+        """Give up to ``pages`` free pages back to the file system; return how many are left, or None."""
+        return 0
+
+    async def optimize(self):
+        """Refresh the statistics the query planner works from."""
+
+    async def vacuum(self):
+        """Compact everything at once; blocks all queries while it runs."""
+
+    async def storage_stats(self):
+        """Size figures to report, e.g. file_bytes and pages."""
+        return {}
+
+    async def forget_import_snapshot(self):
+        """Drop anything kept in this process about the last import, e.g. once another process may import."""
+
+    @abstractmethod
+    async def acquire_lease(self, name, holder, ttl):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_lease(self, name, holder):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def bump_generation(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_generation(self, name):
+        raise NotImplementedError
+
+
+class UserStore(ABC):
+    """Where users and their assigned proxies are kept."""
+
+    @abstractmethod
+    async def init_users(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_assigned_proxies_and_language_code(self, user_id):
+        """A user's assigned proxies as proxy_info dicts (oldest first) and language code."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def assign_proxy(self, user_id, new_proxy, language_code, expires_at):
+        """Record the user, and lease ``new_proxy`` to them until ``expires_at``.
+
+        Only the MAX_ASSIGNED_PROXIES newest leases are kept. A proxy the user
+        already holds has its lease extended. Returns (acquired, released):
+        whether a new lease was taken, and the proxies whose leases were dropped
+        to make room.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def expire_assignments(self, now, limit):
+        """Drop up to ``limit`` leases that expired by ``now``; return their (user_id, proxy)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_holder_counts(self):
+        """Proxy -> number of leases on it, counting expired leases not dropped yet."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_users_holding(self, proxies, now):
+        """User -> every proxy they lease (oldest first), for users with a lease on one of ``proxies`` unexpired at ``now``."""
+        raise NotImplementedError
+
+
+class MemoryStore(ProxyStore, UserStore):
+    """Everything in dicts, for single-process deployments.
+
+    With ``snapshot_path`` the data is loaded from that file on open(),
+    written to it every ``snapshot_interval`` seconds and again on close().
+    Snapshots are pickled on the event loop, which keeps them consistent,
+    and written to disk in a thread.
+    """
+
+    def __init__(self, snapshot_path=None, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._proxies = {}  # proxy -> dict of PROXY_COLUMNS, plus checked_at and fingerprint
+        self._geo = {}  # proxy -> tuple of GEO_COLUMNS
+        self._users = {}  # user_id -> language_code
+        self._assignments = {}  # user_id -> [(assigned_at, proxy, expires_at)], oldest first
+        self._expiry = []  # heap of (expires_at, user_id, proxy); stale once a lease is extended or dropped
+        self._leases = {}  # name -> (holder, expires_at)
+        self._generations = {}
+        self._facet_counts = {}  # (protocol, country_code, anonymity) -> alive proxies
+        self._next_id = 1
+        self._snapshot_task = None
+
+    async def open(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            self.load_snapshot()
+        if self.snapshot_path and self.snapshot_interval:
+            self._snapshot_task = asyncio.create_task(self._snapshot_periodically())
+
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self.snapshot_path:
+            await self.snapshot()
+
+    async def _snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception:
+                logging.exception("Memory store snapshot failed.")
+
+    async def snapshot(self):
+        """Write the store to snapshot_path, atomically replacing the previous snapshot."""
+        payload = pickle.dumps({
+            'version': SNAPSHOT_VERSION,
+            'proxies': self._proxies,
+            'geo': self._geo,
+            'users': self._users,
+            'assignments': self._assignments,
+            'generations': self._generations,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        await asyncio.to_thread(self._write_snapshot, payload)
+
+    def _write_snapshot(self, payload):
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(temp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        with open(self.snapshot_path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != SNAPSHOT_VERSION:
+            logging.warning(f"Ignoring snapshot {self.snapshot_path} with unknown version {data.get('version')}.")
+            return
+        self._proxies = data['proxies']
+        self._geo = data['geo']
+        self._users = data['users']
+        self._assignments = data['assignments']
+        self._generations = data['generations']
+        expires_at = time.time() + ASSIGNMENT_TTL
+        for user_id, assignments in self._assignments.items():
+            # Snapshots written before leases existed keep (assigned_at, proxy).
+            assignments[:] = [assignment if len(assignment) == 3 else (*assignment, expires_at) for assignment in assignments]
+        self._expiry = [(expires_at, user_id, proxy)
+                        for user_id, assignments in self._assignments.items() for _, proxy, expires_at in assignments]
+        heapq.heapify(self._expiry)
+        for record in self._proxies.values():
+            # Snapshots written before browsing existed have no row ids.
+            if 'id' not in record:
+                record['id'] = self._next_id
+            self._next_id = max(self._next_id, record['id'] + 1)
+        self._refresh_facets()
+
+    async def init_proxies(self):
+        pass
+
+    async def init_users(self):
+        pass
+
+    async def import_proxies(self, data):
+        imported_at = time.time()
+        seen = set()
+        inserted, updated = [], []
+        async for row, geo in aiter_rows(data, imported_at):
+            proxy = row[0]
+            values = volatile_values(row)
+            current = fingerprint(values)
+            seen.add(proxy)
+            record = self._proxies.get(proxy)
+            if record is None:
+                record = dict(zip(PROXY_COLUMNS, row), id=self._next_id, checked_at=None, fingerprint=current)
+                self._next_id += 1
+                self._proxies[proxy] = record
+                self._geo[proxy] = geo[:-1]
+                inserted.append(proxy)
+            elif record['fingerprint'] != current:
+                # Our own newer health check wins over upstream liveness and latency.
+                keep_checked = record['checked_at'] is not None and row[10] is not None and record['checked_at'] > row[10]
+                alive, timeout = record['alive'], record['timeout']
+                # A proxy listed again after being dropped counts as new, like in SQLiteStore.
+                (inserted if record['status'] == 'dead' else updated).append(proxy)
+                record.update(zip(PROXY_COLUMNS, row))
+                if keep_checked:
+                    record['alive'], record['timeout'] = alive, timeout
+                record['fingerprint'] = current
+        removed = []
+        if seen:
+            for proxy, record in self._proxies.items():
+                if proxy not in seen and record['status'] != 'dead':
+                    record['status'] = 'dead'
+                    record['alive'] = False
+                    record['fingerprint'] = None
+                    removed.append(proxy)
+        if inserted or updated or removed:
+            self._refresh_facets()
+            await self.bump_generation('proxies')
+        return import_result(len(seen), inserted, updated, removed)
+
+    def _refresh_facets(self):
+        counts = {}
+        for key, _ in self._browsable():
+            facets = key[:3]
+            counts[facets] = counts.get(facets, 0) + 1
+        self._facet_counts = counts
+
+    def _browsable(self):
+        """(browse key, record) of every alive proxy with all of FILTER_ATTRIBUTES set."""
+        for record in self._proxies.values():
+            if record['alive'] and all(record[name] is not None for name in FILTER_ATTRIBUTES):
+                yield (record['protocol'], record['country_code'], record['anonymity'], record['id']), record
+
+    async def get_active_proxy(self):
+        return next((proxy for proxy, record in self._proxies.items() if record['status'] == 'active'), None)
+
+    async def get_alive_proxies(self):
+        return [proxy for proxy, record in self._proxies.items() if record['alive']]
+
+    async def get_alive_index_entries(self):
+        return [
+            (self._info(proxy), record['timeout'] or record['average_timeout'],
+             proxy_quality(record['uptime'], record['times_alive'], record['times_dead']))
+            for proxy, record in self._proxies.items() if record['alive']
+        ]
+
+    async def random_alive_proxy(self, exclude, filters):
+        matching = [
+            proxy for proxy, record in self._proxies.items()
+            if record['alive'] and all(record[attribute] == value for attribute, value in filters.items())
+        ]
+        exclude = set(exclude)
+        candidates = [proxy for proxy in matching if proxy not in exclude] or matching
+        return random.choice(candidates) if candidates else None
+
+    def _info(self, proxy):
+        record = self._proxies.get(proxy)
+        if record is None:
+            return None
+        return proxy_info((proxy, record['protocol'], record['ip'], record['port'], record['country_code'],
+                           record['country'], record['anonymity'], record['ssl'], record['timeout'], record['last_seen']))
+
+    async def get_proxy_info(self, proxy):
+        return self._info(proxy)
+
+    async def browse_proxies(self, filters, after=None, before=None, limit=BROWSE_PAGE_SIZE):
+        columns = browse_order(filters)
+        rows = sorted(
+            (browse_position(key, columns), key, record) for key, record in self._browsable()
+            if all(record[name] == value for name, value in filters.items())
+        )
+        if before is not None:
+            position = browse_position(before, columns)
+            rows = [row for row in rows if row[0] < position][-limit:]
+        else:
+            if after is not None:
+                position = browse_position(after, columns)
+                rows = [row for row in rows if row[0] > position]
+            rows = rows[:limit]
+        return [browse_row(key + (record['proxy'], record['timeout'])) for _, key, record in rows]
+
+    async def get_facet_counts(self, facet, filters):
+        column = FILTER_ATTRIBUTES.index(facet)
+        totals = {}
+        for facets, count in self._facet_counts.items():
+            if all(facets[FILTER_ATTRIBUTES.index(name)] == value for name, value in filters.items()):
+                totals[facets[column]] = totals.get(facets[column], 0) + count
+        return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+
+    async def get_listed_proxies(self):
+        return [proxy for proxy, record in self._proxies.items() if record['status'] != 'dead']
+
+    async def record_checks(self, results):
+        changed = 0
+        for alive, latency, checked_at, proxy in results:
+            record = self._proxies.get(proxy)
+            if record is not None:
+                changed += record['alive'] != bool(alive)
+                record['alive'] = bool(alive)
+                if latency is not None:
+                    record['timeout'] = latency
+                record['checked_at'] = checked_at
+        return changed
+
+    async def finish_checks(self):
+        self._refresh_facets()
+        await self.bump_generation('proxies')
+
+    async def prune_dead_proxies(self, cutoff, limit):
+        held = {proxy for assignments in self._assignments.values() for _, proxy, _ in assignments}
+        doomed = []
+        for proxy, record in self._proxies.items():
+            if len(doomed) == limit:
+                break
+            last_alive = max(record['last_seen'] or 0, record['checked_at'] or 0, record['imported_at'] or 0)
+            if record['status'] == 'dead' and not record['alive'] and last_alive < cutoff and proxy not in held:
+                doomed.append(proxy)
+        for proxy in doomed:
+            del self._proxies[proxy]
+            self._geo.pop(proxy, None)
+        return len(doomed)
+
+    async def storage_stats(self):
+        return {'proxies': len(self._proxies), 'users': len(self._users)}
+
+    async def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        current = self._leases.get(name)
+        if current is None or current[0] == holder or current[1] < now:
+            self._leases[name] = (holder, now + ttl)
+            return True
+        return False
+
+    async def release_lease(self, name, holder):
+        if self._leases.get(name, (None,))[0] == holder:
+            del self._leases[name]
+
+    async def bump_generation(self, name):
+        self._generations[name] = self._generations.get(name, 0) + 1
+        return self._generations[name]
+
+    async def get_generation(self, name):
+        return self._generations.get(name, 0)
+
+    async def get_assigned_proxies_and_language_code(self, user_id):
+        if user_id not in self._users:
+            return [], None
+        now = time.time()
+        assigned = (self._info(proxy) for _, proxy, expires_at in self._assignments.get(user_id, ()) if expires_at > now)
+        return [info for info in assigned if info is not None], self._users[user_id]
+
+    async def assign_proxy(self, user_id, new_proxy, language_code, expires_at):
+        self._users[user_id] = language_code
+        if not new_proxy or new_proxy not in self._proxies:
+            return False, []
+        assignments = self._assignments.setdefault(user_id, [])
+        heapq.heappush(self._expiry, (expires_at, user_id, new_proxy))
+        for i, (assigned_at, proxy, _) in enumerate(assignments):
+            if proxy == new_proxy:
+                assignments[i] = (assigned_at, proxy, expires_at)
+                return False, []
+        assignments.append((time.time(), new_proxy, expires_at))
+        released = [proxy for _, proxy, _ in assignments[:-MAX_ASSIGNED_PROXIES]]
+        del assignments[:-MAX_ASSIGNED_PROXIES]
+        return True, released
+
+    async def expire_assignments(self, now, limit):
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now and len(expired) < limit:
+            expires_at, user_id, proxy = heapq.heappop(self._expiry)
+            assignments = self._assignments.get(user_id, [])
+            for i, assignment in enumerate(assignments):
+                if assignment[1] == proxy and assignment[2] == expires_at:
+                    del assignments[i]
+                    expired.append((user_id, proxy))
+                    break
+        return expired
+
+    async def get_holder_counts(self):
+        counts = {}
+        for assignments in self._assignments.values():
+            for _, proxy, _ in assignments:
+                counts[proxy] = counts.get(proxy, 0) + 1
+        return counts
+
+    async def get_users_holding(self, proxies, now):
+        proxies = set(proxies)
+        holders = {}
+        for user_id, assignments in self._assignments.items():
+            held = [proxy for _, proxy, expires_at in assignments if expires_at > now]
+            if not proxies.isdisjoint(held):
+                holders[user_id] = held
+        return holders
+
+
+POSTGRES_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS proxies (
+        id BIGSERIAL PRIMARY KEY,
+        proxy TEXT NOT NULL UNIQUE,
+        status TEXT NOT NULL,
+        alive BOOLEAN NOT NULL,
+        alive_since DOUBLE PRECISION,
+        anonymity TEXT,
+        average_timeout DOUBLE PRECISION,
+        first_seen DOUBLE PRECISION,
+        ip TEXT,
+        country TEXT,
+        country_code TEXT,
+        last_seen DOUBLE PRECISION,
+        port INTEGER,
+        protocol TEXT,
+        ssl BOOLEAN,
+        timeout DOUBLE PRECISION,
+        times_alive INTEGER,
+        times_dead INTEGER,
+        uptime DOUBLE PRECISION,
+        imported_at DOUBLE PRECISION,
+        checked_at DOUBLE PRECISION
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS proxy_geo (
+        proxy_id BIGINT PRIMARY KEY REFERENCES proxies (id),
+        as_value TEXT, asname TEXT, city TEXT, continent TEXT, isp TEXT, org TEXT,
+        region_name TEXT, timezone TEXT, zip_code TEXT
+    )
+    ''',
+    'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value BIGINT NOT NULL)',
+) + tuple(
+    f'CREATE INDEX IF NOT EXISTS idx_proxies_browse_{order[0]} ON proxies ({", ".join(order)}, id) INCLUDE (proxy, timeout) WHERE alive'
+    for order in BROWSE_ORDERS
+) + (
+    '''
+    CREATE TABLE IF NOT EXISTS proxy_facets (
+        protocol TEXT NOT NULL,
+        country_code TEXT NOT NULL,
+        anonymity TEXT NOT NULL,
+        proxies INTEGER NOT NULL,
+        PRIMARY KEY (protocol, country_code, anonymity)
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_proxies_dead ON proxies (id) WHERE status = 'dead'",
+)
+
+POSTGRES_USERS_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, language_code TEXT)',
+    '''
+    CREATE TABLE IF NOT EXISTS user_proxies (
+        user_id BIGINT NOT NULL REFERENCES users (user_id),
+        proxy_id BIGINT NOT NULL REFERENCES proxies (id),
+        assigned_at DOUBLE PRECISION NOT NULL,
+        expires_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, proxy_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_user_proxies_proxy ON user_proxies (proxy_id)',
+    # Tables from before leases: every existing assignment gets a full lease.
+    'ALTER TABLE user_proxies ADD COLUMN IF NOT EXISTS expires_at DOUBLE PRECISION',
+    f'UPDATE user_proxies SET expires_at = EXTRACT(EPOCH FROM now()) + {ASSIGNMENT_TTL} WHERE expires_at IS NULL',
+    'ALTER TABLE user_proxies ALTER COLUMN expires_at SET NOT NULL',
+    'CREATE INDEX IF NOT EXISTS idx_user_proxies_expires ON user_proxies (expires_at)',
+)
+
+POSTGRES_UPSERT_PROXY_SQL = f'''
+INSERT INTO proxies ({', '.join(PROXY_COLUMNS)})
+VALUES ({', '.join(f'${i}' for i in range(1, len(PROXY_COLUMNS) + 1))})
+ON CONFLICT (proxy) DO UPDATE SET
+    status = excluded.status,
+    alive = CASE WHEN proxies.checked_at > excluded.last_seen THEN proxies.alive ELSE excluded.alive END,
+    alive_since = excluded.alive_since,
+    anonymity = excluded.anonymity,
+    average_timeout = excluded.average_timeout,
+    country = excluded.country,
+    country_code = excluded.country_code,
+    last_seen = excluded.last_seen,
+    ssl = excluded.ssl,
+    timeout = CASE WHEN proxies.checked_at > excluded.last_seen THEN proxies.timeout ELSE excluded.timeout END,
+    times_alive = excluded.times_alive,
+    times_dead = excluded.times_dead,
+    uptime = excluded.uptime,
+    imported_at = excluded.imported_at
+'''
+
+POSTGRES_UPSERT_GEO_SQL = f'''
+INSERT INTO proxy_geo (proxy_id, {', '.join(GEO_COLUMNS)})
+SELECT id, $1, $2, $3, $4, $5, $6, $7, $8, $9 FROM proxies WHERE proxy = $10
+ON CONFLICT (proxy_id) DO NOTHING
+'''
+
+# The stored volatile fields of the given proxies, in volatile_values order.
+POSTGRES_STORED_SQL = '''
+SELECT proxy, status, alive, alive_since, last_seen, anonymity, average_timeout, ssl, timeout, times_alive, times_dead, uptime
+FROM proxies WHERE proxy = ANY($1::text[])
+'''
+
+POSTGRES_BUMP_GENERATION_SQL = '''
+INSERT INTO generations (name, value) VALUES ($1, 1)
+ON CONFLICT (name) DO UPDATE SET value = generations.value + 1'''
+
+POSTGRES_REFRESH_FACETS_SQL = (
+    'DELETE FROM proxy_facets',
+    '''
+    INSERT INTO proxy_facets (protocol, country_code, anonymity, proxies)
+    SELECT protocol, country_code, anonymity, COUNT(*) FROM proxies
+    WHERE alive AND protocol IS NOT NULL AND country_code IS NOT NULL AND anonymity IS NOT NULL
+    GROUP BY protocol, country_code, anonymity
+    ''',
+)
+
+POSTGRES_PRUNE_SQL = '''
+WITH doomed AS (
+    SELECT id FROM proxies p
+    WHERE status = 'dead' AND NOT alive
+        AND GREATEST(COALESCE(last_seen, 0), COALESCE(checked_at, 0), COALESCE(imported_at, 0)) < $1
+        AND NOT EXISTS (SELECT 1 FROM user_proxies up WHERE up.proxy_id = p.id)
+    LIMIT $2
+), geo AS (
+    DELETE FROM proxy_geo WHERE proxy_id IN (SELECT id FROM doomed)
+)
+DELETE FROM proxies WHERE id IN (SELECT id FROM doomed) RETURNING id
+'''
+
+POSTGRES_PROXY_INFO_COLUMNS = 'p.proxy, p.protocol, p.ip, p.port, p.country_code, p.country, p.anonymity, p.ssl, p.timeout, p.last_seen'
+
+
+class PostgresStore(ProxyStore, UserStore):
+    """PostgreSQL backend over an asyncpg pool, for several hosts sharing one database.
+
+    Needs the optional asyncpg package and a server reachable at ``dsn``, e.g.
+    a local one started with ``docker run -e POSTGRES_PASSWORD=... -p 5432:5432 postgres``.
+    Imports compare each record with the stored row rather than with a local
+    snapshot, since other hosts may write the same rows, and upsert only new
+    and changed proxies.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    async def open(self):
+        if asyncpg is None:
+            raise RuntimeError('PostgresStore needs the asyncpg package: pip install asyncpg')
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def init_proxies(self):
+        async with self._pool.acquire() as db:
+            for statement in POSTGRES_SCHEMA:
+                await db.execute(statement)
+
+    async def init_users(self):
+        async with self._pool.acquire() as db:
+            for statement in POSTGRES_USERS_SCHEMA:
+                await db.execute(statement)
+
+    async def import_proxies(self, data):
+        imported_at = time.time()
+        rows, geo_rows = {}, {}
+        async for row, geo in aiter_rows(data, imported_at):
+            rows[row[0]] = row
+            geo_rows[row[0]] = geo
+        if not rows:
+            return import_result()
+        proxies = list(rows)
+        async with self._pool.acquire() as db:
+            async with db.transaction():
+                stored = {
+                    record['proxy']: (record['status'], fingerprint(tuple(record)[2:]))
+                    for record in await db.fetch(POSTGRES_STORED_SQL, proxies)
+                }
+                inserted, updated = [], []
+                for proxy, row in rows.items():
+                    status, old = stored.get(proxy, ('dead', None))
+                    if status == 'dead':
+                        inserted.append(proxy)
+                    elif old != fingerprint(volatile_values(row)):
+                        updated.append(proxy)
+                changed = inserted + updated
+                await db.executemany(POSTGRES_UPSERT_PROXY_SQL, [rows[proxy] for proxy in changed])
+                await db.executemany(POSTGRES_UPSERT_GEO_SQL, [geo_rows[proxy] for proxy in inserted])
+                removed = [record['proxy'] for record in await db.fetch(
+                    "UPDATE proxies SET status = 'dead', alive = FALSE "
+                    "WHERE status != 'dead' AND NOT (proxy = ANY($1::text[])) RETURNING proxy", proxies)]
+                if changed or removed:
+                    for statement in POSTGRES_REFRESH_FACETS_SQL:
+                        await db.execute(statement)
+                    await db.execute(POSTGRES_BUMP_GENERATION_SQL, 'proxies')
+        return import_result(len(rows), inserted, updated, removed)
+
+    async def get_active_proxy(self):
+        return await self._pool.fetchval("SELECT proxy FROM proxies WHERE status = 'active' LIMIT 1")
+
+    async def get_alive_proxies(self):
+        return [record['proxy'] for record in await self._pool.fetch('SELECT proxy FROM proxies WHERE alive')]
+
+    async def get_alive_index_entries(self):
+        records = await self._pool.fetch(f'''
+        SELECT {POSTGRES_PROXY_INFO_COLUMNS}, p.average_timeout, p.uptime, p.times_alive, p.times_dead
+        FROM proxies p WHERE p.alive
+        ''')
+        return [
+            (proxy_info(tuple(r)[:10]), r['timeout'] or r['average_timeout'], proxy_quality(r['uptime'], r['times_alive'], r['times_dead']))
+            for r in records
+        ]
+
+    async def random_alive_proxy(self, exclude, filters):
+        filter_sql = ''.join(f' AND {attribute} = ${i}' for i, attribute in enumerate(filters, start=2))
+        values = tuple(filters.values())
+        proxy = await self._pool.fetchval(
+            f'SELECT proxy FROM proxies WHERE alive AND NOT (proxy = ANY($1::text[])){filter_sql} ORDER BY random() LIMIT 1',
+            list(exclude), *values)
+        if proxy is None:
+            filter_sql = ''.join(f' AND {attribute} = ${i}' for i, attribute in enumerate(filters, start=1))
+            proxy = await self._pool.fetchval(
+                f'SELECT proxy FROM proxies WHERE alive{filter_sql} ORDER BY random() LIMIT 1', *values)
+        return proxy
+
+    async def get_proxy_info(self, proxy):
+        record = await self._pool.fetchrow(
+            f'SELECT {POSTGRES_PROXY_INFO_COLUMNS} FROM proxies p WHERE p.proxy = $1', proxy)
+        return proxy_info(tuple(record)) if record else None
+
+    async def browse_proxies(self, filters, after=None, before=None, limit=BROWSE_PAGE_SIZE):
+        sql, params = browse_query(filters, after, before, limit, alive='alive', param=lambda i: f'${i}')
+        rows = [browse_row(tuple(record)) for record in await self._pool.fetch(sql, *params)]
+        return rows[::-1] if before is not None else rows
+
+    async def get_facet_counts(self, facet, filters):
+        if facet not in FILTER_ATTRIBUTES:
+            raise ValueError(f'Unknown proxy facet: {facet}')
+        where = ' AND '.join(f'{name} = ${i}' for i, name in enumerate(filters, start=1)) or 'TRUE'
+        records = await self._pool.fetch(
+            f'SELECT {facet}, SUM(proxies) FROM proxy_facets WHERE {where} GROUP BY {facet} ORDER BY 2 DESC, 1',
+            *filters.values())
+        return [(record[0], record[1]) for record in records]
+
+    async def get_listed_proxies(self):
+        return [record['proxy'] for record in await self._pool.fetch("SELECT proxy FROM proxies WHERE status != 'dead'")]
+
+    async def record_checks(self, results):
+        async with self._pool.acquire() as db:
+            async with db.transaction():
+                changed = await db.fetchval('''
+                SELECT COUNT(*) FROM proxies p JOIN unnest($1::text[], $2::boolean[]) AS c (proxy, alive) ON c.proxy = p.proxy
+                WHERE p.alive IS DISTINCT FROM c.alive
+                ''', [proxy for *_, proxy in results], [bool(alive) for alive, *_ in results])
+                await db.executemany(
+                    'UPDATE proxies SET alive = $1, timeout = COALESCE($2, timeout), checked_at = $3 WHERE proxy = $4',
+                    [(bool(alive), latency, checked_at, proxy) for alive, latency, checked_at, proxy in results])
+        return changed
+
+    async def finish_checks(self):
+        async with self._pool.acquire() as db:
+            async with db.transaction():
+                for statement in POSTGRES_REFRESH_FACETS_SQL:
+                    await db.execute(statement)
+                await db.execute(POSTGRES_BUMP_GENERATION_SQL, 'proxies')
+
+    async def prune_dead_proxies(self, cutoff, limit):
+        return len(await self._pool.fetch(POSTGRES_PRUNE_SQL, cutoff, limit))
+
+    async def optimize(self):
+        # Autovacuum reclaims space on its own; only the statistics are refreshed here.
+        await self._pool.execute('ANALYZE proxies, proxy_geo, user_proxies')
+
+    async def storage_stats(self):
+        return {'file_bytes': await self._pool.fetchval('SELECT pg_database_size(current_database())')}
+
+    async def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        current = await self._pool.fetchval('''
+        INSERT INTO leases (name, holder, expires_at) VALUES ($1, $2, $3)
+        ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE leases.holder = excluded.holder OR leases.expires_at < $4
+        RETURNING holder
+        ''', name, holder, now + ttl, now)
+        return current == holder
+
+    async def release_lease(self, name, holder):
+        await self._pool.execute('DELETE FROM leases WHERE name = $1 AND holder = $2', name, holder)
+
+    async def bump_generation(self, name):
+        return await self._pool.fetchval(POSTGRES_BUMP_GENERATION_SQL + ' RETURNING value', name)
+
+    async def get_generation(self, name):
+        return await self._pool.fetchval('SELECT value FROM generations WHERE name = $1', name) or 0
+
+    async def get_assigned_proxies_and_language_code(self, user_id):
+        records = await self._pool.fetch(f'''
+        SELECT u.language_code, {POSTGRES_PROXY_INFO_COLUMNS}
+        FROM users u
+        LEFT JOIN user_proxies up ON up.user_id = u.user_id AND up.expires_at > $2
+        LEFT JOIN proxies p ON p.id = up.proxy_id
+        WHERE u.user_id = $1
+        ORDER BY up.assigned_at
+        ''', user_id, time.time())
+        if not records:
+            return [], None
+        return [proxy_info(tuple(r)[1:]) for r in records if r['proxy'] is not None], records[0]['language_code']
+
+    async def assign_proxy(self, user_id, new_proxy, language_code, expires_at):
+        async with self._pool.acquire() as db:
+            async with db.transaction():
+                await db.execute('''
+                INSERT INTO users (user_id, language_code) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET language_code = excluded.language_code
+                ''', user_id, language_code)
+                if not new_proxy:
+                    return False, []
+                # xmax is 0 only for a row this statement inserted.
+                acquired = await db.fetchval('''
+                INSERT INTO user_proxies (user_id, proxy_id, assigned_at, expires_at)
+                SELECT $1, id, $2, $3 FROM proxies WHERE proxy = $4
+                ON CONFLICT (user_id, proxy_id) DO UPDATE SET expires_at = excluded.expires_at
+                RETURNING xmax = 0
+                ''', user_id, time.time(), expires_at, new_proxy)
+                released = await db.fetch('''
+                DELETE FROM user_proxies up USING proxies p
+                WHERE up.user_id = $1 AND p.id = up.proxy_id AND up.proxy_id NOT IN (
+                    SELECT proxy_id FROM user_proxies WHERE user_id = $1 ORDER BY assigned_at DESC LIMIT $2
+                )
+                RETURNING p.proxy
+                ''', user_id, MAX_ASSIGNED_PROXIES)
+        return bool(acquired), [record['proxy'] for record in released]
+
+    async def expire_assignments(self, now, limit):
+        records = await self._pool.fetch('''
+        WITH expired AS (
+            SELECT user_id, proxy_id FROM user_proxies WHERE expires_at <= $1 ORDER BY expires_at LIMIT $2
+        )
+        DELETE FROM user_proxies up USING expired e, proxies p
+        WHERE up.user_id = e.user_id AND up.proxy_id = e.proxy_id AND p.id = up.proxy_id
+        RETURNING up.user_id, p.proxy
+        ''', now, limit)
+        return [(record['user_id'], record['proxy']) for record in records]
+
+    async def get_holder_counts(self):
+        records = await self._pool.fetch('''
+        SELECT p.proxy, COUNT(*) FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id GROUP BY p.proxy
+        ''')
+        return {record[0]: record[1] for record in records}
+
+    async def get_users_holding(self, proxies, now):
+        records = await self._pool.fetch('''
+        SELECT up.user_id, p.proxy FROM user_proxies up JOIN proxies p ON p.id = up.proxy_id
+        WHERE up.expires_at > $2 AND up.user_id IN (
+            SELECT h.user_id FROM proxies d JOIN user_proxies h ON h.proxy_id = d.id
+            WHERE d.proxy = ANY($1::text[]) AND h.expires_at > $2
+        )
+        ORDER BY up.user_id, up.assigned_at
+        ''', list(proxies), now)
+        holders = {}
+        for record in records:
+            holders.setdefault(record['user_id'], []).append(record['proxy'])
+        return holders
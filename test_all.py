@@ -1,129 +1,100 @@
 import os
+import json
+import random
 from import_proxies import *
 from handlers import *
 from bot import *
+import config
+import db_utils
 from db_utils import *
+import maintenance
+import storage
+from storage import MemoryStore, PostgresStore
+from proxy_index import AliveIndex, proxy_score
+from records import ProxyRecord, ProxyColumns
+import health_check
+import events
+from events import bus
+import webhook
+from telebot.types import Update
+from render import ProxyCardCache
+import time
+from fetcher import Fetcher, ProxyscrapeSource, PlainTextSource, RowDecoder, backoff_delay, iter_proxy_records
 import pytest
+import pytest_asyncio
 import aiosqlite
-from unittest.mock import patch, AsyncMock
-
-# Fixture to mock get_db_path function
-@pytest.fixture
-async def mock_get_db_path(monkeypatch):
-    mock_path = AsyncMock(return_value='path/to/proxies.db')
-    monkeypatch.setattr('db_utils.get_db_path', mock_path)
-    return mock_path
+import aiohttp
+import sqlite3
+from unittest.mock import patch, AsyncMock, Mock
+
+# Every storage backend must pass the tests taking the ``store`` fixture.
+# Set TEST_POSTGRES_DSN to an empty scratch database to include PostgresStore
+# (pip install -r requirements-postgres.txt); its tables are dropped first.
+STORE_BACKENDS = ('sqlite', 'memory', 'postgres')
+
+@pytest_asyncio.fixture(params=STORE_BACKENDS)
+async def store(request, monkeypatch, tmp_path):
+    async def fake_get_db_path(db_name):
+        return str(tmp_path / f'{db_name}.db')
+    monkeypatch.setattr('db_utils.get_db_path', fake_get_db_path)
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    if request.param == 'postgres':
+        dsn = os.environ.get('TEST_POSTGRES_DSN')
+        if not dsn:
+            pytest.skip('set TEST_POSTGRES_DSN to test PostgresStore')
+        backend = PostgresStore(dsn)
+    else:
+        backend = db_utils.create_store(request.param)
+    monkeypatch.setattr('db_utils.store', backend)
+    await backend.open()
+    try:
+        if request.param == 'postgres':
+            await backend._pool.execute('DROP TABLE IF EXISTS user_proxies, users, proxy_geo, proxy_facets, proxies, leases, generations')
+        await init_db()
+        await create_users_table()
+        yield backend
+    finally:
+        await backend.close()
 
 # Tests for db_utils.py
 @pytest.mark.asyncio
-async def test_init_db(mock_get_db_path):
-    """Test the init_db function.
-    The test uses AsyncMock to mock the database connection.
-    It patches aiosqlite.connect to return a mock database.
-    It checks if execute and commit methods are called once each. """
-    mock_db = AsyncMock()
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        await init_db()
-    mock_db.execute.assert_called_once()
-    mock_db.commit.assert_called_once()
-
-@pytest.mark.asyncio
-async def test_get_active_proxy(mock_get_db_path):
-    """Test the get_active_proxy function.
-    Mocks the database cursor to return a predefined proxy.
-    Checks if the function correctly retrieves and returns the active proxy."""
-    mock_cursor = AsyncMock()
-    mock_cursor.fetchone.return_value = ('http://example.com:8080',)
-
-    mock_db = AsyncMock()
-    mock_db.execute.return_value = AsyncMock(__aenter__=AsyncMock(return_value=mock_cursor))
-
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        proxy = await get_active_proxy()
-
-    assert proxy == 'http://example.com:8080'
-
-@pytest.mark.asyncio
-async def test_replace_proxy(mock_get_db_path):
-    """
-    Test the replace_proxy function.
-    This test verifies that the function correctly replaces an old proxy with a new one from the database.
-    """
-    # Mock data that simulates a database record
-    mock_db_record = (
-        'http://example.com:8080',
-        'active',
-        True,
-        1623456789,
-        'high',
-        0.5,
-        1623400000,
-        '192.168.1.1',
-        'AS12345',
-        'Example ISP',
-        'New York',
-        'North America',
-        'United States',
-        'US',
-        'Example ISP',
-        'Example Organization',
-        'New York',
-        1623456789,
-        8080,
-        'http',
-        False,
-        1.0,
-        100,
-        0,
-        99.9,
-        'America/New_York',
-        '10001'
-    )
-
-    # Set up the mock cursor
-    mock_cursor = AsyncMock()
-    mock_cursor.fetchone.return_value = mock_db_record
-
-    # Set up the mock database connection
-    mock_db = AsyncMock()
-    mock_db.execute.return_value = AsyncMock(__aenter__=AsyncMock(return_value=mock_cursor))
+async def test_init_db(store):
+    """Test that init_db can run again on an existing store and starts out empty."""
+    await init_db()
+    assert await get_active_proxy() is None
+    assert await get_alive_proxies() == []
+    assert await get_generation(PROXIES_GENERATION) == 0
 
-    # Patch the database connection
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        # Call the function we're testing
-        new_proxy = await replace_proxy(1234, ['http://old-proxy.com:8080'])
-
-    # Assert that the function returns the correct proxy
-    assert new_proxy == 'http://example.com:8080'
-
-    # Verify that the correct SQL query was executed
-    mock_db.execute.assert_called_with(
-        'SELECT proxy FROM proxies WHERE alive = 1 AND proxy NOT IN (?) ORDER BY RANDOM() LIMIT 1',
-        ('http://old-proxy.com:8080',)
-    )
-
-    # Test the case when no new proxy is found
-    mock_cursor.fetchone.return_value = None
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        new_proxy = await replace_proxy(1234, ['http://old-proxy.com:8080'])
-
-    # Assert that the function returns None when no new proxy is found
-    assert new_proxy is None
+@pytest.mark.asyncio
+async def test_get_active_proxy(store):
+    """Test that get_active_proxy returns a listed proxy, and None once all are dropped."""
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    assert await get_active_proxy() in {'http://1.1.1.1:8080', 'http://2.2.2.2:8080'}
+    await store.import_proxies([make_proxy_data('2.2.2.2')])
+    assert await get_active_proxy() == 'http://2.2.2.2:8080'
 
-    # Verify that the fallback query was executed
-    mock_db.execute.assert_called_with(
-        'SELECT proxy FROM proxies WHERE alive = 1 ORDER BY RANDOM() LIMIT 1'
-    )
+@pytest.mark.asyncio
+async def test_replace_proxy(store):
+    """Test the store's fallback pick, used before the alive index is loaded."""
+    await import_proxies([
+        make_proxy_data('1.1.1.1'),
+        make_proxy_data('2.2.2.2'),
+        make_proxy_data('3.3.3.3', alive=False),
+        make_proxy_data('4.4.4.4', protocol='socks5'),
+    ])
+    for _ in range(10):
+        assert await replace_proxy(1234, ['http://1.1.1.1:8080', 'socks5://4.4.4.4:8080']) == 'http://2.2.2.2:8080'
+    # With every alive proxy excluded, any alive one will do.
+    excluded = ['http://1.1.1.1:8080', 'http://2.2.2.2:8080', 'socks5://4.4.4.4:8080']
+    assert await replace_proxy(1234, excluded) in excluded
+    assert await replace_proxy(1234, [], {'protocol': 'socks5'}) == 'socks5://4.4.4.4:8080'
+    assert await replace_proxy(1234, [], {'protocol': 'socks4'}) is None
 
 @pytest.mark.asyncio
-async def test_create_users_table(mock_get_db_path):
-    """Test the create_users_table function.
-    Similar to test_init_db, it checks if the SQL execution and commit are called."""
-    mock_db = AsyncMock()
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        await create_users_table()
-    mock_db.execute.assert_called_once()
-    mock_db.commit.assert_called_once()
+async def test_create_users_table(store):
+    """Test that create_users_table can run again and unknown users have nothing assigned."""
+    await create_users_table()
+    assert await get_assigned_proxies_and_language_code(1234) == ([], None)
 
 @pytest.mark.asyncio
 async def test_main(monkeypatch):
@@ -179,17 +150,41 @@ async def test_fetch_proxies(monkeypatch):
     assert proxies == [{'proxy': 'http://example.com:8080'}]
 
 @pytest.mark.asyncio
-async def test_import_proxies(mock_get_db_path):
-    """Test the import_proxies function."""
-    # This test checks if the import_proxies function correctly
-    # inserts proxy data into the database.
-    mock_db = AsyncMock()
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        await import_proxies([{'proxy': 'http://example.com:8080'}])
-    
-    # Verify that execute and commit are called
-    mock_db.execute.assert_called()
-    mock_db.commit.assert_called_once()
+async def test_import_proxies(store):
+    """Test what a store reports and keeps across new, changed, unchanged, dropped and relisted proxies."""
+    first = [make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2'), make_proxy_data('3.3.3.3', alive=False)]
+    result = await store.import_proxies(first)
+    assert result['imported'] == 3
+    assert sorted(result['inserted']) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080', 'http://3.3.3.3:8080']
+    assert sorted(await get_alive_proxies()) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080']
+
+    assert await store.import_proxies(first) == {'imported': 3, 'inserted': [], 'updated': [], 'removed': []}
+
+    result = await store.import_proxies([make_proxy_data('1.1.1.1', timeout=50.0), make_proxy_data('3.3.3.3')])
+    assert result['inserted'] == [] and result['removed'] == ['http://2.2.2.2:8080']
+    assert sorted(result['updated']) == ['http://1.1.1.1:8080', 'http://3.3.3.3:8080']
+    assert sorted(await get_listed_proxies()) == ['http://1.1.1.1:8080', 'http://3.3.3.3:8080']
+    assert (await get_proxy_info('http://1.1.1.1:8080')).latency == 50.0
+    assert (await get_proxy_info('http://2.2.2.2:8080')).proxy == 'http://2.2.2.2:8080'
+    assert await get_proxy_info('http://9.9.9.9:8080') is None
+
+    # An empty fetch leaves everything listed; a dropped proxy coming back counts as new.
+    assert (await store.import_proxies([]))['removed'] == []
+    result = await store.import_proxies([make_proxy_data('1.1.1.1', timeout=50.0), make_proxy_data('2.2.2.2'), make_proxy_data('3.3.3.3')])
+    assert result['inserted'] == ['http://2.2.2.2:8080'] and result['updated'] == []
+    assert sorted(await get_alive_proxies()) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080', 'http://3.3.3.3:8080']
+
+def test_fingerprint_is_the_same_in_every_process():
+    """Test that volatile field fingerprints survive restarts, which salt str hashes differently."""
+    import subprocess
+    import sys
+    values = storage.volatile_values(storage.proxy_row(make_proxy_data('1.1.1.1'), 0))
+    code = f'from storage import fingerprint; print(fingerprint({values!r}))'
+    digests = {subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                              env=dict(os.environ, PYTHONHASHSEED=seed)).stdout.strip() for seed in ('1', '2')}
+    assert digests == {str(storage.fingerprint(values))}
+    assert storage.fingerprint((True, 120, 'elite')) == storage.fingerprint((True, 120.0, 'elite'))
+    assert storage.fingerprint((True, 120, 'elite')) != storage.fingerprint((True, 121, 'elite'))
 
 @pytest.mark.asyncio
 async def test_callback_query(monkeypatch):
@@ -274,6 +269,20 @@ async def test_periodic_update(monkeypatch):
 
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('imported, committed', [(1, 1), (0, 0)])
+async def test_periodic_update_commits_the_fetch_only_after_an_import(monkeypatch, imported, committed):
+    """Test that a failed import (0 records) leaves the fetch uncommitted, so the next cycle retries it."""
+    commit = Mock()
+    monkeypatch.setattr('import_proxies.fetch_proxies', AsyncMock(return_value=[{'proxy': 'http://example.com:8080'}]))
+    monkeypatch.setattr('import_proxies.import_proxies', AsyncMock(return_value=imported))
+    monkeypatch.setattr('import_proxies.rebuild_alive_index', AsyncMock(return_value=0))
+    monkeypatch.setattr('import_proxies.commit_fetch', commit)
+    monkeypatch.setattr('import_proxies.asyncio.sleep', AsyncMock(side_effect=asyncio.CancelledError))
+    with pytest.raises(asyncio.CancelledError):
+        await periodic_update()
+    assert commit.call_count == committed
+
 @pytest.mark.asyncio
 async def test_handle_start(monkeypatch):
     """Test the handle_start function."""
@@ -324,43 +333,1436 @@ async def test_get_db_path():
     assert actual_path == expected_path
 
 @pytest.mark.asyncio
-async def test_get_assigned_proxies_and_language_code(mock_get_db_path):
-    """Test the get_assigned_proxies_and_language_code function."""
-    # This test verifies that the function correctly retrieves
-    # assigned proxies and language code for a user.
-    mock_cursor = AsyncMock()
-    mock_cursor.fetchone.side_effect = [('http://example.com:8080', 'en'), None]
+async def test_get_assigned_proxies_and_language_code(store):
+    """Test that a user's proxies come back as cards, oldest first, with the language code."""
+    await import_proxies([make_proxy_data('1.1.1.1', anonymity='anonymous', ssl=True), make_proxy_data('2.2.2.2')])
+    await assign_proxy(1234, 'http://1.1.1.1:8080', 'en')
+    await assign_proxy(1234, 'http://2.2.2.2:8080', 'en')
+    await assign_proxy(5678, None, 'de')
+
+    assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
+    assert assigned_proxies[0] == ProxyRecord(
+        'http://1.1.1.1:8080', 'http', '1.1.1.1', 8080, 'DE', 'Germany', 'anonymous', True, 100.0, 1700000000.0)
+    assert assigned_proxies[0].https == 'Yes'
+    assert [proxy.proxy for proxy in assigned_proxies] == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080']
+    assert language_code == 'en'
+    assert await get_assigned_proxies_and_language_code(5678) == ([], 'de')
+    assert await get_assigned_proxies_and_language_code(9999) == ([], None)
 
-    mock_db = AsyncMock()
-    mock_db.execute.return_value = AsyncMock(__aenter__=AsyncMock(return_value=mock_cursor))
+@pytest.mark.asyncio
+async def test_assign_proxy(store):
+    """Test that assign_proxy keeps the MAX_ASSIGNED_PROXIES newest and ignores repeats and unknown proxies."""
+    await import_proxies([make_proxy_data(f'1.1.1.{i}') for i in range(5)])
+    for i in range(5):
+        await assign_proxy(1234, f'http://1.1.1.{i}:8080', 'de')
+        await asyncio.sleep(0.001)
+    await assign_proxy(1234, 'http://1.1.1.3:8080', 'en')
+    await assign_proxy(1234, 'http://9.9.9.9:8080', 'en')
+
+    assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
+    assert [proxy.proxy for proxy in assigned_proxies] == ['http://1.1.1.2:8080', 'http://1.1.1.3:8080', 'http://1.1.1.4:8080']
+    assert language_code == 'en'
 
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
-        assert assigned_proxies == [{'proxy': 'http://example.com:8080', 'protocol': 'http', 'ip': '127.0.0.1', 'port': 8080, 'country_code': 'US', 'country': 'United States', 'anonymity': 'anonymous', 'https': 'No', 'latency': 100, 'last_checked': 1234567890}]
-        assert language_code == 'en'
+@pytest.mark.asyncio
+async def test_import_snapshot_is_reread_after_another_worker_imported(temp_db_path):
+    """Test that leadership moving A -> B -> A does not leave B's vanished proxies listed or skip B's changes."""
+    a, b = SQLiteStore(), SQLiteStore()
+    await init_db()
+    await a.import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    await b.import_proxies([make_proxy_data('1.1.1.1', timeout=50.0), make_proxy_data('2.2.2.2'), make_proxy_data('3.3.3.3')])
+    result = await a.import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    assert result['removed'] == ['http://3.3.3.3:8080'] and result['updated'] == ['http://1.1.1.1:8080']
+    assert sorted(await get_listed_proxies()) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080']
+    assert (await get_proxy_info('http://1.1.1.1:8080')).latency == 100.0
+
+    # A worker stepping down forgets its snapshot.
+    cluster = Cluster(holder='a')
+    with patch('db_utils.store', a):
+        await cluster._step_down()
+    assert a._snapshots == {}
 
-        assigned_proxies, language_code = await get_assigned_proxies_and_language_code(5678)
+@pytest.mark.asyncio
+async def test_store_record_checks_and_leases(store):
+    """Test health check results, the alive index entries, leases and generation counters on every store."""
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    generation = await get_generation(PROXIES_GENERATION)
+    assert await record_checks([(False, None, time.time(), 'http://1.1.1.1:8080'), (True, 42.0, time.time(), 'http://2.2.2.2:8080')]) == 1
+    assert await get_generation(PROXIES_GENERATION) == generation  # once per run, in finish_checks
+    await finish_checks()
+    assert await get_generation(PROXIES_GENERATION) == generation + 1
+    assert await get_alive_proxies() == ['http://2.2.2.2:8080']
+    assert sorted(await get_listed_proxies()) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080']
+    [(record, latency, quality)] = await get_alive_index_entries()
+    assert (record.proxy, record.latency, latency, record.country_code) == ('http://2.2.2.2:8080', 42.0, 42.0, 'DE')
+    # Upstream data older than our check does not revive the proxy.
+    await store.import_proxies([make_proxy_data('1.1.1.1', timeout=70.0), make_proxy_data('2.2.2.2')])
+    assert await get_alive_proxies() == ['http://2.2.2.2:8080']
+
+    assert await acquire_lease('leader', 'a', ttl=0.2)
+    assert not await acquire_lease('leader', 'b', ttl=0.2)
+    await release_lease('leader', 'a')
+    assert await acquire_lease('leader', 'b', ttl=0.2)
+    assert await bump_generation('other') == 1
+
+def test_incomplete_store_cannot_be_instantiated():
+    """Test that a backend missing part of the store interface fails when created, not on first use."""
+    class HalfStore(storage.ProxyStore, storage.UserStore):
+        async def init_proxies(self):
+            pass
+
+    with pytest.raises(TypeError, match='abstract'):
+        HalfStore()
+    SQLiteStore()
+    MemoryStore()
+    PostgresStore('postgresql://localhost/proxies')
+
+@pytest.mark.asyncio
+async def test_memory_store_snapshot_round_trip(tmp_path, monkeypatch):
+    """Test that a MemoryStore reopened from its snapshot has the same proxies and users."""
+    path = str(tmp_path / 'store.pickle')
+    first = MemoryStore(path, snapshot_interval=None)
+    monkeypatch.setattr('db_utils.store', first)
+    await first.open()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    await assign_proxy(1234, 'http://1.1.1.1:8080', 'en')
+    await first.close()
+
+    second = MemoryStore(path, snapshot_interval=None)
+    monkeypatch.setattr('db_utils.store', second)
+    await second.open()
+    assert sorted(await get_alive_proxies()) == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080']
+    assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
+    assert [proxy.proxy for proxy in assigned_proxies] == ['http://1.1.1.1:8080'] and language_code == 'en'
+    assert (await second.import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')]))['updated'] == []
+    await second.close()
+
+
+# Fixture pointing every database, and the alive index snapshot next to them,
+# at a temporary directory; autouse, so no test touches proxies.db in the repository.
+@pytest.fixture(autouse=True)
+def temp_db_path(monkeypatch, tmp_path):
+    async def fake_get_db_path(db_name):
+        return str(tmp_path / f'{db_name}.db')
+    monkeypatch.setattr('db_utils.get_db_path', fake_get_db_path)
+    return tmp_path
+
+@pytest.mark.asyncio
+async def test_connection_pool_reuses_connections(temp_db_path):
+    """Test that pooled queries run in WAL mode without opening new connections."""
+    await open_pools()
+    try:
+        await init_db()
+        await create_users_table()
+        with patch('aiosqlite.connect') as mock_connect:
+            await assign_proxy(1234, None, 'en')
+            assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
+            assert await replace_proxy(1234, []) is None
+        mock_connect.assert_not_called()
         assert assigned_proxies == []
-        assert language_code is None
+        assert language_code == 'en'
+
+        async with read_connection('proxies') as db:
+            async with db.execute('PRAGMA journal_mode') as cursor:
+                assert (await cursor.fetchone())[0] == 'wal'
+    finally:
+        await close_pools()
+
+def make_proxy_data(ip, port=8080, protocol='http', alive=True, timeout=100.0, **fields):
+    """Build a proxy record shaped like the proxyscrape API response."""
+    data = {
+        'proxy': f'{protocol}://{ip}:{port}',
+        'alive': alive,
+        'anonymity': 'elite',
+        'ip': ip,
+        'port': port,
+        'protocol': protocol,
+        'ssl': False,
+        'timeout': timeout,
+        'average_timeout': timeout,
+        'uptime': 99.0,
+        'times_alive': 10,
+        'times_dead': 1,
+        'last_seen': 1700000000.0,
+        'ip_data': {'country': 'Germany', 'countryCode': 'DE', 'as': 'AS1', 'asname': 'Example'},
+    }
+    data.update(fields)
+    return data
+
+@pytest.mark.asyncio
+async def test_init_db_dedupes_existing_proxies(temp_db_path):
+    """Test that the migration removes duplicate rows and enforces unique proxies."""
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        await db.execute('CREATE TABLE proxies (id INTEGER PRIMARY KEY AUTOINCREMENT, proxy TEXT NOT NULL, status TEXT NOT NULL, alive BOOLEAN NOT NULL, alive_since REAL, anonymity TEXT, average_timeout REAL, first_seen REAL, ip TEXT, as_value TEXT, asname TEXT, city TEXT, continent TEXT, country TEXT, country_code TEXT, isp TEXT, org TEXT, region_name TEXT, last_seen REAL, port INTEGER, protocol TEXT, ssl BOOLEAN, timeout REAL, times_alive INTEGER, times_dead INTEGER, uptime REAL, timezone TEXT, zip_code TEXT)')
+        for timeout in (100, 200):
+            await db.execute('INSERT INTO proxies (proxy, status, alive, timeout) VALUES (?, ?, ?, ?)', ('http://1.1.1.1:80', 'active', 1, timeout))
+        await db.commit()
+
+    await init_db()
+
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT proxy, timeout FROM proxies') as cursor:
+            assert await cursor.fetchall() == [('http://1.1.1.1:80', 200)]
+        with pytest.raises(sqlite3.IntegrityError):
+            await db.execute('INSERT INTO proxies (proxy, status, alive) VALUES (?, ?, ?)', ('http://1.1.1.1:80', 'active', 1))
+
+@pytest.mark.asyncio
+async def test_import_proxies_upserts_and_marks_missing_dead(temp_db_path):
+    """Test that repeated imports update rows in place and retire missing proxies."""
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    await import_proxies([make_proxy_data('1.1.1.1', timeout=50.0)])
+
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT proxy, status, alive, timeout FROM proxies ORDER BY proxy') as cursor:
+            rows = await cursor.fetchall()
+    assert rows == [
+        ('http://1.1.1.1:8080', 'active', 1, 50.0),
+        ('http://2.2.2.2:8080', 'dead', 0, 100.0),
+    ]
+
+@pytest.mark.asyncio
+async def test_iter_proxy_records_handles_split_chunks():
+    """Test that the streaming parser yields every record whatever the chunk boundaries."""
+    records = [make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2', ip_data={'country': 'Österreich'})]
+    payload = json.dumps({'shown_records': 2, 'proxies': records}, ensure_ascii=False).encode('utf-8')
+
+    for size in (1, 7, len(payload)):
+        async def chunks():
+            for i in range(0, len(payload), size):
+                yield payload[i:i + size]
+        assert [record async for record in iter_proxy_records(chunks())] == records
+
+    async def truncated():
+        yield payload[:-10]
+    with pytest.raises(ValueError):
+        [record async for record in iter_proxy_records(truncated())]
+
+@pytest.mark.asyncio
+async def test_import_proxies_in_batches(temp_db_path, monkeypatch):
+    """Test that import_proxies writes chunks with executemany and skips malformed records."""
+    monkeypatch.setattr('db_utils.IMPORT_BATCH_SIZE', 2)
+    await init_db()
+
+    async def records():
+        for i in range(5):
+            yield make_proxy_data(f'10.0.0.{i}')
+        yield {'alive': True}
+
+    assert await import_proxies(records()) == 5
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT COUNT(*) FROM proxies WHERE alive = 1') as cursor:
+            assert (await cursor.fetchone())[0] == 5
+
+def test_alive_index_sample_excludes_assigned():
+    """Test O(1) removal and that sampling skips the user's proxies while others remain."""
+    index = AliveIndex()
+    index.replace(['a', 'b', 'c', 'd'])
+    index.discard('b')
+    index.discard('missing')
+    assert len(index) == 3 and 'b' not in index
+    for _ in range(50):
+        assert index.sample(['a', 'c']) == 'd'
+    assert index.sample(['a', 'c', 'd']) in {'a', 'c', 'd'}
+    assert AliveIndex().sample() is None
+
+@pytest.mark.asyncio
+async def test_replace_proxy_uses_alive_index(temp_db_path, monkeypatch):
+    """Test that replace_proxy serves from the rebuilt index without querying SQL."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2'), make_proxy_data('3.3.3.3', alive=False)])
+    assert await rebuild_alive_index() == 2
+
+    with patch('aiosqlite.connect') as mock_connect:
+        new_proxy = await replace_proxy(1234, ['http://1.1.1.1:8080'])
+    mock_connect.assert_not_called()
+    assert new_proxy == 'http://2.2.2.2:8080'
+
+@pytest.mark.asyncio
+async def test_assign_proxy_keeps_three_newest(temp_db_path):
+    """Test that assignments live in user_proxies and rotate after three proxies."""
+    await init_db()
+    await create_users_table()
+    await import_proxies([make_proxy_data(f'1.1.1.{i}') for i in range(5)])
+
+    for i in range(5):
+        await assign_proxy(1234, f'http://1.1.1.{i}:8080', 'de')
+    await assign_proxy(1234, 'http://1.1.1.3:8080', 'en')
+
+    assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1234)
+    assert [proxy.proxy for proxy in assigned_proxies] == ['http://1.1.1.2:8080', 'http://1.1.1.3:8080', 'http://1.1.1.4:8080']
+    assert assigned_proxies[-1].country_code == 'DE'
+    assert language_code == 'en'
+
+@pytest.mark.asyncio
+async def test_create_users_table_migrates_legacy_users(temp_db_path):
+    """Test that comma-separated assignments in users.db are moved into user_proxies."""
+    async with aiosqlite.connect(str(temp_db_path / 'users.db')) as db:
+        await db.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, assigned_proxies TEXT, language_code TEXT)')
+        await db.execute('INSERT INTO users (user_id, assigned_proxies, language_code) VALUES (?, ?, ?)', (1, 'http://1.1.1.1:8080', 'ru'))
+        await db.execute('INSERT INTO users (user_id, assigned_proxies, language_code) VALUES (?, ?, ?)', (1, 'http://2.2.2.2:8080,http://1.1.1.1:8080,http://gone:1', 'en'))
+        await db.execute('INSERT INTO users (user_id, assigned_proxies, language_code) VALUES (?, ?, ?)', (2, '', None))
+        await db.commit()
+
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    await create_users_table()
+
+    assigned_proxies, language_code = await get_assigned_proxies_and_language_code(1)
+    assert [proxy.proxy for proxy in assigned_proxies] == ['http://2.2.2.2:8080', 'http://1.1.1.1:8080']
+    assert language_code == 'en'
+    assert await get_assigned_proxies_and_language_code(2) == ([], None)
+    assert await get_assigned_proxies_and_language_code(3) == ([], None)
+    assert not (temp_db_path / 'users.db').exists()
+
+async def start_fake_proxy(protocol, accept=True):
+    """Start a local server that answers the given proxy handshake."""
+    async def handle(reader, writer):
+        try:
+            if protocol == 'http':
+                await reader.readuntil(b'\r\n\r\n')
+                writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n' if accept else b'HTTP/1.1 403 Forbidden\r\n\r\n')
+            elif protocol == 'socks4':
+                await reader.readuntil(b'\x00')
+                await reader.readuntil(b'\x00')
+                writer.write(b'\x00' + (b'\x5a' if accept else b'\x5b') + b'\x00' * 6)
+            elif protocol == 'socks5':
+                await reader.readexactly(3)
+                writer.write(b'\x05\x00')
+                header = await reader.readexactly(5)
+                await reader.readexactly(header[4] + 2)
+                writer.write(b'\x05' + (b'\x00' if accept else b'\x05') + b'\x00\x01' + b'\x00' * 6)
+            await writer.drain()
+            await reader.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+@pytest.mark.asyncio
+async def test_check_proxies_against_fake_servers(temp_db_path, monkeypatch):
+    """Test per-protocol handshakes and that results are written back in batches."""
+    index = AliveIndex()
+    monkeypatch.setattr('db_utils.alive_index', index)
+    servers = []
+    proxies = []
+    for protocol, accept in (('http', True), ('socks4', True), ('socks5', True), ('socks5', False), ('http', False)):
+        server, port = await start_fake_proxy(protocol, accept)
+        servers.append(server)
+        proxies.append(make_proxy_data('127.0.0.1', port=port, protocol=protocol, alive=not accept, timeout=9999.0))
+    closed_server, closed_port = await start_fake_proxy('http')
+    closed_server.close()
+    await closed_server.wait_closed()
+    proxies.append(make_proxy_data('127.0.0.1', port=closed_port, protocol='socks4', alive=True))
+
+    await init_db()
+    await import_proxies(proxies)
+    index.replace(p['proxy'] for p in proxies)
+    generation = await get_generation(PROXIES_GENERATION)
+    try:
+        report = await health_check.check_proxies([p['proxy'] for p in proxies], concurrency=3, batch_size=2, timeout=2)
+        # Three batches, one facet recount and generation bump; none when nothing went alive or dead.
+        assert report['changed'] == 6 and await get_generation(PROXIES_GENERATION) == generation + 1
+        again = await health_check.check_proxies([p['proxy'] for p in proxies], concurrency=3, batch_size=2, timeout=2)
+        assert again['changed'] == 0 and await get_generation(PROXIES_GENERATION) == generation + 1
+    finally:
+        for server in servers:
+            server.close()
+
+    assert report['probed'] == 6 and report['alive'] == 3
+    assert report['p50_ms'] is not None and report['probes_per_sec'] > 0
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT proxy, alive, timeout < 9999, checked_at IS NOT NULL FROM proxies') as cursor:
+            rows = {row[0]: row[1:] for row in await cursor.fetchall()}
+    assert [rows[p['proxy']] for p in proxies] == [(1, 1, 1), (1, 1, 1), (1, 1, 1), (0, 0, 1), (0, 0, 1), (0, 1, 1)]
+    await bus.drain()
+    assert len(index) == 3
+
+def test_alive_index_weighted_and_filtered_sampling():
+    """Test that fast proxies are picked more often and filters are honoured."""
+    random.seed(1)
+    index = AliveIndex()
+    index.replace([
+        (ProxyRecord('http://fast:1', 'http', country_code='de', anonymity='elite'), 50, 1.0),
+        (ProxyRecord('http://slow:1', 'http', country_code='US', anonymity='elite'), 20000, 1.0),
+        (ProxyRecord('socks5://a:1', 'socks5', country_code='DE', anonymity='anonymous'), 100, 0.5),
+    ])
+    picks = [index.sample(protocol='http') for _ in range(1000)]
+    assert set(picks) == {'http://fast:1', 'http://slow:1'}
+    assert picks.count('http://fast:1') > 10 * picks.count('http://slow:1')
+
+    assert index.sample(country_code='de', anonymity='anonymous') == 'socks5://a:1'
+    assert index.sample(['socks5://a:1'], protocol='SOCKS5') == 'socks5://a:1'
+    assert index.sample(country_code='FR') is None
+    assert index.count(country_code='DE') == 2
+
+    index.update_latency('http://slow:1', 10)
+    index.discard('http://fast:1')
+    assert {index.sample(protocol='http') for _ in range(20)} == {'http://slow:1'}
+    with pytest.raises(ValueError):
+        index.sample(port=80)
+
+def test_alive_index_rare_filter_combination_without_scans(monkeypatch):
+    """Test that a filter combination matching under 1% of the index is picked from its own set, never a scan."""
+    random.seed(2)
+    index = AliveIndex()
+    # Each facet alone matches half the index; all three together match 0.5%.
+    entries = [(ProxyRecord(f'http://{i}:1', ('socks4', 'http')[i % 2], country_code=('JP', 'US')[i // 2 % 2],
+                            anonymity=('transparent', 'elite')[i // 4 % 2]), 100, 1.0) for i in range(8000)]
+    entries += [(ProxyRecord(f'socks4://rare{i}:1', 'socks4', country_code='JP', anonymity='transparent'), 100, 1.0) for i in range(40)]
+    for record, _, _ in entries[:8000]:
+        if (record.protocol, record.country_code, record.anonymity) == ('socks4', 'JP', 'transparent'):
+            record.anonymity = 'anonymous'
+    index.replace(entries)
+    rare = {f'socks4://rare{i}:1' for i in range(40)}
+    filters = dict(protocol='socks4', country_code='jp', anonymity='transparent')
+    assert index.count(**filters) == 40 and index.sample(**filters) in rare
+
+    calls = []
+    matches = AliveIndex._matches
+    monkeypatch.setattr(AliveIndex, '_matches', lambda self, proxy, f: calls.append(proxy) or matches(self, proxy, f))
+    assert {index.sample(**filters) for _ in range(300)} == rare
+    # All but one excluded: the excluded keys are weighed out instead of scanned past.
+    assert {index.sample(sorted(rare)[1:], **filters) for _ in range(20)} == {sorted(rare)[0]}
+    assert index.sample(rare, **filters) in rare
+    index.discard('socks4://rare0:1')
+    index.add(ProxyRecord('socks4://late:1', 'socks4', country_code='JP', anonymity='transparent'), 100, 1.0)
+    index.acquire('socks4://late:1')
+    assert index.count(**filters) == 40 and 'socks4://rare0:1' not in {index.sample(**filters) for _ in range(300)}
+    combined = index._combinations[(('protocol', 'socks4'), ('country_code', 'JP'), ('anonymity', 'transparent'))]
+    assert combined.weight('socks4://late:1') == index._all.weight('socks4://late:1') < combined.weight('socks4://rare1:1')
+    assert calls == []
+
+def test_parse_proxy_filters():
+    """Test that /get_proxy arguments are mapped to filters."""
+    assert parse_proxy_filters(['SOCKS5', 'de', 'Elite']) == {'protocol': 'socks5', 'country_code': 'DE', 'anonymity': 'elite'}
+    assert parse_proxy_filters([]) == {}
+    with pytest.raises(ValueError):
+        parse_proxy_filters(['fastest'])
+
+@pytest.mark.asyncio
+async def test_replace_proxy_with_filters(temp_db_path, monkeypatch):
+    """Test filtered picks from both the cold SQL path and the loaded index."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2', protocol='socks5')])
+
+    assert await replace_proxy(1, [], {'protocol': 'socks5'}) == 'socks5://2.2.2.2:8080'
+    await rebuild_alive_index()
+    assert await replace_proxy(1, [], {'protocol': 'socks5', 'country_code': 'de'}) == 'socks5://2.2.2.2:8080'
+    assert await replace_proxy(1, [], {'protocol': 'socks4'}) is None
+
+def make_update(update_id, chat_id, text='/start'):
+    """Build a Telegram message update as sent to the webhook."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1700000000,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'},
+            'text': text,
+        },
+    }
+
+class RecordingBot:
+    """Stand-in for AsyncTeleBot that records the order updates are processed in."""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def process_new_updates(self, updates):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.processed.extend((u.message.chat.id, u.update_id) for u in updates)
+        self.running -= 1
+
+@pytest.mark.asyncio
+async def test_update_dispatcher_orders_per_chat_and_caps_concurrency():
+    """Test that each chat's updates run in order while chats run in parallel up to the cap."""
+    bot = RecordingBot()
+    dispatcher = webhook.UpdateDispatcher(bot, max_workers=3)
+    for update_id in range(40):
+        dispatcher.submit(Update.de_json(make_update(update_id, chat_id=update_id % 5)))
+    await dispatcher.join()
+
+    assert len(bot.processed) == 40
+    assert bot.max_running == 3
+    for chat_id in range(5):
+        ids = [update_id for chat, update_id in bot.processed if chat == chat_id]
+        assert ids == sorted(ids)
+    assert dispatcher.pending == 0
+
+@pytest.mark.asyncio
+async def test_webhook_app_checks_secret_and_dispatches():
+    """Test the webhook endpoint rejects bad secrets and queues valid updates."""
+    from aiohttp.test_utils import TestClient, TestServer
+    bot = RecordingBot(delay=0)
+    app = webhook.create_webhook_app(bot, secret_token='s3cret')
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post('/webhook', json=make_update(1, 42))
+        assert response.status == 403
+        response = await client.post('/webhook', json=make_update(2, 42), headers={webhook.SECRET_HEADER: 's3cret'})
+        assert response.status == 200
+        response = await client.post('/webhook', data=b'not json', headers={webhook.SECRET_HEADER: 's3cret'})
+        assert response.status == 400
+        await app[webhook.DISPATCHER_KEY].join()
+    assert bot.processed == [(42, 2)]
+
+@pytest.mark.asyncio
+async def test_webhook_is_registered_once_for_all_workers(monkeypatch):
+    """Test that workers only serve while launch_workers sets and removes the webhook once."""
+    import bot as bot_module
+    telegram = AsyncMock()
+    server = asyncio.create_task(webhook.run_webhook(telegram, 'https://bot.example.com', '127.0.0.1', 0, register=False))
+    await asyncio.sleep(0.05)
+    server.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await server
+    telegram.set_webhook.assert_not_awaited()
+    telegram.remove_webhook.assert_not_awaited()
+
+    class FakeProcess:
+        def __init__(self, target, args, name):
+            self.args = args
+        def start(self):
+            pass
+        def join(self):
+            pass
+    class FakeContext:
+        Process = FakeProcess
+    calls = []
+    async def fake_set_shared_webhook(args, remove=False):
+        calls.append(remove)
+    monkeypatch.setattr('bot.multiprocessing.get_context', lambda method: FakeContext())
+    monkeypatch.setattr('bot.prepare_database', AsyncMock())
+    monkeypatch.setattr('bot.set_shared_webhook', fake_set_shared_webhook)
+    args = bot_module.parse_args(['--mode', 'webhook', '--webhook-url', 'https://bot.example.com', '--workers', '3'])
+    await asyncio.to_thread(bot_module.launch_workers, args)
+    assert calls == [False, True]
+
+def test_proxy_card_cache_lru_ttl_and_invalidation(monkeypatch):
+    """Test hit/miss counting, LRU eviction, TTL expiry and per-proxy invalidation."""
+    cache = ProxyCardCache(max_size=2, ttl=60)
+    cache.put(1, 'one', ['p1', 'p2'])
+    cache.put(2, 'two', ['p2'])
+    assert cache.get(1) == 'one' and cache.get(3) is None
+    cache.put(3, 'three', ['p3'])  # evicts user 2, the least recently used
+    assert cache.get(2) is None and len(cache) == 2
+
+    cache.invalidate_proxies(['p2', 'unrelated'])
+    assert cache.get(1) is None and cache.get(3) == 'three'
+
+    generation = cache.generation
+    cache.invalidate_user(3)
+    cache.put(3, 'stale', ['p3'], generation)
+    assert cache.get(3) is None
+
+    cache.put(4, 'four', [])
+    now = time.monotonic()
+    monkeypatch.setattr('render.time.monotonic', lambda: now + 61)
+    assert cache.get(4) is None
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 5
+
+@pytest.mark.asyncio
+async def test_check_proxy_served_from_card_cache(temp_db_path, monkeypatch):
+    """Test that repeated Check Proxy taps hit the cache until an assignment changes."""
+    cache = ProxyCardCache()
+    monkeypatch.setattr('handlers.card_cache', cache)
+    monkeypatch.setattr('db_utils.card_cache', cache)
+    await init_db()
+    await create_users_table()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+
+    bot = AsyncTeleBot('123456:TEST')
+    sent = []
+    async def fake_send_message(chat_id, text, **kwargs):
+        sent.append(text)
+    bot.send_message = fake_send_message
+    register_handlers(bot)
+
+    def tap(update_id, data):
+        user = {'id': 7, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'}
+        message = {'message_id': update_id, 'date': 1700000000, 'chat': {'id': 7, 'type': 'private'}, 'from': user, 'text': 'menu'}
+        return Update.de_json({'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '7', 'data': data, 'message': message}})
+
+    await assign_proxy(7, 'http://1.1.1.1:8080', 'en')
+    await bot.process_new_updates([tap(1, '/check_proxy')])
+    await bot.process_new_updates([tap(2, '/check_proxy')])
+    assert cache.hits == 1 and cache.misses == 1
+    assert sent[0] == sent[1] and 'IP Address: 1.1.1.1' in sent[0]
+
+    await assign_proxy(7, 'http://2.2.2.2:8080', 'en')
+    await bot.process_new_updates([tap(3, '/check_proxy')])
+    assert 'IP Address: 2.2.2.2' in sent[2] and 'http 1.1.1.1:8080' in sent[2]
+    assert cache.misses == 2
+
+@pytest.mark.asyncio
+async def test_fetcher_conditional_requests_retries_and_merge():
+    """Test ETag/hash change detection after commit, retry with backoff and merging of several sources."""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    state = {'json_calls': 0, 'text_calls': 0, 'text_body': 'socks5://1.1.1.1:8080\n9.9.9.9:3128\nnot a proxy\n'}
+    json_body = json.dumps({'proxies': [make_proxy_data('1.1.1.1', protocol='socks5'), make_proxy_data('2.2.2.2')]})
+
+    async def json_list(request):
+        state['json_calls'] += 1
+        if state['json_calls'] == 1:
+            return web.Response(status=503)
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text=json_body, headers={'ETag': '"v1"'})
+
+    async def text_list(request):
+        state['text_calls'] += 1
+        return web.Response(text=state['text_body'])
+
+    async def missing(request):
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get('/json', json_list)
+    app.router.add_get('/text', text_list)
+    app.router.add_get('/missing', missing)
+    async with TestServer(app) as server:
+        fetcher = Fetcher([
+            ProxyscrapeSource(str(server.make_url('/json'))),
+            PlainTextSource(str(server.make_url('/text')), name='text'),
+            PlainTextSource(str(server.make_url('/missing')), name='missing'),
+        ], retries=2, backoff_base=0.001)
+        try:
+            proxies = await fetcher.fetch()
+            assert [p['proxy'] for p in proxies] == ['socks5://1.1.1.1:8080', 'http://2.2.2.2:8080', 'http://9.9.9.9:3128']
+            assert proxies[0]['anonymity'] == 'elite'  # the richer, earlier source wins
+            assert state['json_calls'] == 2
+
+            # Not imported yet, so the same lists come back instead of a 304 or a hash match.
+            assert len(await fetcher.fetch()) == 3
+            fetcher.commit()
+            decode = AsyncMock(wraps=fetcher.decoder.decode)
+            fetcher.decoder.decode = decode
+            assert await fetcher.fetch() is None  # 304 and identical text body
+            decode.assert_not_awaited()
+
+            state['text_body'] = '9.9.9.9:3128\n'
+            proxies = await fetcher.fetch()
+            assert [p['proxy'] for p in proxies] == ['socks5://1.1.1.1:8080', 'http://2.2.2.2:8080', 'http://9.9.9.9:3128']
+            assert decode.await_count == 1
+        finally:
+            await fetcher.close()
+
+def test_backoff_delay_grows_with_jitter():
+    """Test that backoff delays double per attempt, are jittered and capped."""
+    for attempt in range(6):
+        delay = backoff_delay(attempt, base=1.0, cap=10.0)
+        assert min(10.0, 2 ** attempt) / 2 <= delay <= min(10.0, 2 ** attempt)
+
+@pytest.mark.asyncio
+async def test_import_proxies_writes_only_changes(temp_db_path):
+    """Test that re-imports only touch new, changed and removed proxies, and geo data is split out."""
+    await init_db()
+    proxies = [make_proxy_data(f'1.1.1.{i}') for i in range(4)]
+    await import_proxies(proxies)
+
+    async def imported_at():
+        async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+            async with db.execute('SELECT proxy, imported_at, status FROM proxies') as cursor:
+                return {proxy: (stamp, status) for proxy, stamp, status in await cursor.fetchall()}
+    before = await imported_at()
+
+    proxies[1] = dict(proxies[1], timeout=42.0)
+    await import_proxies(proxies[:3] + [make_proxy_data('2.2.2.2')])
+    after = await imported_at()
+
+    assert after['http://1.1.1.0:8080'] == before['http://1.1.1.0:8080']
+    assert after['http://1.1.1.1:8080'][0] > before['http://1.1.1.1:8080'][0]
+    assert after['http://1.1.1.3:8080'] == (before['http://1.1.1.3:8080'][0], 'dead')
+    assert after['http://2.2.2.2:8080'][1] == 'active'
+
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT p.proxy, g.as_value FROM proxy_geo g JOIN proxies p ON p.id = g.proxy_id ORDER BY p.proxy') as cursor:
+            assert [row[1] for row in await cursor.fetchall()] == ['AS1'] * 5
+        async with db.execute('SELECT name FROM pragma_table_info(\'proxies\')') as cursor:
+            columns = {row[0] for row in await cursor.fetchall()}
+    assert 'asname' not in columns and 'country_code' in columns
+
+@pytest.mark.asyncio
+async def test_metrics_timing_exposition_and_switch_off(monkeypatch):
+    """Test that timed calls land in histograms, render as Prometheus text and stop when disabled."""
+    import metrics
+    from aiohttp.test_utils import TestClient, TestServer
+    monkeypatch.setattr('metrics._registry', {})
+    histogram = metrics.Histogram('test_seconds', 'Test latency.', ['op'], buckets=(0.1, 1.0))
+    counter = metrics.Counter('test_total', 'Test count.', ['op'])
+
+    @metrics.timed(histogram, op='work')
+    async def work():
+        counter.inc(op='work')
+        return 'done'
+
+    assert await work() == 'done'
+    histogram.observe(0.5, op='work')
+    text = metrics.render()
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{op="work",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{op="work",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{op="work",le="+Inf"} 2' in text
+    assert 'test_seconds_count{op="work"} 2' in text
+    assert 'test_total{op="work"} 1' in text
+
+    monkeypatch.setattr('metrics.enabled', False)
+    await work()
+    assert histogram.count(op='work') == 2 and counter.value(op='work') == 1
+
+    monkeypatch.setattr('metrics.enabled', True)
+    runner = await metrics.start_metrics_server(port=0)
+    try:
+        port = runner.addresses[0][1]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                assert response.status == 200
+                assert 'test_total{op="work"} 1' in await response.text()
+    finally:
+        await runner.cleanup()
+
+
+def test_token_bucket_limiter_refills_and_evicts_idle_chats():
+    """Test per-chat token buckets, refill over time and bounded, idle-first eviction."""
+    from throttle import TokenBucketLimiter
+    now = [0.0]
+    limiter = TokenBucketLimiter(rate=1.0, burst=2, max_entries=3, clock=lambda: now[0])
+    assert limiter.allow(1) and limiter.allow(1) and not limiter.allow(1)
+    now[0] = 1.0
+    assert limiter.allow(1) and not limiter.allow(1)
+
+    limiter.allow(2)
+    now[0] = 5.0  # both buckets have refilled by now, so they are dropped on the next insert
+    limiter.allow(3)
+    assert len(limiter) == 1
+    for chat_id in range(4, 10):
+        limiter.allow(chat_id)
+    assert len(limiter) == 3
+
+@pytest.mark.asyncio
+async def test_callback_throttle_coalesces_limits_and_caps_concurrency():
+    """Test that duplicate taps share one run, fast tappers are limited and handlers are capped."""
+    from throttle import CallbackThrottle
+    throttle = CallbackThrottle(rate=0.001, burst=2, concurrency=2)
+    runs = []
+    running = 0
+    peak = 0
+
+    async def handler(name):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        runs.append(name)
+        running -= 1
+
+    results = await asyncio.gather(*(throttle.run(1, '/get_proxy', lambda: handler('dup')) for _ in range(5)))
+    assert results == [True] * 5 and runs == ['dup']
+
+    assert await throttle.run(1, '/help', lambda: handler('help'))
+    assert not await throttle.run(1, '/check_proxy', lambda: handler('limited'))
+
+    await asyncio.gather(*(throttle.run(chat_id, '/help', lambda: handler('other')) for chat_id in range(2, 10)))
+    assert runs.count('other') == 8 and peak == 2
+    assert len(throttle.coalescer) == 0
+
+
+class FakeTelegramAPI:
+    """Records send_message calls; answers with 429 flood control for the first ``flood`` calls to a chat."""
+
+    def __init__(self, flood=None, retry_after=0.05):
+        self.sent = []
+        self.flood = dict(flood or {})
+        self.retry_after = retry_after
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        if self.flood.get(chat_id):
+            self.flood[chat_id] -= 1
+            from telebot.asyncio_helper import ApiTelegramException
+            raise ApiTelegramException('sendMessage', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': self.retry_after}})
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+@pytest.mark.asyncio
+async def test_message_sender_keeps_chat_order_and_honours_retry_after():
+    """Test per-chat FIFO delivery, including a message retried after a 429."""
+    from sender import MessageSender
+    api = FakeTelegramAPI(flood={1: 1})
+    sender = MessageSender(api, workers=4, global_rate=1000, chat_rate=1000, chat_burst=100)
+    sender.start()
+    try:
+        started = time.monotonic()
+        futures = [await sender.send_message(1, text) for text in 'abc']
+        await sender.send_message(2, 'x')
+        assert len(sender) == 4 and api.sent == []  # enqueued only
+        await sender.join()
+        assert [await future for future in futures] == ['a', 'b', 'c']
+    finally:
+        await sender.close()
+    assert [text for chat_id, text, _ in api.sent if chat_id == 1] == ['a', 'b', 'c']
+    first_a = next(sent_at for chat_id, text, sent_at in api.sent if text == 'a')
+    assert first_a - started >= api.retry_after
+    assert api.sent[0][1] == 'x' and len(sender) == 0
+
+@pytest.mark.asyncio
+async def test_message_sender_pauses_every_chat_on_flood_control():
+    """Test that a 429 holds back all chats, as Telegram's flood limit is per bot."""
+    from sender import MessageSender
+    api = FakeTelegramAPI(flood={1: 1})
+    sender = MessageSender(api, workers=2, global_rate=1000, chat_rate=1000, chat_burst=100)
+    sender.start()
+    try:
+        started = time.monotonic()
+        await sender.send_message(1, 'a')
+        await asyncio.sleep(0.01)  # chat 1 got its 429
+        await sender.send_message(2, 'b')
+        await sender.join()
+    finally:
+        await sender.close()
+    assert all(sent_at - started >= api.retry_after for _, _, sent_at in api.sent)
+    assert sorted(text for _, text, _ in api.sent) == ['a', 'b']
+
+@pytest.mark.asyncio
+async def test_message_sender_throttled_chat_keeps_the_global_budget():
+    """Test that a chat over its own rate gives back the global token it took."""
+    from sender import MessageSender
+    api = FakeTelegramAPI()
+    sender = MessageSender(api, workers=1, global_rate=2, chat_rate=100, chat_burst=1)
+    await sender.send_message(1, 'first')
+    await sender.send_message(1, 'second')
+    sender.start()
+    try:
+        await sender.join()
+    finally:
+        await sender.close()
+    times = [sent_at for _, _, sent_at in api.sent]
+    assert times[1] - times[0] < 0.2  # not held until the global bucket refills (0.5s)
+
+@pytest.mark.asyncio
+async def test_message_sender_prioritises_interactive_and_limits_chats():
+    """Test that interactive replies overtake bulk traffic and a chat's burst is rate limited."""
+    from sender import MessageSender, BULK
+    api = FakeTelegramAPI()
+    sender = MessageSender(api, workers=1, global_rate=1000, chat_rate=20, chat_burst=1)
+    for chat_id in range(1, 6):
+        await sender.send_message(chat_id, f'bulk {chat_id}', priority=BULK)
+    await sender.send_message(9, 'reply 1')
+    await sender.send_message(9, 'reply 2')
+    sender.start()
+    try:
+        await sender.join()
+    finally:
+        await sender.close()
+    assert api.sent[0][1] == 'reply 1'
+    times = {text: sent_at for _, text, sent_at in api.sent}
+    assert times['reply 2'] - times['reply 1'] >= 0.04
+
+@pytest.mark.asyncio
+async def test_message_sender_replies_overtake_a_bulk_backlog_at_the_global_limit():
+    """Test that workers do not wait for global send budget holding bulk chats while a reply is queued."""
+    from sender import MessageSender, BULK
+    api = FakeTelegramAPI()
+    sender = MessageSender(api, workers=4, global_rate=20, chat_rate=100, chat_burst=1)
+    for chat_id in range(1, 41):
+        await sender.send_message(chat_id, f'bulk {chat_id}', priority=BULK)
+    sender.start()
+    try:
+        await asyncio.sleep(0.2)  # the burst is spent; every worker is out of budget
+        queued_at = time.monotonic()
+        reply = await sender.send_message(99, 'reply')
+        await reply
+        assert time.monotonic() - queued_at < 0.1
+        assert sum(1 for _, text, _ in api.sent if text.startswith('bulk')) < 40
+    finally:
+        await sender.close()
+
+
+@pytest.mark.asyncio
+async def test_leader_lease_renew_expire_and_release(temp_db_path):
+    """Test that a lease is exclusive until it expires or is released, and generations count writes."""
+    await init_db()
+    assert await acquire_lease('leader', 'a', ttl=0.2)
+    assert not await acquire_lease('leader', 'b', ttl=0.2)
+    assert await acquire_lease('leader', 'a', ttl=0.2)  # renewal
+    await asyncio.sleep(0.25)
+    assert await acquire_lease('leader', 'b', ttl=0.2)
+    await release_lease('leader', 'a')  # no longer a's to release
+    assert not await acquire_lease('leader', 'a', ttl=0.2)
+    await release_lease('leader', 'b')
+    assert await acquire_lease('leader', 'a', ttl=0.2)
+
+    assert await get_generation(PROXIES_GENERATION) == 0
+    await import_proxies([make_proxy_data('1.1.1.1')])
+    await import_proxies([make_proxy_data('1.1.1.1')])  # unchanged, no bump
+    assert await get_generation(PROXIES_GENERATION) == 1
+
+def _cluster_worker(db_dir, holder, run_for, crash, events):
+    """A worker process for the multi-process test: leads with a fake importer, or follows."""
+    from cluster import Cluster
+
+    async def get_db_path(db_name):
+        return os.path.join(db_dir, f'{db_name}.db')
+
+    async def fake_update():
+        while True:
+            await import_proxies([make_proxy_data('1.1.1.1', timeout=random.uniform(1, 1000))])
+            events.put((holder, 'import', time.time()))
+            await asyncio.sleep(0.05)
+
+    async def run():
+        db_utils.get_db_path = get_db_path
+        await open_pools()
+        cluster = Cluster([fake_update], holder=holder, ttl=0.5, interval=0.05)
+        task = asyncio.create_task(cluster.run())
+        await asyncio.sleep(run_for)
+        if crash:
+            os._exit(0)  # no lease release: the others must wait for it to expire
+        task.cancel()
+        await cluster.stop()
+        events.put((holder, 'reloads', cluster.reloads))
+        await close_pools()
+
+    asyncio.run(run())
+
+def test_cluster_workers_elect_one_importer_and_fail_over(tmp_path):
+    """Test with real processes that one worker imports at a time and followers reload."""
+    import multiprocessing
+    db_dir = str(tmp_path)
+
+    async def prepare():
+        monkeypatch = pytest.MonkeyPatch()
+        async def get_db_path(db_name):
+            return os.path.join(db_dir, f'{db_name}.db')
+        monkeypatch.setattr('db_utils.get_db_path', get_db_path)
+        try:
+            await init_db()
+        finally:
+            monkeypatch.undo()
+    asyncio.run(prepare())
+
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    first = context.Process(target=_cluster_worker, args=(db_dir, 'a', 1.5, True, events))
+    first.start()
+    assert events.get(timeout=30)[:2] == ('a', 'import')  # 'a' leads before the others start
+    others = [context.Process(target=_cluster_worker, args=(db_dir, holder, 2.5, False, events)) for holder in 'bc']
+    for process in others:
+        process.start()
+    for process in [first] + others:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+    received = []
+    while not events.empty():
+        received.append(events.get())
+    imports = sorted((at, holder) for holder, kind, at in received if kind == 'import')
+    leaders = [holder for _, holder in imports]
+    blocks = [holder for i, holder in enumerate(leaders) if i == 0 or leaders[i - 1] != holder]
+    assert blocks[0] == 'a' and len(blocks) == 2 and blocks[1] in 'bc'
+    handover = next(at for at, holder in imports if holder != 'a')
+    assert handover - max(at for at, holder in imports if holder == 'a') >= 0.3
+    reloads = {holder: count for holder, kind, count in received if kind == 'reloads'}
+    follower = 'b' if blocks[1] == 'c' else 'c'
+    assert reloads[follower] >= 1
+
+
+def test_proxy_columns_round_trip_and_discard():
+    """Test that records survive the columnar layout, including swaps on discard and non-IPv4 hosts."""
+    records = [
+        ProxyRecord('http://1.2.3.4:8080', 'http', '1.2.3.4', 8080, 'DE', 'Germany', 'elite', True, 120.5, 1700000000.0),
+        ProxyRecord('socks5://[::1]:1080', 'socks5', '::1', 1080, 'US', 'United States', 'anonymous', False, None, None),
+        ProxyRecord('http://255.255.255.255:65535', 'http', '255.255.255.255', 65535, 'DE', 'Germany', 'elite', False, 0.0, 1.0),
+    ]
+    table = ProxyColumns()
+    for record in records:
+        table.add(record, quality=0.5)
+    assert len(table) == 3 and [table.get(record.proxy) for record in records] == records
+    assert table.protocol[0] is table.protocol[2]  # interned
+
+    table.discard(records[0].proxy)
+    table.discard('http://missing:1')
+    assert len(table) == 2 and records[0].proxy not in table
+    assert table.get(records[1].proxy) == records[1] and table.get(records[2].proxy) == records[2]
+    table.set_latency(records[1].proxy, 33.0)
+    assert table.get(records[1].proxy).latency == 33.0 and table.quality[table.row(records[1].proxy)] == 0.5
+
+@pytest.mark.asyncio
+async def test_get_proxy_info_served_from_alive_index(temp_db_path, monkeypatch):
+    """Test that cards of alive proxies come from the index and match the database."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1', ssl=True)])
+    from_database = await get_proxy_info('http://1.1.1.1:8080')
+    await rebuild_alive_index()
+    with patch('aiosqlite.connect') as mock_connect:
+        from_index = await get_proxy_info('http://1.1.1.1:8080')
+    mock_connect.assert_not_called()
+    assert from_index == from_database and format_proxy_card(from_index) == format_proxy_card(from_database)
+
+
+@pytest.mark.asyncio
+async def test_browse_proxies_pages_and_facet_counts(store):
+    """Test keyset pages in both directions and the facet counts kept up to date on every store."""
+    def country(code):
+        return {'country': code, 'countryCode': code}
+    await import_proxies(
+        [make_proxy_data(f'1.1.1.{i}', protocol='socks5', ip_data=country('DE')) for i in range(5)]
+        + [make_proxy_data(f'2.2.2.{i}', ip_data=country('US'), anonymity='anonymous') for i in range(3)]
+        + [make_proxy_data('3.3.3.3', ip_data=country('DE'), alive=False)]
+    )
+    assert await get_facet_counts('protocol') == [('socks5', 5), ('http', 3)]
+    assert await get_facet_counts('country_code', {'anonymity': 'elite'}) == [('DE', 5)]
+    assert await get_facet_counts('anonymity', {'protocol': 'http', 'country_code': 'us'}) == [('anonymous', 3)]
+
+    pages = [await browse_proxies({'country_code': 'DE'}, limit=2)]
+    while pages[-1]['next']:
+        pages.append(await browse_proxies({'country_code': 'DE'}, after=pages[-1]['last'], limit=2))
+    assert [len(page['proxies']) for page in pages] == [2, 2, 1]
+    assert sorted(record.proxy for page in pages for record in page['proxies']) == [f'socks5://1.1.1.{i}:8080' for i in range(5)]
+    assert not pages[0]['previous'] and pages[1]['previous']
+    back = await browse_proxies({'country_code': 'DE'}, before=pages[2]['first'], limit=2)
+    assert back['proxies'] == pages[1]['proxies'] and back['previous'] and back['next']
+    assert len((await browse_proxies(limit=20))['proxies']) == 8
+
+    await record_checks([(False, None, time.time(), 'socks5://1.1.1.0:8080')])
+    await finish_checks()
+    assert await get_facet_counts('protocol') == [('socks5', 4), ('http', 3)]
+    await store.import_proxies([make_proxy_data('2.2.2.0', ip_data=country('US'), anonymity='anonymous')])
+    assert await get_facet_counts('country_code') == [('US', 1)]
+
+def test_browse_callback_data_round_trip():
+    """Test that browse and page callback data parse back and fit Telegram's 64 bytes."""
+    choices = ['socks4', ANY, 'transparent']
+    assert parse_browse_callback(browse_callback(choices)) == choices
+    assert choice_filters(choices) == {'protocol': 'socks4', 'anonymity': 'transparent'}
+    key = ('socks4', 'ZZ', 'transparent', 2**32)
+    data = page_callback(['socks4', 'ZZ', 'transparent'], '<', key)
+    assert len(data.encode()) <= 64
+    assert parse_page_callback(data) == (['socks4', 'ZZ', 'transparent'], '<', key)
+    with pytest.raises(ValueError):
+        parse_page_callback('page|http||')
+
+@pytest.mark.asyncio
+async def test_browse_flow_through_handlers(temp_db_path, monkeypatch):
+    """Test /browse, then choosing facets, paging and taking a proxy from the inline keyboards."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await create_users_table()
+    await import_proxies([make_proxy_data(f'1.1.{i // 256}.{i % 256}', protocol='socks5') for i in range(BROWSE_PAGE_SIZE + 1)]
+                         + [make_proxy_data('2.2.2.2')])
+
+    monkeypatch.setattr('handlers.CallbackThrottle', lambda: CallbackThrottle(rate=100, burst=100))
+    bot = AsyncTeleBot('123456:TEST')
+    sent = []
+    async def fake_send_message(chat_id, text, reply_markup=None, **kwargs):
+        sent.append((text, [button for row in getattr(reply_markup, 'keyboard', []) for button in row]))
+    bot.send_message = fake_send_message
+    bot.answer_callback_query = AsyncMock()
+    register_handlers(bot)
+
+    def tap(update_id, data):
+        user = {'id': 7, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'}
+        message = {'message_id': update_id, 'date': 1700000000, 'chat': {'id': 7, 'type': 'private'}, 'from': user, 'text': 'menu'}
+        return Update.de_json({'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '7', 'data': data, 'message': message}})
+
+    def button(text):
+        return next(b.callback_data for b in sent[-1][1] if b.text.startswith(text))
+
+    await bot.process_new_updates([Update.de_json({'update_id': 100, 'message': {
+        'message_id': 100, 'date': 1700000000, 'chat': {'id': 7, 'type': 'private'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'},
+        'text': '/browse', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 7}]}})])
+    assert sent[-1][0] == 'Choose a protocol:'
+    await bot.process_new_updates([tap(1, browse_callback(('', '', '')))])
+    assert [b.text for b in sent[-1][1]] == [f'socks5 ({BROWSE_PAGE_SIZE + 1})', 'http (1)', f'✳️ Any ({BROWSE_PAGE_SIZE + 2})']
+    await bot.process_new_updates([tap(2, button('socks5'))])
+    assert sent[-1][0] == 'Choose a country:'
+    await bot.process_new_updates([tap(3, button('✳️ Any'))])
+    await bot.process_new_updates([tap(4, button('elite'))])
+    assert sent[-1][0].count('socks5://') == BROWSE_PAGE_SIZE
+    await bot.process_new_updates([tap(5, button('Next'))])
+    assert sent[-1][0].count('socks5://') == 1 and button('◀️ Prev')
+
+    await bot.process_new_updates([tap(6, button('🆕 1'))])
+    assert sent[-1][0].startswith('🎉 You have been assigned a new proxy')
+    assigned, _ = await get_assigned_proxies_and_language_code(7)
+    assert len(assigned) == 1 and assigned[0].protocol == 'socks5'
+
+@pytest.mark.asyncio
+async def test_take_from_a_stale_browse_page_skips_dead_proxies(temp_db_path, monkeypatch):
+    """Test that a take button for a proxy that died after the page was sent does not assign it."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await create_users_table()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    await rebuild_alive_index()
+    assign = AsyncMock(wraps=assign_proxy)
+    monkeypatch.setattr('handlers.assign_proxy', assign)
+    monkeypatch.setattr('handlers.CallbackThrottle', lambda: CallbackThrottle(rate=100, burst=100))
+    bot = AsyncTeleBot('123456:TEST')
+    sent = []
+    async def fake_send_message(chat_id, text, reply_markup=None, **kwargs):
+        sent.append(text)
+    bot.send_message = fake_send_message
+    bot.answer_callback_query = AsyncMock()
+    register_handlers(bot)
+
+    await import_proxies([make_proxy_data('2.2.2.2')])  # 1.1.1.1 is unlisted after its page went out
+    await bus.drain()
+    user = {'id': 7, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'}
+    message = {'message_id': 1, 'date': 1700000000, 'chat': {'id': 7, 'type': 'private'}, 'from': user, 'text': 'page'}
+    await bot.process_new_updates([Update.de_json({'update_id': 1, 'callback_query': {
+        'id': '1', 'from': user, 'chat_instance': '7', 'data': TAKE_PREFIX + 'http://1.1.1.1:8080', 'message': message}})])
+    assert sent[0] == PROXY_GONE_TEXT and sent[-1].startswith('🎉 You have been assigned a new proxy')
+    assert [call.args[1] for call in assign.await_args_list] == ['http://2.2.2.2:8080']
+
+
+def test_alive_index_snapshot_round_trip(tmp_path):
+    """Test that an index read back from its snapshot has the same records, weights and facets."""
+    index = AliveIndex()
+    index.replace([
+        (ProxyRecord('http://1.1.1.1:80', 'http', '1.1.1.1', 80, 'DE', 'Germany', 'elite', True, 120.0, 1700000000.0), 120.0, 0.9),
+        (ProxyRecord('socks5://[::1]:1080', 'socks5', '::1', 1080, 'US', 'United States', 'anonymous'), None, 0.5),
+        (ProxyRecord('socks5://2.2.2.2:1080', 'socks5', '2.2.2.2', 1080, 'US', 'United States', 'elite', False, 80.0), 80.0, 1.0),
+    ])
+    path = tmp_path / 'alive.snapshot'
+    path.write_bytes(index.to_snapshot(generation=42))
+
+    loaded = AliveIndex()
+    assert loaded.load_snapshot(str(path)) == 42
+    assert loaded.loaded and len(loaded) == 3
+    for proxy in ('http://1.1.1.1:80', 'socks5://[::1]:1080', 'socks5://2.2.2.2:1080'):
+        assert loaded.record(proxy) == index.record(proxy)
+    assert loaded.count(protocol='socks5') == 2 and loaded.count(country_code='us', anonymity='elite') == 1
+    assert loaded.sample(exclude=['socks5://[::1]:1080'], protocol='socks5') == 'socks5://2.2.2.2:1080'
+    loaded.discard('http://1.1.1.1:80')
+    loaded.update_latency('socks5://2.2.2.2:1080', 30.0)
+    assert len(loaded) == 2 and loaded.record('socks5://2.2.2.2:1080').latency == 30.0
+
+    path.write_bytes(b'not a snapshot' + bytes(16))
+    with pytest.raises(ValueError):
+        AliveIndex().load_snapshot(str(path))
+
+@pytest.mark.asyncio
+async def test_warm_start_serves_snapshot_and_rebuilds_when_stale(temp_db_path, monkeypatch):
+    """Test that startup loads the snapshot without a query, and rebuilds in the background once data moved on."""
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+    assert await warm_start_alive_index() is None  # no snapshot yet: rebuilt from the database
+    assert len(db_utils.alive_index) == 2
+    await save_alive_snapshot()
+
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    with patch('db_utils.get_alive_index_entries') as mock_entries:
+        assert await warm_start_alive_index() is None
+    mock_entries.assert_not_called()
+    assert await replace_proxy(1, ['http://1.1.1.1:8080']) == 'http://2.2.2.2:8080'
+
+    await record_checks([(False, None, time.time(), 'http://2.2.2.2:8080')])
+    await finish_checks()
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    task = await warm_start_alive_index()
+    assert len(db_utils.alive_index) == 2  # served from the stale snapshot meanwhile
+    await task
+    assert await get_alive_proxies() == ['http://1.1.1.1:8080'] and len(db_utils.alive_index) == 1
+
+@pytest.mark.asyncio
+async def test_offload_decodes_rows_and_rebuilds_like_the_event_loop(temp_db_path, monkeypatch):
+    """Test that rows decoded and an index built in the offload pool match what the event loop builds."""
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    monkeypatch.setattr('db_utils.alive_index', AliveIndex())
+    bodies = {
+        '/a': {'proxies': [make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2', timeout=300.0)]},
+        '/b': {'proxies': [make_proxy_data('1.1.1.1', timeout=999.0), make_proxy_data('3.3.3.3', alive=False), {'ip': '4.4.4.4'}]},
+    }
+
+    async def proxy_list(request):
+        return web.json_response(bodies[request.path])
+
+    app = web.Application()
+    app.router.add_get('/{name}', proxy_list)
+    async with TestServer(app) as server:
+        fetcher = Fetcher([ProxyscrapeSource(str(server.make_url(path)), name=path) for path in bodies], decoder=RowDecoder())
+        try:
+            packed = await fetcher.fetch()
+        finally:
+            await fetcher.close()
+    assert isinstance(packed, storage.PackedRows) and len(packed) == 3
+    rows = [row async for row, geo in packed]
+    assert [row[0] for row in rows] == ['http://1.1.1.1:8080', 'http://2.2.2.2:8080', 'http://3.3.3.3:8080']
+    assert rows[0][14] == 100.0  # the earlier source wins
+
+    await init_db()
+    assert await import_proxies(packed) == 3
+    async with aiosqlite.connect(str(temp_db_path / 'proxies.db')) as db:
+        async with db.execute('SELECT COUNT(*) FROM proxies WHERE imported_at IS NOT NULL') as cursor:
+            assert (await cursor.fetchone())[0] == 3
+
+    assert await rebuild_alive_index(snapshot=True) == 2
+    offloaded = db_utils.alive_index.to_snapshot(1)
+    saved = AliveIndex()
+    assert saved.load_snapshot(str(temp_db_path / 'alive_index.snapshot')) == await get_generation('proxies')
+    assert len(saved) == 2
+    monkeypatch.setattr(config, 'OFFLOAD_PROCESSES', 0, raising=False)
+    with patch('db_utils.build_alive_snapshot') as mock_build:
+        assert await rebuild_alive_index() == 2
+    mock_build.assert_not_called()
+    assert db_utils.alive_index.to_snapshot(1) == offloaded
+
+@pytest.mark.asyncio
+async def test_event_bus_coalesces_and_bounds_subscriber_queues():
+    """Test that undelivered proxy events coalesce, full queues hold publishers back and a failing subscriber keeps receiving."""
+    test_bus = events.EventBus(max_pending=3, batch_size=2)
+    received, failures = [], []
+    release = asyncio.Event()
+
+    async def slow(batch):
+        await release.wait()
+        received.extend(batch)
+
+    async def failing(batch):
+        failures.append(batch)
+        raise RuntimeError('subscriber bug')
+
+    queue = test_bus.subscribe(slow, events.ProxyEvent, events.UserAssigned)
+    test_bus.subscribe(failing, events.LatencyChanged)
+    await test_bus.publish_many([events.ProxyAdded('a'), events.ProxyDied('a'), events.LatencyChanged('a', 5.0),
+                                 events.LatencyChanged('a', 7.0)])
+    publisher = asyncio.create_task(test_bus.publish_many([events.UserAssigned(user, 'b') for user in range(5)]))
+    await asyncio.sleep(0.01)
+    assert not publisher.done() and len(queue) == 3  # the slow subscriber holds a batch and its queue is full
+
+    release.set()
+    await publisher
+    await test_bus.publish(events.LatencyChanged('b', 1.0))
+    await test_bus.drain()
+    assert received == [events.ProxyDied('a')] + [events.UserAssigned(user, 'b') for user in range(5)]
+    assert failures == [[events.LatencyChanged('a', 7.0)], [events.LatencyChanged('b', 1.0)]]
+    await test_bus.close()
+
+@pytest.mark.asyncio
+async def test_import_and_leases_publish_events(temp_db_path, monkeypatch):
+    """Test that imports and leases publish what changed, and the card cache drops replies through the bus."""
+    cache = ProxyCardCache()
+    monkeypatch.setattr('db_utils.card_cache', cache)
+    published = []
+
+    async def record(batch):
+        published.extend(batch)
+
+    subscription = bus.subscribe(record)
+    try:
+        await init_db()
+        await create_users_table()
+        await import_proxies([make_proxy_data('1.1.1.1'), make_proxy_data('2.2.2.2')])
+        cache.put(7, 'card', ['http://2.2.2.2:8080'])
+        await import_proxies([make_proxy_data('1.1.1.1', timeout=5.0), make_proxy_data('3.3.3.3')])
+        await assign_proxy(7, 'http://1.1.1.1:8080', 'en')
+        await bus.drain()
+    finally:
+        await bus.unsubscribe(subscription)
+    assert published == [
+        events.ProxyAdded('http://1.1.1.1:8080'), events.ProxyAdded('http://2.2.2.2:8080'),
+        events.ProxyAdded('http://3.3.3.3:8080'), events.ProxyUpdated('http://1.1.1.1:8080'),
+        events.ProxyDied('http://2.2.2.2:8080'), events.UserAssigned(7, 'http://1.1.1.1:8080'),
+    ]
+    assert cache.get(7) is None and cache.invalidations == 1
 
 @pytest.mark.asyncio
-async def test_assign_proxy(mock_get_db_path):
-    """Test the assign_proxy function."""
-    # This test checks if the assign_proxy function correctly
-    # assigns a new proxy to a user in the database.
-    mock_cursor = AsyncMock()
-    mock_cursor.fetchone.return_value = None
+async def test_dead_proxy_notices_reach_each_holder_once_and_switch(store, monkeypatch):
+    """Test that holders of proxies that died are found through the store, told once, and can switch with one tap."""
+    import notifier
+    from sender import BULK
+    await import_proxies([make_proxy_data(f'1.1.1.{i}') for i in range(6)])
+    await rebuild_alive_index()
+    for user_id, ip in ((1, '1.1.1.0'), (1, '1.1.1.1'), (2, '1.1.1.1'), (3, '1.1.1.2'), (4, '1.1.1.3'), (5, '1.1.1.4')):
+        await assign_proxy(user_id, f'http://{ip}:8080', 'en')
+    assert await get_users_holding(['http://1.1.1.1:8080', 'http://9.9.9.9:8080']) == {
+        1: ['http://1.1.1.0:8080', 'http://1.1.1.1:8080'], 2: ['http://1.1.1.1:8080']}
+
+    class RecordingSender:
+        def __init__(self):
+            self.sent = []
+
+        async def send_message(self, chat_id, text, reply_markup=None, priority=None):
+            self.sent.append((chat_id, text, reply_markup, priority))
+
+        def depth(self, priority):
+            return 0
+
+    sender = RecordingSender()
+    task = asyncio.create_task(notifier.DeadProxyNotifier(sender, lookup_batch_size=1, batch_size=2, pause=0).run())
+    try:
+        await asyncio.sleep(0)
+        # 1.1.1.1 is unlisted, 1.1.1.2 fails a health check, 1.1.1.3 is listed as dead and drops out on the rebuild.
+        await import_proxies([make_proxy_data(f'1.1.1.{i}', alive=i != 3) for i in (0, 2, 3, 4, 5)])
+        await bus.publish(events.ProxyDied('http://1.1.1.2:8080'))
+        await rebuild_alive_index()
+        await bus.drain()
+        for _ in range(100):
+            if len(sender.sent) == 4:
+                break
+            await asyncio.sleep(0.01)
+        await rebuild_alive_index()
+        await bus.drain()
+        await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    notices = {chat_id: (text, markup, priority) for chat_id, text, markup, priority in sender.sent}
+    assert len(sender.sent) == 4 and sorted(notices) == [1, 2, 3, 4]
+    assert 'http://1.1.1.1:8080 stopped' in notices[1][0] and 'http://1.1.1.3:8080 stopped' in notices[4][0]
+    assert all(priority == BULK for _, _, priority in notices.values())
+    offered = notices[3][1].keyboard[0][0].callback_data
+    assert offered.startswith(SWITCH_PREFIX) and offered[len(SWITCH_PREFIX):] in ('http://1.1.1.0:8080', 'http://1.1.1.4:8080', 'http://1.1.1.5:8080')
+    assert notices[1][1].keyboard[0][0].callback_data != SWITCH_PREFIX + 'http://1.1.1.0:8080'
+
+    monkeypatch.setattr('handlers.CallbackThrottle', lambda: CallbackThrottle(rate=100, burst=100))
+    bot = AsyncTeleBot('123456:TEST')
+    replies = []
+    async def fake_send_message(chat_id, text, reply_markup=None, **kwargs):
+        replies.append(text)
+    bot.send_message = fake_send_message
+    bot.answer_callback_query = AsyncMock()
+    register_handlers(bot)
+    user = {'id': 3, 'is_bot': False, 'first_name': 'Test', 'language_code': 'en'}
+    message = {'message_id': 1, 'date': 1700000000, 'chat': {'id': 3, 'type': 'private'}, 'from': user, 'text': 'notice'}
+    await bot.process_new_updates([Update.de_json({'update_id': 1, 'callback_query': {
+        'id': '1', 'from': user, 'chat_instance': '3', 'data': offered, 'message': message}})])
+    assert replies[-1].startswith('🎉 You have been assigned a new proxy')
+    assigned, _ = await get_assigned_proxies_and_language_code(3)
+    assert assigned[-1].proxy == offered[len(SWITCH_PREFIX):]
 
-    mock_db = AsyncMock()
-    mock_db.execute.return_value = AsyncMock(__aenter__=AsyncMock(return_value=mock_cursor))
+@pytest.mark.asyncio
+async def test_maintenance_prunes_dead_unheld_proxies(store):
+    """Test that maintenance deletes unlisted proxies in batches but keeps held and recent ones."""
+    await import_proxies([make_proxy_data(f'1.1.1.{i}') for i in range(5)])
+    await assign_proxy(7, 'http://1.1.1.1:8080', 'en')
+    await import_proxies([make_proxy_data('1.1.1.0')])
 
-    with patch('aiosqlite.connect', return_value=AsyncMock(__aenter__=AsyncMock(return_value=mock_db), __aexit__=AsyncMock())):
-        await assign_proxy(1234, 'http://example.com:8080', 'en')
-        mock_db.execute.assert_called()
-        mock_db.commit.assert_called_once()
+    report = await maintenance.run_maintenance(retention=3600, batch_size=2, pause=0)
+    assert report['pruned'] == 0
+    report = await maintenance.run_maintenance(retention=-1, batch_size=2, pause=0)
+    assert report['pruned'] == 3 and report['longest_batch_ms'] >= 0
+    assert await get_proxy_info('http://1.1.1.2:8080') is None
+    assert (await get_proxy_info('http://1.1.1.1:8080')).proxy == 'http://1.1.1.1:8080'
+    assert [proxy.proxy for proxy in (await get_assigned_proxies_and_language_code(7))[0]] == ['http://1.1.1.1:8080']
+    assert await get_listed_proxies() == ['http://1.1.1.0:8080']
+    if isinstance(store, SQLiteStore):
+        assert report['incremental_vacuum'] and report['pages'] > report['free_pages'] >= 0
 
 
 
+@pytest.mark.asyncio
+async def test_startup_phases_lazy_tasks_and_import_report(monkeypatch):
+    """Leader tasks resolve their function when called, and background phases stay out of the total."""
+    import startup
+    calls = []
+
+    async def fake_periodic_update():
+        calls.append('update')
+    monkeypatch.setattr('import_proxies.periodic_update', fake_periodic_update)
+    task = startup.lazy('import_proxies', 'periodic_update')
+    assert task.__name__ == 'periodic_update'
+    await task()
+    assert calls == ['update']
+
+    phases = startup.StartupPhases()
+    with phases('first'):
+        pass
+    with phases('rebuild', background=True):
+        await asyncio.sleep(0.01)
+    assert [name for name, _, _ in phases.phases] == ['first', 'rebuild']
+    assert phases.total < 0.01
+    assert 'rebuild' not in phases.summary() and '(background)' in phases.report()
+
+    entries = startup.import_times(['records'])
+    assert (0, 'records') in [(depth, module) for depth, module, _, _ in entries]
+    assert 'records' in startup.import_report(['records'])
+
+@pytest.mark.asyncio
+async def test_assignment_leases_count_holders_and_expire(store, monkeypatch):
+    """Test that leases move holder counts in the alive index and expire in bulk on every store."""
+    proxies = [f'http://1.1.1.{i}:8080' for i in range(5)]
+    await import_proxies([make_proxy_data(f'1.1.1.{i}') for i in range(5)])
+    await rebuild_alive_index()
+    await assign_proxy(1, proxies[0], 'en')
+    await assign_proxy(2, proxies[0], 'en')
+    for proxy in proxies[1:4]:
+        await asyncio.sleep(0.001)
+        await assign_proxy(1, proxy, 'en')
+    await assign_proxy(1, proxies[3], 'en')  # extends the lease, no second holder
+    holders = {proxy: 1 for proxy in proxies[:4]}
+    assert await db_utils.get_holder_counts() == holders
+    assert {proxy: db_utils.alive_index.holders(proxy) for proxy in proxies} == dict(holders, **{proxies[4]: 0})
+
+    monkeypatch.setattr(config, 'ASSIGNMENT_TTL', -1, raising=False)
+    await assign_proxy(3, proxies[4], 'de')
+    assert await get_assigned_proxies_and_language_code(3) == ([], 'de')
+    assert db_utils.alive_index.holders(proxies[4]) == 1
+    assert await expire_assignments(100) == 1 and await expire_assignments(100) == 0
+    assert db_utils.alive_index.holders(proxies[4]) == 0
+    assert await db_utils.get_holder_counts() == holders
+
+    # A rebuild reads the same counts back from the store.
+    db_utils.alive_index.set_holders({})
+    await rebuild_alive_index()
+    assert {proxy: db_utils.alive_index.holders(proxy) for proxy in proxies[:4]} == holders
+
+def test_alive_index_prefers_lightly_held_proxies(tmp_path):
+    """Test that holders weigh a proxy down, re-weighing on acquire and release, and survive a snapshot."""
+    index = AliveIndex()
+    index.replace(['a', 'b'], holders={'a': 3})
+    random.seed(1)
+    picks = [index.sample() for _ in range(1000)]
+    assert picks.count('b') > 900
+    for _ in range(3):
+        index.release('a')
+    index.acquire('b')
+    assert (index.holders('a'), index.holders('b')) == (0, 1)
+    assert index._all.weight('a') == pytest.approx(1.0) and index._all.weight('b') == pytest.approx(0.25)
+
+    index.set_holders({'b': 1, 'gone': 2})
+    path = tmp_path / 'alive.snapshot'
+    path.write_bytes(index.to_snapshot(generation=1))
+    restored = AliveIndex()
+    restored.load_snapshot(str(path))
+    assert restored.holders('gone') == 2 and restored._all.weight('b') == pytest.approx(0.25)
+    restored.add(ProxyRecord('gone'), latency=100.0)
+    assert restored._all.weight('gone') == pytest.approx(proxy_score(100.0, 1.0) / 9)
+
+@pytest.mark.asyncio
+async def test_create_users_table_adds_leases_to_old_assignments(temp_db_path):
+    """Test that assignments made before leases existed get a full lease on upgrade."""
+    await init_db()
+    await import_proxies([make_proxy_data('1.1.1.1')])
+    async with aiosqlite.connect(temp_db_path / 'proxies.db') as db:
+        await db.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, language_code TEXT)')
+        await db.execute('CREATE TABLE user_proxies (user_id INTEGER NOT NULL, proxy_id INTEGER NOT NULL, '
+                         'assigned_at REAL NOT NULL, PRIMARY KEY (user_id, proxy_id)) WITHOUT ROWID')
+        await db.execute("INSERT INTO users VALUES (1, 'en')")
+        await db.execute('INSERT INTO user_proxies SELECT 1, id, 0 FROM proxies')
+        await db.commit()
+    await create_users_table()
+    assigned, _ = await get_assigned_proxies_and_language_code(1)
+    assert [proxy.proxy for proxy in assigned] == ['http://1.1.1.1:8080']
+    assert await expire_assignments(10) == 0
+
+
 
 # Run all tests
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from metrics import Counter
+
+CALLBACK_RATE = 1.0  # tokens per second, per chat
+CALLBACK_BURST = 5  # taps a chat can make at once
+HANDLER_CONCURRENCY = 100  # callback handlers running at the same time
+MAX_TRACKED_CHATS = 100_000
+
+THROTTLED_CALLBACKS = Counter('callback_throttled_total', 'Button taps not run on their own, by reason.', ['reason'])
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets, kept in an LRU of at most ``max_entries`` keys.
+
+    A bucket that has been idle long enough to refill completely carries no
+    information, so it is dropped; when every tracked key is still active the
+    least recently used one is dropped instead. Both happen on insert, so
+    memory stays bounded without a background sweep.
+    """
+
+    def __init__(self, rate=CALLBACK_RATE, burst=CALLBACK_BURST, max_entries=MAX_TRACKED_CHATS, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.clock = clock
+        self._refill_time = burst / rate
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at], least recently used first
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key):
+        """Take a token for ``key``; return False if its bucket is empty."""
+        now = self.clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            self._evict(now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def refund(self, key):
+        """Give back a token allow() took for ``key`` that went unused."""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while len(buckets) > self.max_entries:
+            buckets.popitem(last=False)
+        while buckets:
+            tokens, updated_at = next(iter(buckets.values()))
+            if now - updated_at < self._refill_time:
+                break
+            buckets.popitem(last=False)
+
+
+class Coalescer:
+    """Runs one call per key at a time; callers arriving meanwhile share its result."""
+
+    def __init__(self):
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def in_flight(self, key):
+        return key in self._in_flight
+
+    async def run(self, key, factory):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # A cancelled caller must not cancel the call others are waiting on.
+        return await asyncio.shield(task)
+
+
+class CallbackThrottle:
+    """Gatekeeper for button taps: coalescing, then a per-chat limit, then a global cap.
+
+    A tap repeating one that is still running for the same chat waits for
+    it instead of running again and does not use up a token. Other taps take
+    a token from the chat's bucket and run under a semaphore of
+    ``concurrency`` slots.
+    """
+
+    def __init__(self, rate=CALLBACK_RATE, burst=CALLBACK_BURST, concurrency=HANDLER_CONCURRENCY,
+                 max_chats=MAX_TRACKED_CHATS, clock=time.monotonic):
+        self.limiter = TokenBucketLimiter(rate, burst, max_chats, clock)
+        self.coalescer = Coalescer()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _run_limited(self, handler):
+        async with self._semaphore:
+            return await handler()
+
+    async def run(self, chat_id, action, handler):
+        """Run ``handler()`` for a tap on ``action``; return False if the chat is rate limited."""
+        key = (chat_id, action)
+        if self.coalescer.in_flight(key):
+            THROTTLED_CALLBACKS.inc(reason='coalesced')
+        elif not self.limiter.allow(chat_id):
+            THROTTLED_CALLBACKS.inc(reason='rate_limited')
+            return False
+        await self.coalescer.run(key, lambda: self._run_limited(handler))
+        return True
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from aiohttp import web
+from telebot.types import Update
+
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_WORKERS = 64  # updates processed at the same time, across all chats
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_chat_id(update):
+    """Chat an update belongs to, used to keep each chat's updates in order."""
+    if update.message is not None:
+        return update.message.chat.id
+    if update.edited_message is not None:
+        return update.edited_message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+class UpdateDispatcher:
+    """Runs updates through the bot with a global concurrency cap.
+
+    Updates from the same chat are processed one at a time, in arrival
+    order; different chats run in parallel up to ``max_workers``. Per-chat
+    queues are dropped as soon as they drain.
+    """
+
+    def __init__(self, bot, max_workers=WEBHOOK_WORKERS, on_processed=None):
+        self.bot = bot
+        self.on_processed = on_processed
+        self._slots = asyncio.Semaphore(max_workers)
+        self._chats = {}
+        self._tasks = set()
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self._chats.values())
+
+    def submit(self, update):
+        """Queue an update and return immediately."""
+        received = time.perf_counter()
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            self._spawn(self._process(update, received))
+            return
+        queue = self._chats.get(chat_id)
+        if queue is not None:
+            queue.append((update, received))
+            return
+        self._chats[chat_id] = deque([(update, received)])
+        self._spawn(self._drain(chat_id))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, chat_id):
+        queue = self._chats[chat_id]
+        try:
+            while queue:
+                update, received = queue[0]
+                await self._process(update, received)
+                queue.popleft()
+        finally:
+            del self._chats[chat_id]
+
+    async def _process(self, update, received):
+        async with self._slots:
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception:
+                logging.exception(f"Failed to process update {update.update_id}.")
+        if self.on_processed is not None:
+            self.on_processed(time.perf_counter() - received)
+
+    async def join(self):
+        """Wait until every queued update has been processed."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+
+
+DISPATCHER_KEY = web.AppKey('dispatcher', UpdateDispatcher)
+
+
+def create_webhook_app(bot, path=WEBHOOK_PATH, secret_token=None, max_workers=WEBHOOK_WORKERS, on_processed=None):
+    """Build an aiohttp app that feeds Telegram webhook calls to the bot's handlers."""
+    dispatcher = UpdateDispatcher(bot, max_workers, on_processed)
+
+    async def handle_update(request):
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        dispatcher.submit(update)
+        return web.Response()
+
+    async def drain_updates(app):
+        await dispatcher.join()
+
+    app = web.Application()
+    app[DISPATCHER_KEY] = dispatcher
+    app.router.add_post(path, handle_update)
+    app.on_shutdown.append(drain_updates)
+    return app
+
+
+async def register_webhook(bot, url, path=WEBHOOK_PATH, secret_token=None):
+    """Ask Telegram to post updates to ``url`` + ``path``."""
+    await bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret_token)
+
+
+async def run_webhook(bot, url, host='0.0.0.0', port=8443, path=WEBHOOK_PATH, secret_token=None,
+                      max_workers=WEBHOOK_WORKERS, reuse_port=False, register=True):
+    """Serve updates until cancelled, registering the webhook with Telegram for that time.
+
+    With ``reuse_port`` several worker processes can listen on the same port
+    and the kernel spreads connections between them. Such workers pass
+    ``register=False`` and only serve: the webhook belongs to all of them, so
+    bot.launch_workers sets it once and removes it after the last one exits.
+    """
+    app = create_webhook_app(bot, path, secret_token, max_workers)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, reuse_port=reuse_port or None)
+    await site.start()
+    if register:
+        await register_webhook(bot, url, path, secret_token)
+    logging.info(f"Serving webhook on {host}:{port}{path}.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if register:
+            await bot.remove_webhook()
+        await runner.cleanup()